@@ -10,9 +10,13 @@ from flask import Flask, render_template, request, jsonify, redirect, url_for
 from werkzeug.utils import secure_filename
 from PIL import Image
 import torch
-from transformers import OwlViTProcessor, OwlViTForObjectDetection
 import numpy as np
 
+from model_bundle import load_owlvit
+from owlvit_postprocessing import DEFAULT_TOP_K, postprocess_detections
+from owlvit_preprocessing import OwlViTPreprocessor
+from owlvit_runtime import runtime_from_env
+
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -26,7 +30,9 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 
 # Global model variables
 processor = None
+preprocessor = None
 model = None
+runtime = None
 device = None
 
 def calculate_iou(box1, box2):
@@ -99,19 +105,20 @@ def allowed_file(filename):
 
 def load_model():
     """Load the OWL-ViT model."""
-    global processor, model, device
+    global processor, preprocessor, model, runtime, device
     
     if processor is None or model is None:
         print("Loading OWL-ViT model...")
-        processor = OwlViTProcessor.from_pretrained("google/owlvit-base-patch32")
-        model = OwlViTForObjectDetection.from_pretrained("google/owlvit-base-patch32")
+        processor, model = load_owlvit("google/owlvit-base-patch32")
+        preprocessor = OwlViTPreprocessor(processor)
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         model.to(device)
+        runtime = runtime_from_env(model, "google/owlvit-base-patch32", device)
         print(f"Model loaded on device: {device}")
 
-def detect_lays_in_image(image, confidence_threshold=0.1):
+def detect_lays_in_image(image, confidence_threshold=0.1, top_k=DEFAULT_TOP_K):
     """Detect Lay's chips in the given image."""
-    global processor, model, device
+    global processor, preprocessor, model, runtime, device
     
     # Load model if not already loaded
     load_model()
@@ -124,38 +131,13 @@ def detect_lays_in_image(image, confidence_threshold=0.1):
     ]
     
     # Prepare inputs
-    inputs = processor(
-        text=lays_prompts, 
-        images=image, 
-        return_tensors="pt"
-    )
-    
-    # Move inputs to device
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    inputs = preprocessor(text=lays_prompts, images=image, device=device)
     
     # Run inference
-    with torch.no_grad():
-        outputs = model(**inputs)
+    outputs = runtime(**inputs)
     
     # Process outputs
-    target_sizes = torch.Tensor([image.size[::-1]]).to(device)
-    results = processor.post_process_object_detection(
-        outputs=outputs, 
-        target_sizes=target_sizes, 
-        threshold=confidence_threshold
-    )
-    
-    detections = []
-    boxes, scores, labels = results[0]["boxes"], results[0]["scores"], results[0]["labels"]
-    
-    for box, score, label in zip(boxes, scores, labels):
-        detection = {
-            "box": box.cpu().numpy().tolist(),
-            "score": float(score.cpu()),
-            "label": lays_prompts[label.cpu().item()],
-            "label_id": int(label.cpu().item())
-        }
-        detections.append(detection)
+    detections = postprocess_detections(outputs, image.size, lays_prompts, confidence_threshold, top_k)
     
     # Apply Non-Maximum Suppression to remove duplicate detections
     filtered_detections = non_maximum_suppression(detections, iou_threshold=0.3)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Multi-image upload helpers for the batch endpoints
+
+A batch arrives as several multipart `files` fields, as zip/tar archives of
+photos, or a mix of both. Archives are read member by member (tar in
+streaming mode), and every photo is decoded on a shared thread pool: Pillow
+releases the GIL while decoding, so a visit's photos decode in parallel
+while the request thread waits for the slowest one.
+
+Archives are size-checked before anything is inflated: a member larger than
+MAX_IMAGE_MB (by its header, or by actually reading one byte past the cap)
+is rejected, and so is a batch whose photos add up to more than MAX_BATCH_MB
+uncompressed, so a small zip bomb cannot expand into gigabytes in memory.
+"""
+
+import io
+import os
+import tarfile
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from memory_budget import decode_bounded
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz')
+MAX_BATCH_IMAGES = int(os.environ.get("MAX_BATCH_IMAGES", 32))
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_MB", 16)) * 1024 * 1024
+MAX_BATCH_BYTES = int(os.environ.get("MAX_BATCH_MB", 128)) * 1024 * 1024
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", min(8, os.cpu_count() or 1)))
+
+_decode_pool = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+
+
+def _is_image(name):
+    return '.' in name and name.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def _read_bounded(name, stream, size, max_bytes):
+    """Read one photo, refusing it when its declared or actual size exceeds max_bytes."""
+    if size is not None and size > max_bytes:
+        raise ValueError(f"{name} exceeds {max_bytes // (1024 * 1024)} MB")
+    data = stream.read(max_bytes + 1)  # Headers can lie about the inflated size
+    if len(data) > max_bytes:
+        raise ValueError(f"{name} exceeds {max_bytes // (1024 * 1024)} MB")
+    return data
+
+
+def _archive_members(name, stream, max_bytes=MAX_IMAGE_BYTES):
+    """Yield (member name, bytes) for every photo in a zip or tar archive."""
+    try:
+        if name.lower().endswith('.zip'):
+            with zipfile.ZipFile(stream) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and _is_image(info.filename):
+                        with archive.open(info) as member:
+                            yield info.filename, _read_bounded(info.filename, member, info.file_size, max_bytes)
+        else:
+            with tarfile.open(fileobj=stream, mode="r|*") as archive:
+                for member in archive:
+                    if member.isfile() and _is_image(member.name):
+                        yield member.name, _read_bounded(member.name, archive.extractfile(member), member.size,
+                                                         max_bytes)
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error) as e:
+        raise ValueError(f"Corrupt archive {name}: {e}")
+
+
+def collect_uploads(files, max_images=MAX_BATCH_IMAGES, max_image_bytes=MAX_IMAGE_BYTES,
+                    max_batch_bytes=MAX_BATCH_BYTES):
+    """Flatten uploaded files and archives into (name, bytes) pairs.
+
+    Raises ValueError when the batch holds more than max_images photos, a
+    photo is larger than max_image_bytes, the photos add up to more than
+    max_batch_bytes, or a file is neither a photo nor a supported archive.
+    """
+    items = []
+    total = 0
+    for upload in files:
+        name = upload.filename or ''
+        if name.lower().endswith(ARCHIVE_SUFFIXES):
+            members = _archive_members(name, upload.stream, max_image_bytes)
+        elif _is_image(name):
+            members = [(name, _read_bounded(name, upload.stream, None, max_image_bytes))]
+        else:
+            raise ValueError(f"Unsupported file in batch: {name}")
+
+        for item in members:
+            items.append(item)
+            total += len(item[1])
+            if len(items) > max_images:
+                raise ValueError(f"Batch exceeds {max_images} images")
+            if total > max_batch_bytes:
+                raise ValueError(f"Batch exceeds {max_batch_bytes // (1024 * 1024)} MB of photos")
+    return items
+
+
+def _decode(data, max_side=None):
+    if max_side:
+        return decode_bounded(data, max_side)
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image.convert('RGB') if image.mode != 'RGB' else image
+
+
+def decode_images(items, max_side=None):
+    """Decode (name, bytes) pairs in parallel into (name, image, error) triples, keeping order.
+
+    With max_side, photos are decoded straight to that working resolution.
+    """
+    futures = [(name, _decode_pool.submit(_decode, data, max_side)) for name, data in items]
+    decoded = []
+    for name, future in futures:
+        try:
+            decoded.append((name, future.result(), None))
+        except Exception as e:
+            decoded.append((name, None, f"Could not decode image: {e}"))
+    return decoded
+
+
+def chunked(items, size):
+    """Split a list into consecutive chunks of at most size items."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Compact closed-set Lay's pack detector
+
+A small CenterNet-style network distilled from the multi-model ensemble (see
+distill.py): depthwise-separable convolutions down to stride 32, one
+upsampling merge back to a stride-8 feature map, and three 1x1 heads for a
+per-cell pack heatmap, the box size and the sub-cell centre offset. At a
+320x320 input it has well under a million parameters and needs no NMS: peaks
+are picked with a 3x3 max-pool.
+
+Weights are exported as safetensors with the input size and labels in the
+metadata, and load into LaysDetector as a drop-in backend:
+
+    python lays_detector.py shelf.jpg --student lays_student.safetensors
+"""
+
+import json
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+INPUT_SIZE = 320
+STRIDE = 8
+DEFAULT_LABELS = ["Lay's pack"]
+
+# ImageNet statistics, the network is trained from scratch with the same normalization
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32) * 255
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32) * 255
+
+
+def _separable(in_channels, out_channels, stride=1):
+    return nn.Sequential(
+        nn.Conv2d(in_channels, in_channels, 3, stride, 1, groups=in_channels, bias=False),
+        nn.BatchNorm2d(in_channels),
+        nn.ReLU(inplace=True),
+        nn.Conv2d(in_channels, out_channels, 1, bias=False),
+        nn.BatchNorm2d(out_channels),
+        nn.ReLU(inplace=True)
+    )
+
+
+class CompactDetector(nn.Module):
+    """Heatmap / size / offset detector with a stride-8 output."""
+
+    def __init__(self, num_classes=1, width=32):
+        super().__init__()
+        self.num_classes = num_classes
+        self.width = width
+        self.stem = nn.Sequential(
+            nn.Conv2d(3, width // 2, 3, 2, 1, bias=False),
+            nn.BatchNorm2d(width // 2),
+            nn.ReLU(inplace=True),
+            _separable(width // 2, width, 2)
+        )
+        self.stage8 = nn.Sequential(_separable(width, 2 * width, 2), _separable(2 * width, 2 * width))
+        self.stage16 = nn.Sequential(_separable(2 * width, 4 * width, 2), _separable(4 * width, 4 * width))
+        self.stage32 = nn.Sequential(_separable(4 * width, 8 * width, 2), _separable(8 * width, 8 * width))
+        self.lateral = nn.Conv2d(8 * width, 2 * width, 1)
+        self.merge = _separable(2 * width, 2 * width)
+
+        self.heatmap = nn.Conv2d(2 * width, num_classes, 1)
+        self.size = nn.Conv2d(2 * width, 2, 1)
+        self.offset = nn.Conv2d(2 * width, 2, 1)
+
+        # Start with a low pack prior so the focal loss is not swamped by background cells
+        nn.init.constant_(self.heatmap.bias, -2.19)
+
+    def forward(self, pixel_values):
+        c8 = self.stage8(self.stem(pixel_values))
+        c32 = self.stage32(self.stage16(c8))
+        features = self.merge(c8 + F.interpolate(self.lateral(c32), size=c8.shape[-2:], mode="nearest"))
+        return self.heatmap(features), self.size(features), self.offset(features)
+
+
+def preprocess(images, input_size=INPUT_SIZE):
+    """Resize and normalize PIL images into a (batch, 3, input_size, input_size) tensor."""
+    batch = np.empty((len(images), input_size, input_size, 3), dtype=np.float32)
+    for i, image in enumerate(images):
+        pixels = np.asarray(image.convert("RGB"))
+        interpolation = cv2.INTER_AREA if max(pixels.shape[:2]) > input_size else cv2.INTER_LINEAR
+        batch[i] = cv2.resize(pixels, (input_size, input_size), interpolation=interpolation)
+    batch -= MEAN
+    batch /= STD
+    return torch.from_numpy(batch).permute(0, 3, 1, 2).contiguous()
+
+
+def decode(heatmap, size, offset, image_sizes, labels, threshold=0.1, top_k=100):
+    """Turn raw head outputs into one list of detection dicts per image."""
+    scores = torch.sigmoid(heatmap)
+    peaks = scores == F.max_pool2d(scores, 3, stride=1, padding=1)
+    scores = (scores * peaks).flatten(1)
+
+    batch, num_classes, height, width = heatmap.shape
+    top_scores, top_indices = scores.topk(min(top_k, scores.shape[1]), dim=1)
+
+    cell = top_indices % (height * width)
+    label_ids = top_indices // (height * width)
+    ys = (cell // width).float()
+    xs = (cell % width).float()
+
+    size = size.flatten(2)
+    offset = offset.flatten(2)
+    detections = []
+    for i, (image_width, image_height) in enumerate(image_sizes):
+        keep = top_scores[i] > threshold
+        gather = cell[i][keep]
+        cx = (xs[i][keep] + offset[i, 0, gather]) / width * image_width
+        cy = (ys[i][keep] + offset[i, 1, gather]) / height * image_height
+        w = size[i, 0, gather].clamp(min=0) * image_width
+        h = size[i, 1, gather].clamp(min=0) * image_height
+
+        rows = torch.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2,
+                            top_scores[i][keep], label_ids[i][keep].float()], dim=1).tolist()
+        detections.append([{
+            "box": [x1, y1, x2, y2],
+            "score": score,
+            "label": labels[int(label_id)],
+            "label_id": int(label_id)
+        } for x1, y1, x2, y2, score, label_id in rows])
+    return detections
+
+
+class StudentDetector:
+    """Inference wrapper around an exported CompactDetector."""
+
+    def __init__(self, model, labels=DEFAULT_LABELS, input_size=INPUT_SIZE, device=None):
+        self.device = device or torch.device("cpu")
+        self.model = model.to(self.device).eval()
+        self.labels = list(labels)
+        self.input_size = input_size
+
+    @classmethod
+    def load(cls, path, device=None):
+        """Load weights and metadata written by save()."""
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+
+        with safe_open(str(path), framework="pt") as f:
+            metadata = f.metadata()
+        labels = json.loads(metadata["labels"])
+        model = CompactDetector(num_classes=len(labels), width=int(metadata["width"]))
+        model.load_state_dict(load_file(str(path)))
+        return cls(model, labels, int(metadata["input_size"]), device)
+
+    def save(self, path, **extra_metadata):
+        """Export weights as safetensors with the input size and labels in the metadata."""
+        from safetensors.torch import save_file
+
+        metadata = {"labels": json.dumps(self.labels), "input_size": str(self.input_size),
+                    "width": str(self.model.width), "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        metadata.update({key: str(value) for key, value in extra_metadata.items()})
+        state_dict = {k: v.detach().contiguous().cpu() for k, v in self.model.state_dict().items()}
+        save_file(state_dict, str(path), metadata=metadata)
+
+    def detect_batch(self, images, confidence_threshold=0.1, top_k=100):
+        """Detect packs in a list of PIL images."""
+        pixel_values = preprocess(images, self.input_size).to(self.device)
+        with torch.inference_mode():
+            heatmap, size, offset = self.model(pixel_values)
+        return decode(heatmap, size, offset, [image.size for image in images], self.labels,
+                      confidence_threshold, top_k)
+
+    def detect(self, image, confidence_threshold=0.1, top_k=100):
+        """Detect packs in one PIL image."""
+        return self.detect_batch([image], confidence_threshold, top_k)[0]
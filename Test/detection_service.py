@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Local Lay's detection service for the Node backend
+
+A long-running replacement for the Cloud Vision call in
+backend/utils/aiDetection.js. The models are loaded once, and the service
+answers with the same result shape `analyzeImageForLays` builds from Cloud
+Vision (laysDetected, laysCount, confidence, detectionMethod,
+logoDetections, extractedText, detectedObjects, laysTextFound), so the
+controller and the shop model need no changes.
+
+The image goes in as raw bytes in the request body (no multipart or base64
+encoding), or as a `url` query parameter that the service fetches through
+the pooled, disk-cached image fetcher. The server speaks HTTP/1.1 with
+keep-alive, so Node's pooled fetch reuses its connections across visits.
+
+Usage:
+    python detection_service.py --port 5003
+    curl --data-binary @shelf.jpg -H "Content-Type: image/jpeg" http://localhost:5003/v1/detect
+    LOCAL_DETECTION_URL=http://localhost:5003 npm start   # in backend/
+"""
+
+import argparse
+import io
+import logging
+import time
+from datetime import datetime, timezone
+
+import requests
+from flask import Flask, jsonify, request
+from PIL import Image
+from werkzeug.serving import WSGIRequestHandler
+
+import multi_model_app as pipeline
+from image_fetcher import ImageTooLarge, default_fetcher
+from inference_scheduler import install_scheduler
+from load_replay import install_capture
+from memory_budget import BudgetExceeded, install_budget
+from phash_index import rescale_detections
+from profiler_capture import install_profiler
+from single_flight import RequestAbandoned, install_single_flight
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024
+install_capture(app)  # Records traffic for load replay when TRAFFIC_CAPTURE_DIR is set
+if pipeline.memory_budget is not None:
+    install_budget(app, pipeline.memory_budget)
+profiler = install_profiler(app)  # Armed on demand via /admin/profile or SIGUSR2
+single_flight = install_single_flight(app)  # Identical concurrent requests share one pipeline run
+if pipeline.scheduler is not None:
+    install_scheduler(app, pipeline.scheduler)  # ?priority=bulk&tenant=<manager> for rescoring jobs
+
+LAYS_TEXT_KEYWORDS = [
+    'lays', "lay's", 'lays classic', 'lays masala', 'lays magic masala',
+    'lays cream onion', 'lays cheese herbs', 'lays tomato tango', 'lays macho chilli'
+]
+
+
+def _bounding_poly(box):
+    x1, y1, x2, y2 = [round(v) for v in box]
+    return {"vertices": [{"x": x1, "y": y1}, {"x": x2, "y": y1}, {"x": x2, "y": y2}, {"x": x1, "y": y2}]}
+
+
+def to_vision_result(detections, elapsed_ms):
+    """Map pipeline detections onto the result shape aiDetection.js stores for a visit."""
+    extracted_text = " ".join(d['ocr_text'] for d in detections
+                              if d.get('ocr_text') and d['ocr_text'] != "OCR not available")
+    lays_text_found = any(keyword in extracted_text.lower() for keyword in LAYS_TEXT_KEYWORDS)
+
+    # OCR-confirmed boxes play the role of Cloud Vision's logo hits
+    logo_hits = [d for d in detections if d.get('ocr_verified') and d.get('ocr_text') != "OCR not available"]
+    if logo_hits:
+        method, counted = 'logo', logo_hits
+    elif detections:
+        method, counted = 'object', detections
+    elif lays_text_found:
+        method, counted = 'text', []
+    else:
+        method, counted = 'none', []
+
+    if counted:
+        confidence = sum(d['score'] for d in counted) / len(counted)
+    else:
+        confidence = 0.7 if lays_text_found else 0.0
+
+    return {
+        "laysDetected": method != 'none',
+        "laysCount": max(len(counted), 1) if method != 'none' else 0,
+        "confidence": round(confidence, 2),
+        "detectionMethod": method,
+        "laysTextFound": lays_text_found,
+        "logoDetections": [{
+            "description": "Lay's",
+            "score": round(d['score'], 4),
+            "boundingPoly": _bounding_poly(d['box'])
+        } for d in logo_hits],
+        "extractedText": extracted_text[:500],
+        "detectedObjects": [{"name": d['label'], "score": round(d['score'], 4)} for d in detections[:10]],
+        "detectedLabels": [],
+        "processedAt": datetime.now(timezone.utc).isoformat(),
+        "processingMs": round(elapsed_ms, 1)
+    }
+
+
+def _read_image():
+    """Decode the request image from the raw body or the `url` query parameter.
+
+    Returns (image, original size); the image is downscaled when a memory budget is active.
+    """
+    url = request.args.get('url')
+    if url:
+        data = default_fetcher().fetch(url)
+    else:
+        data = request.get_data(cache=False)
+    if not data:
+        raise ValueError("Request has no image body or url")
+
+    if pipeline.memory_budget is not None:
+        return pipeline.memory_budget.open_image(data)
+    image = Image.open(io.BytesIO(data))
+    return (image.convert('RGB') if image.mode != 'RGB' else image), image.size
+
+
+@app.route('/v1/detect', methods=['POST'])
+def detect():
+    """Detect Lay's in one image and answer in the Cloud Vision result shape."""
+    try:
+        confidence = float(request.args.get('confidence', 0.1))
+        image, original_size = _read_image()
+    except ImageTooLarge as e:
+        return jsonify({'error': str(e)}), 413
+    except (ValueError, OSError, requests.RequestException) as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        start = time.perf_counter()
+        detections = pipeline.multi_model_detect_lays(image, confidence_threshold=confidence)
+        if image.size != original_size:
+            # Report boxes in the uploaded photo's pixels
+            detections = rescale_detections(detections, image.size, original_size)
+        if pipeline.results_store is not None:
+            pipeline.results_store.record(detections, image_id=request.args.get('url'),
+                                          shop_id=request.args.get('shop_id'), visit_id=request.args.get('visit_id'),
+                                          model_version=pipeline.model_version_name, confidence=confidence)
+        return jsonify(to_vision_result(detections, (time.perf_counter() - start) * 1000))
+    except (BudgetExceeded, RequestAbandoned):
+        raise
+    except Exception as e:
+        logger.error(f"Error in detect: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/health')
+def health():
+    """Health check endpoint."""
+    return jsonify({
+        'status': 'healthy',
+        'owlvit_loaded': pipeline.owlvit_model is not None,
+        'paddleocr_loaded': pipeline.paddleocr_model is not None,
+        'device': str(pipeline.device),
+        'single_flight': single_flight.stats() if single_flight is not None else None,
+        'scheduler': pipeline.scheduler.stats() if pipeline.scheduler is not None else None
+    })
+
+
+def main():
+    """Load the models once and serve detections with keep-alive connections."""
+    parser = argparse.ArgumentParser(description="Local Lay's detection service for the Node backend")
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=5003, help="Port (default: 5003)")
+    args = parser.parse_args()
+
+    print("Loading models on startup...")
+    pipeline.load_models()
+    print("Models loaded successfully!")
+
+    # HTTP/1.1 keeps client connections open between requests
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
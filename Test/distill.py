@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Distil the multi-model ensemble into the compact closed-set detector
+
+Three steps, all on local data:
+
+    # 1. Pseudo-label archived shelf photos with multi_model_detect_lays
+    python distill.py label archive/ --output pseudo_labels.jsonl
+
+    # 2. Train the compact detector on the pseudo-labels
+    python distill.py train pseudo_labels.jsonl --output lays_student.safetensors
+
+    # 3. Compare the student with the teacher on the held-out split
+    python distill.py eval pseudo_labels.jsonl lays_student.safetensors --report distill_report.json
+
+Label files are JSON lines with one photo each: its path, size, the teacher's
+detections and how long the teacher took. A fixed fraction of photos (chosen
+by a hash of the path) is held out from training for evaluation. With
+--ground-truth, a hand-labelled file in the same format is used as the
+reference for both teacher and student instead of the teacher's own labels.
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from compact_detector import (DEFAULT_LABELS, INPUT_SIZE, STRIDE, CompactDetector, StudentDetector,
+                              preprocess)
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
+HOLDOUT_PERCENT = 10
+
+
+def is_holdout(path):
+    """Stable train/eval split by a hash of the photo path."""
+    return int(hashlib.sha1(str(path).encode()).hexdigest(), 16) % 100 < HOLDOUT_PERCENT
+
+
+def read_labels(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def pseudo_label(folder, output, confidence=0.1):
+    """Run the teacher ensemble over every photo in folder and write its detections."""
+    import multi_model_app as teacher
+
+    teacher.load_models()
+    paths = [p for p in sorted(Path(folder).rglob("*")) if p.suffix.lower() in IMAGE_EXTENSIONS]
+
+    labelled = 0
+    with open(output, "w") as f:
+        for path in paths:
+            image = Image.open(path).convert("RGB")
+            start = time.perf_counter()
+            detections = teacher.multi_model_detect_lays(image, confidence_threshold=confidence)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+
+            f.write(json.dumps({
+                "image": str(path),
+                "width": image.size[0],
+                "height": image.size[1],
+                "detections": [{"box": d["box"], "score": d["score"]} for d in detections],
+                "teacher_ms": round(elapsed_ms, 2)
+            }) + "\n")
+            labelled += 1
+            print(f"🏷️  {path}: {len(detections)} pack(s) ({elapsed_ms:.0f} ms)")
+    return labelled
+
+
+def build_targets(records, flips, grid=INPUT_SIZE // STRIDE):
+    """CenterNet targets: Gaussian heatmap, normalized size and centre offset at each box centre."""
+    batch = len(records)
+    heatmap = torch.zeros(batch, 1, grid, grid)
+    size = torch.zeros(batch, 2, grid, grid)
+    offset = torch.zeros(batch, 2, grid, grid)
+    mask = torch.zeros(batch, 1, grid, grid)
+    ys, xs = torch.meshgrid(torch.arange(grid, dtype=torch.float32),
+                            torch.arange(grid, dtype=torch.float32), indexing="ij")
+
+    for i, (record, flip) in enumerate(zip(records, flips)):
+        for detection in record["detections"]:
+            x1, y1, x2, y2 = detection["box"]
+            if flip:
+                x1, x2 = record["width"] - x2, record["width"] - x1
+            w = (x2 - x1) / record["width"]
+            h = (y2 - y1) / record["height"]
+            if w <= 0 or h <= 0:
+                continue
+
+            cx = (x1 + x2) / 2 / record["width"] * grid
+            cy = (y1 + y2) / 2 / record["height"] * grid
+            cell_x = min(int(cx), grid - 1)
+            cell_y = min(int(cy), grid - 1)
+
+            sigma = max(0.5, min(w, h) * grid / 6)
+            gaussian = torch.exp(-((xs - cell_x) ** 2 + (ys - cell_y) ** 2) / (2 * sigma ** 2))
+            heatmap[i, 0] = torch.maximum(heatmap[i, 0], gaussian)
+            size[i, :, cell_y, cell_x] = torch.tensor([w, h])
+            offset[i, :, cell_y, cell_x] = torch.tensor([cx - cell_x, cy - cell_y])
+            mask[i, 0, cell_y, cell_x] = 1
+
+    return heatmap, size, offset, mask
+
+
+def detection_loss(outputs, targets):
+    """Penalty-reduced focal loss on the heatmap plus L1 on size and offset at box centres."""
+    heatmap_logits, size, offset = outputs
+    target_heatmap, target_size, target_offset, mask = targets
+
+    prob = torch.sigmoid(heatmap_logits).clamp(1e-4, 1 - 1e-4)
+    positive = target_heatmap.eq(1).float()
+    positive_loss = -torch.log(prob) * (1 - prob) ** 2 * positive
+    negative_loss = -torch.log(1 - prob) * prob ** 2 * (1 - target_heatmap) ** 4 * (1 - positive)
+    num_objects = positive.sum().clamp(min=1)
+    focal = (positive_loss.sum() + negative_loss.sum()) / num_objects
+
+    size_loss = (F.l1_loss(size, target_size, reduction="none") * mask).sum() / num_objects
+    offset_loss = (F.l1_loss(offset, target_offset, reduction="none") * mask).sum() / num_objects
+    return focal + 5 * size_loss + offset_loss
+
+
+def _load_image(path):
+    image = Image.open(path)
+    image.draft("RGB", (INPUT_SIZE, INPUT_SIZE))
+    return image.convert("RGB")
+
+
+def train(labels_path, output, epochs=30, batch_size=16, learning_rate=2e-3, width=32, min_score=0.0):
+    """Train the compact detector on the non-held-out pseudo-labels and export it."""
+    records = [r for r in read_labels(labels_path) if not is_holdout(r["image"])]
+    for record in records:
+        record["detections"] = [d for d in record["detections"] if d["score"] >= min_score]
+    if not records:
+        raise ValueError(f"No training photos in {labels_path}")
+
+    model = CompactDetector(num_classes=len(DEFAULT_LABELS), width=width)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=1e-4)
+    steps = epochs * math.ceil(len(records) / batch_size)
+    scheduler = torch.optim.lr_scheduler.OneCycleLR(optimizer, learning_rate, total_steps=steps)
+    rng = np.random.default_rng(0)
+
+    model.train()
+    for epoch in range(epochs):
+        order = rng.permutation(len(records))
+        total = 0.0
+        for start in range(0, len(order), batch_size):
+            batch = [records[i] for i in order[start:start + batch_size]]
+            flips = rng.random(len(batch)) < 0.5
+
+            images = []
+            for record, flip in zip(batch, flips):
+                image = _load_image(record["image"])
+                images.append(image.transpose(Image.FLIP_LEFT_RIGHT) if flip else image)
+
+            loss = detection_loss(model(preprocess(images)), build_targets(batch, flips))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            total += loss.item() * len(batch)
+
+        print(f"📉 Epoch {epoch + 1}/{epochs}: loss {total / len(records):.4f}")
+
+    student = StudentDetector(model, DEFAULT_LABELS)
+    student.save(output, teacher="multi_model_detect_lays", labels_file=labels_path, train_photos=len(records))
+    return student
+
+
+def _iou(a, b):
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def match_counts(predictions, references, iou_threshold=0.5):
+    """Greedy score-ordered matching; returns (true positives, predictions, references)."""
+    unmatched = [r["box"] for r in references]
+    true_positives = 0
+    for prediction in sorted(predictions, key=lambda d: d["score"], reverse=True):
+        ious = [_iou(prediction["box"], box) for box in unmatched]
+        if ious and max(ious) >= iou_threshold:
+            unmatched.pop(int(np.argmax(ious)))
+            true_positives += 1
+    return true_positives, len(predictions), len(references)
+
+
+def _summary(counts, latencies):
+    true_positives = sum(c[0] for c in counts)
+    predicted = sum(c[1] for c in counts)
+    referenced = sum(c[2] for c in counts)
+    return {
+        "precision": round(true_positives / predicted, 4) if predicted else None,
+        "recall": round(true_positives / referenced, 4) if referenced else None,
+        "median_ms": round(float(np.median(latencies)), 2) if latencies else None,
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2) if latencies else None
+    }
+
+
+def evaluate(labels_path, student_path, ground_truth=None, confidence=0.3, iou_threshold=0.5):
+    """Recall, precision and latency of student and teacher on the held-out photos."""
+    student = StudentDetector.load(student_path)
+    teacher_records = {r["image"]: r for r in read_labels(labels_path) if is_holdout(r["image"])}
+    if ground_truth:
+        references = {r["image"]: r for r in read_labels(ground_truth) if r["image"] in teacher_records}
+    else:
+        references = teacher_records
+    if not references:
+        raise ValueError("No held-out photos to evaluate")
+
+    student_counts, teacher_counts = [], []
+    student_ms, teacher_ms = [], []
+    for image_path, reference in references.items():
+        image = Image.open(image_path).convert("RGB")
+        start = time.perf_counter()
+        predictions = student.detect(image, confidence)
+        student_ms.append((time.perf_counter() - start) * 1000)
+        student_counts.append(match_counts(predictions, reference["detections"], iou_threshold))
+
+        teacher = teacher_records[image_path]
+        teacher_ms.append(teacher["teacher_ms"])
+        teacher_counts.append(match_counts(teacher["detections"], reference["detections"], iou_threshold))
+
+    report = {
+        "photos": len(references),
+        "reference": "ground_truth" if ground_truth else "teacher",
+        "confidence": confidence,
+        "iou_threshold": iou_threshold,
+        "student": _summary(student_counts, student_ms),
+        "teacher": _summary(teacher_counts, teacher_ms)
+    }
+    if report["student"]["median_ms"] and report["teacher"]["median_ms"]:
+        report["speedup"] = round(report["teacher"]["median_ms"] / report["student"]["median_ms"], 1)
+    return report
+
+
+def main():
+    """Pseudo-label, train and evaluate the distilled Lay's detector."""
+    parser = argparse.ArgumentParser(description="Distil the Lay's ensemble into a compact detector")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    label = subparsers.add_parser("label", help="Pseudo-label archived photos with the ensemble")
+    label.add_argument("folder", help="Folder of archived shelf photos")
+    label.add_argument("--output", "-o", default="pseudo_labels.jsonl",
+                       help="Label file (default: pseudo_labels.jsonl)")
+    label.add_argument("--confidence", "-c", type=float, default=0.1,
+                       help="Teacher confidence threshold (default: 0.1)")
+
+    fit = subparsers.add_parser("train", help="Train the compact detector on pseudo-labels")
+    fit.add_argument("labels", help="Label file from the label step")
+    fit.add_argument("--output", "-o", default="lays_student.safetensors",
+                     help="Exported weights (default: lays_student.safetensors)")
+    fit.add_argument("--epochs", type=int, default=30, help="Training epochs (default: 30)")
+    fit.add_argument("--batch-size", type=int, default=16, help="Batch size (default: 16)")
+    fit.add_argument("--lr", type=float, default=2e-3, help="Peak learning rate (default: 0.002)")
+    fit.add_argument("--width", type=int, default=32, help="Base channel width (default: 32)")
+    fit.add_argument("--min-score", type=float, default=0.0,
+                     help="Drop teacher detections below this score (default: 0.0)")
+
+    check = subparsers.add_parser("eval", help="Compare student and teacher on held-out photos")
+    check.add_argument("labels", help="Label file from the label step")
+    check.add_argument("student", help="Exported student weights")
+    check.add_argument("--ground-truth", "-g", help="Hand-labelled file to use as the reference")
+    check.add_argument("--confidence", "-c", type=float, default=0.3,
+                       help="Student confidence threshold (default: 0.3)")
+    check.add_argument("--iou", type=float, default=0.5, help="IoU for a match (default: 0.5)")
+    check.add_argument("--report", "-r", help="Write the report as JSON")
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "label":
+            count = pseudo_label(args.folder, args.output, args.confidence)
+            print(f"✅ {count} photo(s) labelled: {args.output}")
+        elif args.command == "train":
+            train(args.labels, args.output, args.epochs, args.batch_size, args.lr, args.width, args.min_score)
+            print(f"✅ Student exported: {args.output}")
+        else:
+            report = evaluate(args.labels, args.student, args.ground_truth, args.confidence, args.iou)
+            print(f"📊 {report['photos']} held-out photo(s), reference: {report['reference']}")
+            for name in ("teacher", "student"):
+                summary = report[name]
+                print(f"   {name:<8} precision {summary['precision']}  recall {summary['recall']}  "
+                      f"median {summary['median_ms']} ms  p95 {summary['p95_ms']} ms")
+            if "speedup" in report:
+                print(f"   Student is {report['speedup']}x faster")
+            if args.report:
+                with open(args.report, "w") as f:
+                    json.dump(report, f, indent=2)
+                print(f"✅ Report saved to: {args.report}")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Append-only store of OWL-ViT image-side embeddings
+
+For every processed image the store keeps the per-patch class embeddings,
+the per-patch logit shift/scale of the class head and the predicted boxes,
+all as float16 in flat files that are memory-mapped for reading. New prompts
+can then be scored against archived photos with one matrix multiply per
+image instead of a full vision-tower forward pass:
+
+    logits = (normalized_class_embeds @ normalized_queries.T + shift) * scale
+
+Usage:
+    python lays_detector.py shelf.jpg --embedding-store archive_store
+    python embedding_store.py archive_store --prompt "Lay's Magic Masala bag" --output hits.jsonl
+"""
+
+import argparse
+import json
+import sys
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from owlvit_postprocessing import DEFAULT_TOP_K, postprocess_batch
+
+EMBEDDINGS_FILE = "class_embeds.f16"
+LOGIT_PARAMS_FILE = "logit_params.f16"
+BOXES_FILE = "boxes.f16"
+INDEX_FILE = "index.jsonl"
+META_FILE = "meta.json"
+
+
+class _StoredOutputs:
+    """Minimal stand-in for model outputs consumed by postprocess_batch."""
+
+    def __init__(self, logits, pred_boxes):
+        self.logits = logits
+        self.pred_boxes = pred_boxes
+
+
+def image_side_tensors(model, outputs):
+    """Extract (class_embeds, logit_shift, logit_scale, pred_boxes) for the first image of outputs."""
+    batch_size, height, width, hidden = outputs.image_embeds.shape
+    image_feats = outputs.image_embeds.reshape(batch_size, height * width, hidden)[0]
+
+    class_head = model.class_head
+    with torch.inference_mode():
+        logit_shift = class_head.logit_shift(image_feats)
+        logit_scale = class_head.elu(class_head.logit_scale(image_feats)) + 1
+        class_embeds = F.normalize(outputs.class_embeds[0], dim=-1)
+
+    return class_embeds, logit_shift, logit_scale, outputs.pred_boxes[0]
+
+
+def encode_prompts(model, tokenizer, prompts, device):
+    """Projected OWL-ViT text embeddings for the prompts, shape (num_prompts, dim)."""
+    tokens = tokenizer(list(prompts), padding="max_length", return_tensors="pt")
+    with torch.inference_mode():
+        text_outputs = model.owlvit.text_model(
+            input_ids=tokens["input_ids"].to(device),
+            attention_mask=tokens["attention_mask"].to(device)
+        )
+        return model.owlvit.text_projection(text_outputs[1])
+
+
+class EmbeddingStore:
+    """Float16, memory-mapped, append-only per-patch embedding store."""
+
+    def __init__(self, path, model_name=None, dim=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+        meta_path = self.path / META_FILE
+        if meta_path.exists():
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if model_name and meta["model_name"] != model_name:
+                raise ValueError(f"Store was written with {meta['model_name']}, not {model_name}")
+        else:
+            if model_name is None or dim is None:
+                raise ValueError(f"New embedding store needs model_name and dim: {self.path}")
+            meta = {"model_name": model_name, "dim": dim}
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+
+        self.model_name = meta["model_name"]
+        self.dim = meta["dim"]
+        self.index = self._read_index()
+        self._mapped = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read_index(self):
+        index_path = self.path / INDEX_FILE
+        if not index_path.exists():
+            return []
+        with open(index_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def append(self, image_id, image_size, class_embeds, logit_shift, logit_scale, pred_boxes):
+        """Append one image's patch tensors; the index line is written last so readers never see partial rows."""
+        class_embeds = class_embeds.detach().to(torch.float16).cpu().numpy()
+        logit_params = torch.cat([logit_shift, logit_scale], dim=-1).detach().to(torch.float16).cpu().numpy()
+        pred_boxes = pred_boxes.detach().to(torch.float16).cpu().numpy()
+
+        if class_embeds.shape[-1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dim embeddings, got {class_embeds.shape[-1]}")
+
+        with self._lock:
+            offset = self.index[-1]["offset"] + self.index[-1]["num_patches"] if self.index else 0
+            for name, array in ((EMBEDDINGS_FILE, class_embeds), (LOGIT_PARAMS_FILE, logit_params),
+                                (BOXES_FILE, pred_boxes)):
+                with open(self.path / name, "ab") as f:
+                    f.write(np.ascontiguousarray(array).tobytes())
+
+            entry = {"image_id": image_id, "offset": offset, "num_patches": len(class_embeds),
+                     "width": image_size[0], "height": image_size[1]}
+            with open(self.path / INDEX_FILE, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.index.append(entry)
+            self._mapped = None
+
+    def _maps(self):
+        """Memory-map the data files, remapping after appends."""
+        if self._mapped is None:
+            rows = self.index[-1]["offset"] + self.index[-1]["num_patches"] if self.index else 0
+            self._mapped = tuple(
+                np.memmap(self.path / name, dtype=np.float16, mode="r", shape=(rows, width))
+                for name, width in ((EMBEDDINGS_FILE, self.dim), (LOGIT_PARAMS_FILE, 2), (BOXES_FILE, 4))
+            )
+        return self._mapped
+
+    def requery(self, query_embeds, labels, threshold=0.1, top_k=DEFAULT_TOP_K):
+        """Score new queries against every stored image, yielding (image_id, detections)."""
+        if not self.index:
+            return
+
+        queries = F.normalize(query_embeds.float().cpu(), dim=-1)
+        embeddings, logit_params, boxes = self._maps()
+
+        for entry in self.index:
+            rows = slice(entry["offset"], entry["offset"] + entry["num_patches"])
+            class_embeds = torch.from_numpy(np.asarray(embeddings[rows], dtype=np.float32))
+            params = torch.from_numpy(np.asarray(logit_params[rows], dtype=np.float32))
+            pred_boxes = torch.from_numpy(np.asarray(boxes[rows], dtype=np.float32))
+
+            logits = (class_embeds @ queries.T + params[:, :1]) * params[:, 1:]
+            outputs = _StoredOutputs(logits[None], pred_boxes[None])
+            detections = postprocess_batch(outputs, [(entry["width"], entry["height"])], labels, threshold, top_k)[0]
+            yield entry["image_id"], detections
+
+
+def main():
+    """Score new prompts against an embedding store without re-running the vision tower."""
+    from model_bundle import load_owlvit
+
+    parser = argparse.ArgumentParser(description="Re-query stored image embeddings with new prompts")
+    parser.add_argument("store", help="Embedding store directory")
+    parser.add_argument("--prompt", "-p", action="append", required=True,
+                       help="Prompt to score (repeat for several prompts)")
+    parser.add_argument("--confidence", "-c", type=float, default=0.1,
+                       help="Confidence threshold for detections (default: 0.1)")
+    parser.add_argument("--top-k", "-k", type=int, default=DEFAULT_TOP_K,
+                       help=f"Maximum candidates kept per prompt (default: {DEFAULT_TOP_K})")
+    parser.add_argument("--output", "-o", help="Write per-image detections as JSON lines")
+    args = parser.parse_args()
+
+    try:
+        store = EmbeddingStore(args.store)
+        processor, model = load_owlvit(store.model_name)
+        model.eval()
+        query_embeds = encode_prompts(model, processor.tokenizer, args.prompt, torch.device("cpu"))
+
+        output = open(args.output, "w") if args.output else None
+        matched = 0
+        for image_id, detections in store.requery(query_embeds, args.prompt, args.confidence, args.top_k):
+            if detections:
+                matched += 1
+                print(f"✅ {image_id}: {len(detections)} detection(s)")
+            if output:
+                output.write(json.dumps({"image_id": image_id, "detections": detections}) + "\n")
+        if output:
+            output.close()
+
+        print(f"\n📊 {matched}/{len(store)} stored image(s) matched")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
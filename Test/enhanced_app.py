@@ -7,15 +7,23 @@ Combines OWL-ViT, Grounding DINO, PaddleOCR, and SAM2 for robust detection
 import os
 import io
 import base64
-import cv2
 import numpy as np
 from flask import Flask, render_template, request, jsonify
 from werkzeug.utils import secure_filename
 from PIL import Image
 import torch
-from transformers import OwlViTProcessor, OwlViTForObjectDetection
 import logging
 
+from grounding_dino_adapter import GroundingDinoAdapter
+from model_bundle import load_grounding_dino, load_owlvit, paddleocr_kwargs
+from owlvit_postprocessing import DEFAULT_TOP_K, postprocess_detections
+from owlvit_preprocessing import OwlViTPreprocessor
+from owlvit_runtime import runtime_from_env
+from phash_index import detect_with_index, index_from_env
+from profiler_capture import install_profiler, profiled
+from sam_refinement import mask_refiner_from_env
+from single_flight import RequestAbandoned, install_single_flight, raise_if_abandoned
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,6 +32,8 @@ app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+profiler = install_profiler(app)  # Armed on demand via /admin/profile or SIGUSR2
+single_flight = install_single_flight(app)  # Identical concurrent requests share one pipeline run
 
 # Create upload directory if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -33,10 +43,15 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 
 # Global model variables
 owlvit_processor = None
+owlvit_preprocessor = None
 owlvit_model = None
+owlvit_runtime = None
 grounding_dino_model = None
+grounding_dino_adapter = None
 paddleocr_model = None
 device = None
+duplicate_index = None
+mask_refiner = None
 
 def allowed_file(filename):
     """Check if file extension is allowed."""
@@ -44,7 +59,7 @@ def allowed_file(filename):
 
 def load_models():
     """Load all detection models."""
-    global owlvit_processor, owlvit_model, grounding_dino_model, paddleocr_model, device
+    global owlvit_processor, owlvit_preprocessor, owlvit_model, owlvit_runtime, grounding_dino_model, grounding_dino_adapter, paddleocr_model, device, duplicate_index, mask_refiner
     
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     logger.info(f"Using device: {device}")
@@ -52,30 +67,46 @@ def load_models():
     try:
         # Load OWL-ViT
         logger.info("Loading OWL-ViT model...")
-        owlvit_processor = OwlViTProcessor.from_pretrained("google/owlvit-base-patch32")
-        owlvit_model = OwlViTForObjectDetection.from_pretrained("google/owlvit-base-patch32")
+        owlvit_processor, owlvit_model = load_owlvit("google/owlvit-base-patch32")
+        owlvit_preprocessor = OwlViTPreprocessor(owlvit_processor)
         owlvit_model.to(device)
+        owlvit_runtime = runtime_from_env(owlvit_model, "google/owlvit-base-patch32", device)
         logger.info("OWL-ViT loaded successfully")
         
         # Load Grounding DINO
         logger.info("Loading Grounding DINO model...")
         try:
-            from groundingdino.util.inference import load_model, load_image, predict, annotate
-            grounding_dino_model = load_model("groundingdino/groundingdino_swint_ogc", "groundingdino_swint_ogc.pth")
+            grounding_dino_model = load_grounding_dino("groundingdino/groundingdino_swint_ogc", "groundingdino_swint_ogc.pth")
+            grounding_dino_adapter = GroundingDinoAdapter(grounding_dino_model, device)
             logger.info("Grounding DINO loaded successfully")
         except Exception as e:
             logger.warning(f"Grounding DINO not available: {e}")
             grounding_dino_model = None
+            grounding_dino_adapter = None
         
         # Load PaddleOCR
         logger.info("Loading PaddleOCR model...")
         try:
             from paddleocr import PaddleOCR
-            paddleocr_model = PaddleOCR(use_angle_cls=True, lang='en', show_log=False)
+            paddleocr_model = PaddleOCR(use_angle_cls=True, lang='en', show_log=False, **paddleocr_kwargs(legacy=True))
             logger.info("PaddleOCR loaded successfully")
         except Exception as e:
             logger.warning(f"PaddleOCR not available: {e}")
             paddleocr_model = None
+        
+        # Near-duplicate photo index (enabled by PHASH_INDEX_DIR)
+        duplicate_index = index_from_env()
+        if duplicate_index is not None:
+            logger.info(f"Near-duplicate index loaded with {len(duplicate_index)} photos")
+        
+        # SAM2 mask refinement for share-of-shelf (enabled by SAM_MODEL)
+        logger.info("Loading SAM2 model...")
+        try:
+            mask_refiner = mask_refiner_from_env(device)
+            logger.info("SAM2 loaded successfully" if mask_refiner is not None else "SAM2 disabled (SAM_MODEL not set)")
+        except Exception as e:
+            logger.warning(f"SAM2 not available: {e}")
+            mask_refiner = None
             
     except Exception as e:
         logger.error(f"Error loading models: {e}")
@@ -111,6 +142,7 @@ def is_box_contained(box1, box2):
     return (x1_min >= x2_min and y1_min >= y2_min and 
             x1_max <= x2_max and y1_max <= y2_max)
 
+@profiled("nms")
 def non_maximum_suppression(detections, iou_threshold=0.3):
     """Apply Non-Maximum Suppression to remove duplicate detections."""
     if len(detections) == 0:
@@ -136,9 +168,10 @@ def non_maximum_suppression(detections, iou_threshold=0.3):
     
     return keep
 
-def detect_with_owlvit(image, confidence_threshold=0.1):
+@profiled("owlvit")
+def detect_with_owlvit(image, confidence_threshold=0.1, top_k=DEFAULT_TOP_K):
     """Detect Lay's chips using OWL-ViT."""
-    global owlvit_processor, owlvit_model, device
+    global owlvit_processor, owlvit_preprocessor, owlvit_model, owlvit_runtime, device
     
     lays_prompts = [
         "Lay's potato chips bag",
@@ -148,76 +181,39 @@ def detect_with_owlvit(image, confidence_threshold=0.1):
         "Lay's logo"
     ]
     
-    inputs = owlvit_processor(text=lays_prompts, images=image, return_tensors="pt")
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    inputs = owlvit_preprocessor(text=lays_prompts, images=image, device=device)
     
-    with torch.no_grad():
-        outputs = owlvit_model(**inputs)
+    outputs = owlvit_runtime(**inputs)
     
-    target_sizes = torch.Tensor([image.size[::-1]]).to(device)
-    results = owlvit_processor.post_process_object_detection(
-        outputs=outputs, target_sizes=target_sizes, threshold=confidence_threshold
-    )
-    
-    detections = []
-    boxes, scores, labels = results[0]["boxes"], results[0]["scores"], results[0]["labels"]
-    
-    for box, score, label in zip(boxes, scores, labels):
-        detection = {
-            "box": box.cpu().numpy().tolist(),
-            "score": float(score.cpu()),
-            "label": lays_prompts[label.cpu().item()],
-            "model": "OWL-ViT"
-        }
-        detections.append(detection)
+    detections = postprocess_detections(outputs, image.size, lays_prompts, confidence_threshold, top_k)
+    for detection in detections:
+        detection["model"] = "OWL-ViT"
     
     return detections
 
+@profiled("grounding_dino")
 def detect_with_grounding_dino(image, confidence_threshold=0.1):
     """Detect Lay's chips using Grounding DINO."""
-    global grounding_dino_model
+    global grounding_dino_adapter
     
-    if grounding_dino_model is None:
+    if grounding_dino_adapter is None:
         return []
     
     try:
-        # Convert PIL to OpenCV format
-        img_array = np.array(image)
-        img_cv = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-        
-        # Grounding DINO detection
-        text_prompt = "Lay's chips bag . Lay's logo . Lay's potato chips . Lay's snack bag"
-        
-        from groundingdino.util.inference import load_image, predict, annotate
-        
-        # Load image for Grounding DINO
-        image_dino, _ = load_image(img_cv)
-        
-        # Run prediction
-        boxes, logits, phrases = predict(
-            model=grounding_dino_model,
-            image=image_dino,
-            caption=text_prompt,
-            box_threshold=confidence_threshold,
-            text_threshold=0.25
-        )
-        
-        detections = []
-        for box, score in zip(boxes, logits):
-            detection = {
-                "box": box.tolist(),
-                "score": float(score),
-                "label": "Lay's chips (Grounding DINO)",
-                "model": "Grounding DINO"
-            }
-            detections.append(detection)
-        
-        return detections
+        detections = grounding_dino_adapter.predict(image, box_threshold=confidence_threshold, text_threshold=0.25)
+        return [{
+            "box": detection["box"],
+            "score": detection["score"],
+            "label": "Lay's chips (Grounding DINO)",
+            "phrase": detection["phrase"],
+            "model": "Grounding DINO"
+        } for detection in detections]
         
     except Exception as e:
         logger.warning(f"Grounding DINO detection failed: {e}")
         return []
 
+@profiled("paddleocr")
 def verify_with_ocr(image, detection):
     """Verify detection using OCR to check for Lay's text."""
     global paddleocr_model
@@ -282,6 +278,7 @@ def verify_with_ocr(image, detection):
         detection['ocr_text'] = ""
         return True  # Trust detection if OCR fails
 
+@profiled("ensemble")
 def ensemble_detect_lays(image, confidence_threshold=0.1):
     """Combined detection using multiple models."""
     logger.info("Starting ensemble detection...")
@@ -289,12 +286,14 @@ def ensemble_detect_lays(image, confidence_threshold=0.1):
     all_detections = []
     
     # OWL-ViT detection
+    raise_if_abandoned()
     logger.info("Running OWL-ViT detection...")
     owlvit_detections = detect_with_owlvit(image, confidence_threshold)
     all_detections.extend(owlvit_detections)
     logger.info(f"OWL-ViT found {len(owlvit_detections)} detections")
     
     # Grounding DINO detection
+    raise_if_abandoned()
     logger.info("Running Grounding DINO detection...")
     dino_detections = detect_with_grounding_dino(image, confidence_threshold)
     all_detections.extend(dino_detections)
@@ -309,6 +308,7 @@ def ensemble_detect_lays(image, confidence_threshold=0.1):
     logger.info("Running OCR verification...")
     verified_detections = []
     for detection in filtered_detections:
+        raise_if_abandoned()
         if verify_with_ocr(image, detection):
             verified_detections.append(detection)
             logger.info(f"OCR verified detection: {detection['model']}")
@@ -318,6 +318,7 @@ def ensemble_detect_lays(image, confidence_threshold=0.1):
     logger.info(f"Final verified detections: {len(verified_detections)}")
     return verified_detections
 
+@profiled("annotate")
 def create_annotated_image(image, detections):
     """Create an annotated version of the image with bounding boxes."""
     from PIL import ImageDraw, ImageFont
@@ -355,6 +356,7 @@ def create_annotated_image(image, detections):
     
     return annotated_image
 
+@profiled("encode_image")
 def image_to_base64(image):
     """Convert PIL Image to base64 string."""
     buffer = io.BytesIO()
@@ -390,14 +392,27 @@ def upload_file():
             image = image.convert('RGB')
         
         # Detect Lay's using ensemble method
-        detections = ensemble_detect_lays(image, confidence_threshold=confidence)
+        record = {
+            'image_id': file.filename,
+            'shop_id': request.form.get('shop_id'),
+            'visit_id': request.form.get('visit_id')
+        }
+        detections, near_duplicate = detect_with_index(
+            duplicate_index, image, confidence,
+            lambda img, conf: ensemble_detect_lays(img, confidence_threshold=conf), record
+        )
+        
+        # Mask areas of the surviving boxes (embedding cached per image)
+        shelf_share = mask_refiner.refine(image, detections) if mask_refiner is not None else None
         
         # Prepare response data
         result = {
             'detected': len(detections) > 0,
             'count': len(detections),
             'detections': detections,
-            'original_image': image_to_base64(image)
+            'original_image': image_to_base64(image),
+            'near_duplicate': near_duplicate,
+            'shelf_share': shelf_share
         }
         
         # Add annotated image if detections found
@@ -420,6 +435,8 @@ def upload_file():
         
         return jsonify(result)
         
+    except RequestAbandoned:
+        raise
     except Exception as e:
         logger.error(f"Error in upload_file: {e}")
         return jsonify({'error': str(e)}), 500
@@ -432,6 +449,7 @@ def health():
         'owlvit_loaded': owlvit_model is not None,
         'grounding_dino_loaded': grounding_dino_model is not None,
         'paddleocr_loaded': paddleocr_model is not None,
+        'sam_loaded': mask_refiner is not None,
         'device': str(device)
     })
 
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Accuracy/throughput evaluation over a COCO-format labelled set
+
+Runs a pipeline profile once over the labelled photos, caches the raw model
+outputs, then sweeps post-processing settings over the cache without
+re-inferring:
+
+    python evaluate.py labels.json --images photos/ --sweep sweep.json --output eval_report.json
+
+For the `owlvit` profile the cache holds per-prompt logits for the union of
+every prompt set in the sweep (OWL-ViT scores each prompt independently, so
+any subset is a column slice), so prompt lists, confidence thresholds, NMS
+IoU and the OCR keyword gate are all swept from one forward pass per photo.
+OCR text is cached per box. The `student` profile sweeps thresholds of a
+distilled detector (see distill.py).
+
+Every configuration reports AP@0.5, mAP@[0.5:0.95], precision and recall at
+its threshold, per-photo latency and images/sec; the report ends with the
+Pareto frontier of AP@0.5 against latency. Boxes are matched class-agnostic.
+
+A sweep file is JSON with any of these keys (defaults in DEFAULT_SWEEP):
+
+    {"prompt_sets": {"short": ["Lay's chips bag", "Lay's logo"]},
+     "thresholds": [0.05, 0.1, 0.2], "nms_iou": [0.3, 0.5],
+     "ocr_keywords": [null, ["lay's", "lays"]]}
+
+A null keyword list means no OCR gate.
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+from owlvit_postprocessing import DEFAULT_TOP_K, center_to_corners, select_candidates
+
+IOU_THRESHOLDS = np.round(np.arange(0.5, 0.96, 0.05), 2)
+
+MULTI_MODEL_PROMPTS = [
+    "Lay's potato chips bag",
+    "Lay's Classic chips bag",
+    "Lay's snack bag with red logo",
+    "Lay's chips packet",
+    "Lay's logo on yellow bag",
+    "Lay's red and yellow bag",
+    "Lay's Classic potato chips",
+    "Lay's chips bag with logo"
+]
+DETECTOR_PROMPTS = [
+    "Lay's chips bag",
+    "Lays chips packet",
+    "Lay's potato chips",
+    "Lay's logo",
+    "Lays snack bag",
+    "Lay's chip packet",
+    "Lays potato chips bag"
+]
+OCR_KEYWORDS = ["lay's", "lays", "lay", "classic", "chips", "potato"]
+
+DEFAULT_SWEEP = {
+    "prompt_sets": {"multi_model": MULTI_MODEL_PROMPTS, "detector": DETECTOR_PROMPTS},
+    "thresholds": [0.05, 0.1, 0.15, 0.2, 0.3],
+    "nms_iou": [0.3, 0.5],
+    "ocr_keywords": [None]
+}
+
+
+def load_coco(path, images_dir=None):
+    """Return [(image_id, file path, (N, 4) xyxy ground-truth boxes)] from a COCO file."""
+    with open(path) as f:
+        coco = json.load(f)
+    images_dir = Path(images_dir) if images_dir else Path(path).parent
+
+    boxes = {image["id"]: [] for image in coco["images"]}
+    for annotation in coco["annotations"]:
+        if annotation.get("iscrowd"):
+            continue
+        x, y, w, h = annotation["bbox"]
+        boxes[annotation["image_id"]].append([x, y, x + w, y + h])
+
+    return [(image["id"], images_dir / image["file_name"], np.array(boxes[image["id"]], dtype=np.float32).reshape(-1, 4))
+            for image in coco["images"]]
+
+
+def box_iou(boxes, others):
+    """Pairwise IoU of two (N, 4) and (M, 4) xyxy arrays."""
+    if len(boxes) == 0 or len(others) == 0:
+        return np.zeros((len(boxes), len(others)), dtype=np.float32)
+    top_left = np.maximum(boxes[:, None, :2], others[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], others[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area = (boxes[:, 2:] - boxes[:, :2]).clip(0).prod(axis=1)
+    other_area = (others[:, 2:] - others[:, :2]).clip(0).prod(axis=1)
+    return intersection / np.maximum(area[:, None] + other_area[None] - intersection, 1e-9)
+
+
+def match_detections(boxes, scores, ground_truth):
+    """(num_detections, num_iou_thresholds) true-positive flags, COCO-style greedy matching."""
+    order = np.argsort(-scores)
+    ious = box_iou(boxes[order], ground_truth)
+    matched = np.zeros((len(order), len(IOU_THRESHOLDS)), dtype=bool)
+    for t, iou_threshold in enumerate(IOU_THRESHOLDS):
+        taken = np.zeros(len(ground_truth), dtype=bool)
+        for d in range(len(order)):
+            candidates = np.where(~taken & (ious[d] >= iou_threshold), ious[d], -1)
+            if len(candidates) and candidates.max() >= 0:
+                taken[candidates.argmax()] = True
+                matched[d, t] = True
+    result = np.zeros_like(matched)
+    result[order] = matched
+    return result
+
+
+def average_precision(scores, matched, num_ground_truth):
+    """101-point interpolated AP for each IoU threshold column of matched."""
+    if num_ground_truth == 0:
+        return np.zeros(matched.shape[1])
+    order = np.argsort(-scores, kind="stable")
+    true_positives = np.cumsum(matched[order], axis=0)
+    false_positives = np.cumsum(~matched[order], axis=0)
+    recall = true_positives / num_ground_truth
+    precision = true_positives / np.maximum(true_positives + false_positives, 1)
+
+    # Precision envelope, then sample it at 101 recall points
+    precision = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+    points = np.linspace(0, 1, 101)
+    ap = np.zeros(matched.shape[1])
+    for t in range(matched.shape[1]):
+        index = np.searchsorted(recall[:, t], points, side="left")
+        valid = index < len(recall)
+        ap[t] = precision[index[valid], t].sum() / len(points)
+    return ap
+
+
+def score_config(per_image, ground_truth):
+    """AP@0.5, mAP@[0.5:0.95], precision and recall over per-image (boxes, scores)."""
+    all_scores, all_matched = [], []
+    num_ground_truth = 0
+    for (boxes, scores), gt in zip(per_image, ground_truth):
+        num_ground_truth += len(gt)
+        if len(scores):
+            all_scores.append(scores)
+            all_matched.append(match_detections(boxes, scores, gt))
+
+    if not all_scores:
+        return {"ap50": 0.0, "map": 0.0, "precision": None, "recall": 0.0}
+    scores = np.concatenate(all_scores)
+    matched = np.concatenate(all_matched)
+    ap = average_precision(scores, matched, num_ground_truth)
+    true_positives = int(matched[:, 0].sum())
+    return {
+        "ap50": round(float(ap[0]), 4),
+        "map": round(float(ap.mean()), 4),
+        "precision": round(true_positives / len(scores), 4),
+        "recall": round(true_positives / num_ground_truth, 4) if num_ground_truth else None
+    }
+
+
+def pareto_frontier(results, accuracy="ap50", cost="latency_ms"):
+    """Configurations not beaten on both accuracy (higher) and cost (lower), cheapest first."""
+    frontier = []
+    best = -1.0
+    for result in sorted(results, key=lambda r: (r[cost], -r[accuracy])):
+        if result[accuracy] > best:
+            frontier.append(result)
+            best = result[accuracy]
+    return frontier
+
+
+class OwlViTProfile:
+    """Caches per-prompt OWL-ViT logits and boxes per photo, then replays post-processing."""
+
+    def __init__(self, model_name, prompt_sets, cache_dir, timing_images=5):
+        self.model_name = model_name
+        self.prompt_sets = prompt_sets
+        self.prompts = sorted({prompt for prompts in prompt_sets.values() for prompt in prompts})
+        key = hashlib.sha1(json.dumps([model_name, self.prompts]).encode()).hexdigest()[:12]
+        self.cache_dir = Path(cache_dir) / f"owlvit-{key}"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.timing_images = timing_images
+        self._model = None
+        self._ocr = None
+        self._ocr_cache_path = self.cache_dir / "ocr.jsonl"
+        self._ocr_cache = self._read_ocr_cache()
+
+    def _load_model(self):
+        if self._model is None:
+            from model_bundle import load_owlvit
+            from owlvit_preprocessing import OwlViTPreprocessor
+            from owlvit_runtime import runtime_from_env
+
+            processor, model = load_owlvit(self.model_name)
+            device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+            model.to(device)
+            self._model = (OwlViTPreprocessor(processor), runtime_from_env(model, self.model_name, device), device)
+        return self._model
+
+    def _infer(self, image, prompts):
+        preprocessor, runtime, device = self._load_model()
+        inputs = preprocessor(text=prompts, images=image, device=device)
+        start = time.perf_counter()
+        outputs = runtime(**inputs)
+        logits = outputs.logits[0].float().cpu()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        return logits, outputs.pred_boxes[0].float().cpu(), elapsed_ms
+
+    def cache(self, samples):
+        """Run the model over photos missing from the cache; returns how many were inferred."""
+        inferred = 0
+        for image_id, path, _ in samples:
+            cache_path = self.cache_dir / f"{image_id}.npz"
+            if cache_path.exists():
+                continue
+            image = Image.open(path).convert("RGB")
+            logits, boxes, elapsed_ms = self._infer(image, self.prompts)
+            np.savez(cache_path, logits=logits.numpy().astype(np.float16), boxes=boxes.numpy(),
+                     size=np.array(image.size), model_ms=elapsed_ms)
+            inferred += 1
+            print(f"🔎 {path.name}: {elapsed_ms:.0f} ms")
+        return inferred
+
+    def model_latency(self, samples):
+        """Median model milliseconds per photo for each prompt set, measured on a few photos."""
+        timing_path = self.cache_dir / "timing.json"
+        timings = json.loads(timing_path.read_text()) if timing_path.exists() else {}
+        for name, prompts in self.prompt_sets.items():
+            if name in timings:
+                continue
+            elapsed = []
+            for _, path, _ in samples[:self.timing_images]:
+                image = Image.open(path).convert("RGB")
+                self._infer(image, prompts)  # Warm up this prompt set's tokenization and graph
+                elapsed.append(self._infer(image, prompts)[2])
+            timings[name] = float(np.median(elapsed))
+        timing_path.write_text(json.dumps(timings))
+        return timings
+
+    def _read_ocr_cache(self):
+        if not self._ocr_cache_path.exists():
+            return {}
+        with open(self._ocr_cache_path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        return {(entry["image_id"], tuple(entry["box"])): entry for entry in entries}
+
+    def ocr_text(self, image_id, path, box):
+        """OCR text and milliseconds for an integer box, cached across sweeps."""
+        key = (image_id, tuple(int(v) for v in box))
+        entry = self._ocr_cache.get(key)
+        if entry is None:
+            if self._ocr is None:
+                from paddleocr import PaddleOCR
+                from model_bundle import paddleocr_kwargs
+                self._ocr = PaddleOCR(use_textline_orientation=True, lang='en', **paddleocr_kwargs())
+            x1, y1, x2, y2 = key[1]
+            start = time.perf_counter()
+            text = ""
+            if x2 > x1 and y2 > y1:
+                result = self._ocr.ocr(np.array(Image.open(path).convert("RGB").crop(key[1])), cls=True)
+                if result and result[0]:
+                    text = " ".join(line[1][0] for line in result[0] if line and len(line) >= 2)
+            entry = {"image_id": image_id, "box": list(key[1]), "text": text,
+                     "ms": (time.perf_counter() - start) * 1000}
+            self._ocr_cache[key] = entry
+            with open(self._ocr_cache_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        return entry["text"], entry["ms"]
+
+    def sweep(self, samples, sweep, top_k=DEFAULT_TOP_K):
+        """Score every configuration of the sweep against the cached outputs."""
+        from multi_model_app import non_maximum_suppression
+
+        cached = []
+        for image_id, _, _ in samples:
+            with np.load(self.cache_dir / f"{image_id}.npz") as data:
+                cached.append((torch.from_numpy(data["logits"].astype(np.float32)),
+                               torch.from_numpy(data["boxes"]), tuple(int(v) for v in data["size"])))
+        model_ms = self.model_latency(samples)
+        ground_truth = [gt for _, _, gt in samples]
+
+        results = []
+        for (name, prompts), threshold, nms_iou, keywords in itertools.product(
+                self.prompt_sets.items(), sweep["thresholds"], sweep["nms_iou"], sweep["ocr_keywords"]):
+            columns = [self.prompts.index(prompt) for prompt in prompts]
+            per_image = []
+            post_ms = ocr_ms = 0.0
+            for (image_id, path, _), (logits, boxes, (width, height)) in zip(samples, cached):
+                start = time.perf_counter()
+                indices, scores, _ = select_candidates(logits[:, columns], threshold, top_k)
+                scale = torch.tensor([width, height, width, height], dtype=boxes.dtype)
+                corners = (center_to_corners(boxes[indices]) * scale).tolist()
+                detections = non_maximum_suppression(
+                    [{"box": box, "score": score} for box, score in zip(corners, scores.tolist())], nms_iou)
+                post_ms += (time.perf_counter() - start) * 1000
+
+                if keywords is not None:
+                    kept = []
+                    for detection in detections:
+                        text, elapsed = self.ocr_text(image_id, path, detection["box"])
+                        ocr_ms += elapsed
+                        if any(keyword in text.lower() for keyword in keywords):
+                            kept.append(detection)
+                    detections = kept
+
+                per_image.append((np.array([d["box"] for d in detections], dtype=np.float32).reshape(-1, 4),
+                                  np.array([d["score"] for d in detections], dtype=np.float32)))
+
+            latency_ms = model_ms[name] + (post_ms + ocr_ms) / len(samples)
+            result = {
+                "prompts": name,
+                "threshold": threshold,
+                "nms_iou": nms_iou,
+                "ocr_keywords": keywords,
+                "latency_ms": round(latency_ms, 2),
+                "images_per_sec": round(1000 / latency_ms, 2)
+            }
+            result.update(score_config(per_image, ground_truth))
+            results.append(result)
+        return results
+
+
+class StudentProfile:
+    """Caches low-threshold student detections per photo and sweeps the confidence threshold."""
+
+    CACHE_THRESHOLD = 0.01
+
+    def __init__(self, weights, cache_dir):
+        from compact_detector import StudentDetector
+
+        self.detector = StudentDetector.load(weights)
+        key = hashlib.sha1(Path(weights).read_bytes()).hexdigest()[:12]
+        self.cache_path = Path(cache_dir) / f"student-{key}.json"
+        self.cached = json.loads(self.cache_path.read_text()) if self.cache_path.exists() else {}
+
+    def cache(self, samples):
+        inferred = 0
+        for image_id, path, _ in samples:
+            if str(image_id) in self.cached:
+                continue
+            image = Image.open(path).convert("RGB")
+            start = time.perf_counter()
+            detections = self.detector.detect(image, self.CACHE_THRESHOLD)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.cached[str(image_id)] = {"detections": detections, "model_ms": elapsed_ms}
+            inferred += 1
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.cache_path.write_text(json.dumps(self.cached))
+        return inferred
+
+    def sweep(self, samples, sweep, top_k=None):
+        ground_truth = [gt for _, _, gt in samples]
+        latency_ms = float(np.median([self.cached[str(image_id)]["model_ms"] for image_id, _, _ in samples]))
+        results = []
+        for threshold in sweep["thresholds"]:
+            per_image = []
+            for image_id, _, _ in samples:
+                detections = [d for d in self.cached[str(image_id)]["detections"] if d["score"] > threshold]
+                per_image.append((np.array([d["box"] for d in detections], dtype=np.float32).reshape(-1, 4),
+                                  np.array([d["score"] for d in detections], dtype=np.float32)))
+            result = {"prompts": "student", "threshold": threshold, "nms_iou": None, "ocr_keywords": None,
+                      "latency_ms": round(latency_ms, 2), "images_per_sec": round(1000 / latency_ms, 2)}
+            result.update(score_config(per_image, ground_truth))
+            results.append(result)
+        return results
+
+
+def main():
+    """Evaluate a pipeline profile over a COCO-format set and sweep its settings."""
+    parser = argparse.ArgumentParser(description="Accuracy/throughput evaluation over a labelled set")
+    parser.add_argument("labels", help="COCO-format annotation file")
+    parser.add_argument("--images", "-i", help="Image folder (default: the annotation file's folder)")
+    parser.add_argument("--profile", "-p", choices=["owlvit", "student"], default="owlvit",
+                       help="Pipeline to evaluate (default: owlvit)")
+    parser.add_argument("--model", "-m", default="google/owlvit-base-patch32",
+                       help="OWL-ViT model name (default: google/owlvit-base-patch32)")
+    parser.add_argument("--student", help="Distilled detector weights for the student profile")
+    parser.add_argument("--sweep", "-s", help="Sweep configuration JSON (default: built-in sweep)")
+    parser.add_argument("--cache-dir", default=".eval_cache", help="Model output cache (default: .eval_cache)")
+    parser.add_argument("--top-k", "-k", type=int, default=DEFAULT_TOP_K,
+                       help=f"Maximum candidates kept per prompt (default: {DEFAULT_TOP_K})")
+    parser.add_argument("--output", "-o", help="Write every configuration and the Pareto frontier as JSON")
+    args = parser.parse_args()
+
+    try:
+        sweep = dict(DEFAULT_SWEEP)
+        if args.sweep:
+            with open(args.sweep) as f:
+                sweep.update(json.load(f))
+
+        samples = load_coco(args.labels, args.images)
+        if not samples:
+            raise ValueError(f"No images in {args.labels}")
+
+        if args.profile == "student":
+            if not args.student:
+                raise ValueError("The student profile needs --student weights")
+            profile = StudentProfile(args.student, args.cache_dir)
+        else:
+            profile = OwlViTProfile(args.model, sweep["prompt_sets"], args.cache_dir)
+
+        inferred = profile.cache(samples)
+        print(f"📦 {len(samples)} photo(s), {inferred} newly inferred, {len(samples) - inferred} from cache")
+
+        results = profile.sweep(samples, sweep, args.top_k)
+        frontier = pareto_frontier(results)
+
+        print(f"\n📊 {len(results)} configuration(s); Pareto frontier (AP@0.5 vs latency):")
+        for result in frontier:
+            print(f"   {result['prompts']:<12} thr {result['threshold']:<5} nms {str(result['nms_iou']):<5} "
+                  f"ocr {'on' if result['ocr_keywords'] else 'off':<3}  AP50 {result['ap50']:.3f}  "
+                  f"mAP {result['map']:.3f}  P {result['precision']}  R {result['recall']}  "
+                  f"{result['latency_ms']:.0f} ms ({result['images_per_sec']} img/s)")
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump({"profile": args.profile, "photos": len(samples), "results": results,
+                           "pareto": frontier}, f, indent=2)
+            print(f"✅ Report saved to: {args.output}")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Bulk GPS + image validation of shop visits
+
+A vectorized counterpart of backend/utils/gpsValidation.js for re-validating
+whole regions after a radius policy change. Visits are flattened into NumPy
+arrays (one row per visit, NaN for a missing location), and the haversine
+distance from the shop to the startAudit, photoClick and proceedClick
+locations is computed for all visits at once. The validity rules are the
+ones `validateVisitGPS` applies:
+
+- a location is valid when it is within the radius (30 m, or the shop's own
+  `gps_radius` / a per-shop override file);
+- all available locations valid -> valid; none valid -> invalid; otherwise
+  partial, which still counts as valid when at least two are valid;
+- no shop coordinates or no visit locations -> no_data.
+
+Each visit's GPS result is then joined with its image verdict (the stored
+`aiDetection.laysDetected`, or the results store when --results-db is given)
+into one of: verified, gps_only, image_only, failed, no_gps.
+
+Usage:
+    mongoexport --db shops --collection shops --out shops.json
+    python gps_validation.py shops.json --radius 30 --output gps_results.jsonl
+    python gps_validation.py shops.json --radius-file radii.csv --results-db results.db
+
+The output has one line per shop: {"shopId": ..., "gpsValidationResults": [...]},
+which is the body the /save-gps-validation/:shopId route accepts.
+"""
+
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000
+DEFAULT_RADIUS_M = 30
+LOCATIONS = ("startAudit", "photoClick", "proceedClick")
+STATUSES = np.array(["no_data", "valid", "invalid", "partial"])
+VERDICTS = np.array(["no_gps", "verified", "gps_only", "image_only", "failed"])
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Distance in meters between arrays of points, rounded to centimetres like the backend."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    distance = EARTH_RADIUS_M * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return np.round(distance, 2)
+
+
+def validate(shop_lat, shop_lon, locations, radius=DEFAULT_RADIUS_M):
+    """Validate arrays of visits.
+
+    `locations` maps each name in LOCATIONS to a (lat, lon) pair of arrays with
+    NaN where the visit has no location; `radius` is a scalar or per-visit
+    array. Returns a dict of arrays: <name>_distance (NaN if missing),
+    <name>_valid, valid_count, status (index into STATUSES) and is_valid.
+    """
+    shop_lat = np.asarray(shop_lat, dtype=np.float64)
+    shop_lon = np.asarray(shop_lon, dtype=np.float64)
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), shop_lat.shape)
+    has_shop = ~(np.isnan(shop_lat) | np.isnan(shop_lon))
+
+    result = {}
+    valid_count = np.zeros(shop_lat.shape, dtype=np.int8)
+    total_count = np.zeros(shop_lat.shape, dtype=np.int8)
+    with np.errstate(invalid="ignore"):
+        for name in LOCATIONS:
+            lat, lon = locations[name]
+            distance = haversine(shop_lat, shop_lon, lat, lon)
+            distance[~has_shop] = np.nan
+            valid = distance <= radius  # NaN compares False
+            result[f"{name}_distance"] = distance
+            result[f"{name}_valid"] = valid
+            valid_count += valid
+            total_count += ~np.isnan(distance)
+
+    status = np.select(
+        [total_count == 0, valid_count == total_count, valid_count == 0],
+        [0, 1, 2],
+        default=3
+    ).astype(np.int8)
+    result["valid_count"] = valid_count
+    result["status"] = status
+    result["is_valid"] = (status == 1) | ((status == 3) & (valid_count >= 2))
+    return result
+
+
+def join_verdict(is_valid, status, lays_detected):
+    """Combine GPS validity with the image verdict; returns indexes into VERDICTS."""
+    lays_detected = np.asarray(lays_detected, dtype=bool)
+    return np.select(
+        [status == 0, is_valid & lays_detected, is_valid, lays_detected],
+        [0, 1, 2, 3],
+        default=4
+    ).astype(np.int8)
+
+
+class VisitTable:
+    """Visits flattened into column arrays, one row per (shop, visit)."""
+
+    def __init__(self, shop_ids, visit_index, visit_ids, shop_lat, shop_lon, radius, locations, lays_detected):
+        self.shop_ids = shop_ids
+        self.visit_index = visit_index
+        self.visit_ids = visit_ids
+        self.shop_lat = shop_lat
+        self.shop_lon = shop_lon
+        self.radius = radius
+        self.locations = locations
+        self.lays_detected = lays_detected
+
+    def __len__(self):
+        return len(self.shop_ids)
+
+    @classmethod
+    def from_shops(cls, shops, default_radius=DEFAULT_RADIUS_M, radius_overrides=None):
+        """Flatten shop documents (as exported from Mongo) into a table."""
+        radius_overrides = radius_overrides or {}
+        shop_ids, visit_index, visit_ids, shop_coords, radius, lays = [], [], [], [], [], []
+        coords = {name: [] for name in LOCATIONS}
+
+        for shop in shops:
+            shop_id = _oid(shop.get("_id"))
+            shop_radius = radius_overrides.get(shop_id, shop.get("gps_radius") or default_radius)
+            shop_point = (_number(shop.get("gps_n")), _number(shop.get("gps_e")))
+            for i, visit in enumerate(shop.get("visitImages") or []):
+                shop_ids.append(shop_id)
+                visit_index.append(i)
+                visit_ids.append(_oid(visit.get("_id")))
+                shop_coords.append(shop_point)
+                radius.append(shop_radius)
+                lays.append(bool((visit.get("aiDetection") or {}).get("laysDetected")))
+                location = visit.get("visitLocation") or {}
+                for name in LOCATIONS:
+                    point = location.get(name) or {}
+                    coords[name].append((_number(point.get("latitude")), _number(point.get("longitude"))))
+
+        shop_coords = np.array(shop_coords, dtype=np.float64).reshape(-1, 2)
+        locations = {}
+        for name in LOCATIONS:
+            points = np.array(coords[name], dtype=np.float64).reshape(-1, 2)
+            locations[name] = (points[:, 0], points[:, 1])
+        return cls(shop_ids, np.array(visit_index), visit_ids, shop_coords[:, 0], shop_coords[:, 1],
+                   np.array(radius, dtype=np.float64), locations, np.array(lays, dtype=bool))
+
+    def image_verdicts_from_results(self, path):
+        """Replace the stored image verdicts with the results store's, matched on visit_id."""
+        connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        detected = dict(connection.execute(
+            "SELECT visit_id, MAX(detected) FROM images WHERE visit_id IS NOT NULL GROUP BY visit_id"
+        ))
+        connection.close()
+        self.lays_detected = np.array([bool(detected.get(visit_id, stored))
+                                       for visit_id, stored in zip(self.visit_ids, self.lays_detected)])
+
+    def validate(self):
+        result = validate(self.shop_lat, self.shop_lon, self.locations, self.radius)
+        result["verdict"] = join_verdict(result["is_valid"], result["status"], self.lays_detected)
+        return result
+
+
+def _number(value):
+    # mongoexport writes numbers as plain JSON or as {"$numberDouble": "..."} in canonical mode
+    if isinstance(value, dict):
+        value = next(iter(value.values()), None)
+    try:
+        return float(value) if value is not None else np.nan
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _oid(value):
+    if isinstance(value, dict):
+        return value.get("$oid")
+    return str(value) if value is not None else None
+
+
+def _distance(value):
+    return None if np.isnan(value) else float(value)
+
+
+def to_backend_results(table, result):
+    """Yield (shop_id, gpsValidationResults) in the shape saveGPSValidationResults stores."""
+    validated_at = datetime.now(timezone.utc).isoformat()
+    start = 0
+    while start < len(table):
+        shop_id = table.shop_ids[start]
+        end = start
+        while end < len(table) and table.shop_ids[end] == shop_id:
+            end += 1
+
+        visits = []
+        for i in range(start, end):
+            has_shop = not np.isnan(table.shop_lat[i])
+            visits.append({
+                "visitIndex": int(table.visit_index[i]),
+                "verdict": str(VERDICTS[result["verdict"][i]]),
+                "laysDetected": bool(table.lays_detected[i]),
+                "calculatedGPSValidation": {
+                    "isValid": bool(result["is_valid"][i]),
+                    "validationStatus": str(STATUSES[result["status"][i]]),
+                    **{f"{name}Distance": _distance(result[f"{name}_distance"][i]) for name in LOCATIONS},
+                    "shopCoordinates": ({"latitude": float(table.shop_lat[i]), "longitude": float(table.shop_lon[i])}
+                                        if has_shop else None),
+                    "validationDetails": {f"{name}Valid": bool(result[f"{name}_valid"][i]) for name in LOCATIONS},
+                    "radiusThreshold": float(table.radius[i]),
+                    "validatedAt": validated_at
+                }
+            })
+        yield shop_id, visits
+        start = end
+
+
+def summarize(result):
+    """Counts per status and verdict, plus the mean distance like getGPSValidationSummary."""
+    distances = np.stack([result[f"{name}_distance"] for name in LOCATIONS], axis=1)
+    with_gps = result["status"] != 0
+    with np.errstate(invalid="ignore"):
+        mean_distance = np.nanmean(distances[with_gps], axis=1).mean() if with_gps.any() else 0.0
+    valid = int((result["is_valid"] & with_gps).sum())
+    return {
+        "totalVisits": int(len(result["status"])),
+        "visitsWithGPS": int(with_gps.sum()),
+        "validVisits": valid,
+        "invalidVisits": int((result["status"] == 2).sum()),
+        "partialVisits": int((result["status"] == 3).sum()),
+        "noDataVisits": int((~with_gps).sum()),
+        "averageDistance": round(float(mean_distance), 2),
+        "validationRate": round(100 * valid / with_gps.sum()) if with_gps.any() else 0,
+        "verdicts": {str(verdict): int((result["verdict"] == i).sum()) for i, verdict in enumerate(VERDICTS)}
+    }
+
+
+def load_shops(path):
+    """Read shop documents from a JSON array or a JSON-lines (mongoexport) file."""
+    with open(path) as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == "[":
+            return json.load(f)
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_radius_overrides(path):
+    """Read shop_id,radius rows into a dict."""
+    with open(path, newline="") as f:
+        return {row[0]: float(row[1]) for row in csv.reader(f) if row and not row[0].startswith("#")
+                and row[0] != "shop_id"}
+
+
+def main():
+    """Re-validate every visit in a shop export against a radius policy."""
+    parser = argparse.ArgumentParser(description="Bulk GPS + image validation of shop visits")
+    parser.add_argument("shops", help="Shop export (JSON array or JSON lines)")
+    parser.add_argument("--radius", type=float, default=DEFAULT_RADIUS_M,
+                       help=f"Radius in meters for shops without their own (default: {DEFAULT_RADIUS_M})")
+    parser.add_argument("--radius-file", help="CSV of shop_id,radius overrides")
+    parser.add_argument("--results-db", help="Results store to take image verdicts from (matched on visit id)")
+    parser.add_argument("--output", "-o", help="Write per-shop results as JSON lines")
+    args = parser.parse_args()
+
+    try:
+        start = time.perf_counter()
+        shops = load_shops(args.shops)
+        overrides = load_radius_overrides(args.radius_file) if args.radius_file else None
+        table = VisitTable.from_shops(shops, args.radius, overrides)
+        if args.results_db:
+            table.image_verdicts_from_results(args.results_db)
+        loaded = time.perf_counter()
+
+        result = table.validate()
+        validated = time.perf_counter()
+        print(f"📍 {len(table)} visit(s) from {len(shops)} shop(s): loaded in {loaded - start:.2f}s, "
+              f"validated in {(validated - loaded) * 1000:.1f} ms")
+
+        if args.output:
+            with open(args.output, "w") as f:
+                for shop_id, visits in to_backend_results(table, result):
+                    f.write(json.dumps({"shopId": shop_id, "gpsValidationResults": visits}) + "\n")
+            print(f"💾 Results saved to: {args.output}")
+
+        print(json.dumps(summarize(result), indent=2))
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+In-memory Grounding DINO adapter
+
+`groundingdino.util.inference` is built around files: `load_image` opens a
+path with PIL and runs a torchvision transform, and `predict` re-tokenizes
+the caption and runs BERT over it for every image. For a service that
+already has the decoded frame and always asks the same caption, this adapter:
+
+- preprocesses straight from the RGB frame: one OpenCV resize to the
+  800 px short side (1333 px cap) used by `load_image`, then normalization as
+  a tensor op on the model's device;
+- caches the caption's text encoding: the model's BERT module is wrapped so
+  that the same token ids, masks and position ids return the cached output
+  instead of re-running the text encoder, and the tokenized caption used for
+  phrase lookup is computed once;
+- predicts several frames in one padded forward (`nested_tensor_from_tensor_list`
+  masks the padding, and the boxes stay relative to each unpadded frame);
+- returns pixel xyxy boxes in the frame's coordinates, like the OWL-ViT path,
+  instead of normalized cxcywh.
+"""
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from torch import nn
+
+DINO_CAPTION = "Lay's chips bag . Lay's logo . Lay's potato chips . Lay's snack bag"
+SHORT_SIDE = 800
+MAX_SIDE = 1333
+MAX_BATCH_SIZE = 4
+TEXT_CACHE_SIZE = 8
+
+_MEAN = (0.485, 0.456, 0.406)
+_STD = (0.229, 0.224, 0.225)
+
+
+def preprocess_caption(caption):
+    """Lower-case and terminate the caption with '.', as groundingdino's predict() does."""
+    caption = caption.lower().strip()
+    return caption if caption.endswith(".") else caption + "."
+
+
+def resized_shape(width, height, size=SHORT_SIDE, max_size=MAX_SIDE):
+    """(height, width) after groundingdino's RandomResize([size], max_size)."""
+    short, long = float(min(width, height)), float(max(width, height))
+    if long / short * size > max_size:
+        size = int(round(max_size * short / long))
+    if (width <= height and width == size) or (height <= width and height == size):
+        return height, width
+    if width < height:
+        return int(size * height / width), size
+    return size, int(size * width / height)
+
+
+class CachedTextEncoder(nn.Module):
+    """Wraps the model's BERT module and memoizes its output per distinct input."""
+
+    def __init__(self, encoder, max_entries=TEXT_CACHE_SIZE):
+        super().__init__()
+        self.encoder = encoder
+        self.max_entries = max_entries
+        self._cache = {}
+
+    def forward(self, **inputs):
+        key = tuple((name, tuple(value.shape), value.detach().cpu().numpy().tobytes())
+                    for name, value in sorted(inputs.items()) if isinstance(value, torch.Tensor))
+        output = self._cache.get(key)
+        if output is None:
+            output = self.encoder(**inputs)
+            if len(self._cache) >= self.max_entries:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[key] = output
+        return output
+
+
+class GroundingDinoAdapter:
+    """Batched, in-memory Grounding DINO prediction for one fixed caption."""
+
+    def __init__(self, model, device, caption=DINO_CAPTION, max_batch_size=MAX_BATCH_SIZE):
+        self.model = model.to(device).eval()
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.caption = preprocess_caption(caption)
+        if not isinstance(self.model.bert, CachedTextEncoder):
+            self.model.bert = CachedTextEncoder(self.model.bert)
+        self._tokenized = self.model.tokenizer(self.caption)
+        self._mean = torch.tensor(_MEAN, device=device).view(3, 1, 1)
+        self._std = torch.tensor(_STD, device=device).view(3, 1, 1)
+
+    def preprocess(self, image):
+        """Normalized 3xHxW tensor on the model device from a PIL image or RGB array."""
+        frame = np.asarray(image)
+        height, width = resized_shape(frame.shape[1], frame.shape[0])
+        interpolation = cv2.INTER_AREA if height < frame.shape[0] else cv2.INTER_LINEAR
+        frame = cv2.resize(frame, (width, height), interpolation=interpolation)
+        tensor = torch.from_numpy(frame).to(self.device).permute(2, 0, 1).float().div_(255)
+        return (tensor - self._mean) / self._std
+
+    def predict_batch(self, images, box_threshold=0.1, text_threshold=0.25):
+        """Detections per image as lists of dicts with pixel xyxy boxes, score and matched phrase."""
+        from groundingdino.util.misc import nested_tensor_from_tensor_list
+        from groundingdino.util.utils import get_phrases_from_posmap
+
+        results = []
+        for start in range(0, len(images), self.max_batch_size):
+            chunk = images[start:start + self.max_batch_size]
+            samples = nested_tensor_from_tensor_list([self.preprocess(image) for image in chunk])
+            with torch.no_grad():
+                outputs = self.model(samples, captions=[self.caption] * len(chunk))
+            logits = outputs["pred_logits"].sigmoid().cpu()
+            boxes = outputs["pred_boxes"].cpu()
+
+            for image, image_logits, image_boxes in zip(chunk, logits, boxes):
+                width, height = image.size if isinstance(image, Image.Image) else (image.shape[1], image.shape[0])
+                scores = image_logits.max(dim=1).values
+                keep = scores > box_threshold
+                detections = []
+                for logit, score, (cx, cy, w, h) in zip(image_logits[keep], scores[keep], image_boxes[keep].tolist()):
+                    phrase = get_phrases_from_posmap(logit > text_threshold, self._tokenized,
+                                                     self.model.tokenizer).replace('.', '')
+                    detections.append({
+                        "box": [(cx - w / 2) * width, (cy - h / 2) * height, (cx + w / 2) * width, (cy + h / 2) * height],
+                        "score": float(score),
+                        "phrase": phrase.strip()
+                    })
+                results.append(detections)
+        return results
+
+    def predict(self, image, box_threshold=0.1, text_threshold=0.25):
+        return self.predict_batch([image], box_threshold, text_threshold)[0]
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Pooled image fetcher with a content-addressed disk cache
+
+All URL inputs (Cloudinary shelf photos, CLI URLs) go through one
+ImageFetcher: a requests session with a bounded connection pool and urllib3
+retries with backoff, a thread pool that caps concurrent downloads, and
+de-duplication of in-flight requests for the same URL. Downloaded bytes are
+stored once under their SHA-256 (objects/ab/abcd...) with a small per-URL
+pointer file, and the least recently used objects are evicted when the
+cache grows past its size limit. Bodies are streamed and a response larger
+than MAX_IMAGE_MB (default 16) is abandoned with ImageTooLarge, so a URL
+cannot bring in more than an upload could.
+
+Batch jobs can warm the cache ahead of inference with prefetch(), or from
+the command line:
+
+    python image_fetcher.py urls.txt --cache-dir .image_cache
+"""
+
+import argparse
+import hashlib
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_MAX_CACHE_MB = 1024
+DEFAULT_CONCURRENCY = 8
+DEFAULT_MAX_IMAGE_MB = 16
+
+logger = logging.getLogger(__name__)
+
+
+class ImageTooLarge(Exception):
+    """Raised when a response body exceeds the fetcher's byte limit."""
+
+
+class ImageFetcher:
+    """Bounded-concurrency, retrying HTTP fetcher backed by an optional LRU disk cache."""
+
+    def __init__(self, cache_dir=None, max_cache_bytes=DEFAULT_MAX_CACHE_MB * 1024 * 1024,
+                 max_concurrency=DEFAULT_CONCURRENCY, retries=3, backoff=0.5, timeout=10,
+                 max_bytes=DEFAULT_MAX_IMAGE_MB * 1024 * 1024):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=max_concurrency, pool_maxsize=max_concurrency, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="fetch")
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_cache_bytes = max_cache_bytes
+        self._cache_bytes = 0
+        if self.cache_dir:
+            (self.cache_dir / "objects").mkdir(parents=True, exist_ok=True)
+            (self.cache_dir / "urls").mkdir(parents=True, exist_ok=True)
+            self._cache_bytes = sum(p.stat().st_size for p in self._objects())
+
+    def _url_path(self, url):
+        return self.cache_dir / "urls" / hashlib.sha1(url.encode()).hexdigest()
+
+    def _object_path(self, digest):
+        return self.cache_dir / "objects" / digest[:2] / digest
+
+    def _objects(self):
+        """Stored objects, without the temp files of writes still in progress."""
+        return [p for p in (self.cache_dir / "objects").rglob("*") if p.is_file() and p.suffix != ".tmp"]
+
+    def _cached(self, url):
+        """Cached bytes for url, or None. A hit refreshes the object's LRU timestamp."""
+        if not self.cache_dir:
+            return None
+        try:
+            digest = self._url_path(url).read_text().strip()
+            path = self._object_path(digest)
+            data = path.read_bytes()
+            os.utime(path)
+        except (FileNotFoundError, OSError):
+            return None
+        return data
+
+    def _store(self, url, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        path.parent.mkdir(exist_ok=True)
+
+        # Identical content under different URLs is stored once
+        if not path.exists():
+            temp = path.with_suffix(f".{threading.get_ident()}.tmp")
+            temp.write_bytes(data)
+            with self._lock:
+                # Another thread may have stored the same content meanwhile; count it once
+                created = not path.exists()
+                os.replace(temp, path)
+                if created:
+                    self._cache_bytes += len(data)
+        self._url_path(url).write_text(digest)
+
+        if self._cache_bytes > self.max_cache_bytes:
+            self.evict()
+
+    def evict(self):
+        """Delete least recently used objects until the cache is under 90% of its limit."""
+        with self._lock:
+            objects = sorted(self._objects(), key=lambda p: p.stat().st_mtime)
+            target = self.max_cache_bytes * 0.9
+            for path in objects:
+                if self._cache_bytes <= target:
+                    break
+                try:
+                    size = path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                self._cache_bytes -= size
+        # Pointer files to evicted objects simply miss on the next read
+
+    def _download(self, url):
+        data = self._cached(url)
+        if data is not None:
+            return data
+        with self.session.get(url, timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            data = self._read_body(url, response)
+        if self.cache_dir:
+            try:
+                self._store(url, data)
+            except OSError as e:
+                # The download itself succeeded; only the next fetch of this URL misses
+                logger.warning(f"Image cache write failed for {url}: {e}")
+        return data
+
+    def _read_body(self, url, response):
+        """The response body, read no further than max_bytes."""
+        declared = response.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > self.max_bytes:
+            raise ImageTooLarge(f"{url} is {int(declared) // 2**20} MB, limit is {self.max_bytes // 2**20} MB")
+        body = bytearray()
+        for chunk in response.iter_content(1 << 16):
+            body += chunk
+            if len(body) > self.max_bytes:
+                raise ImageTooLarge(f"{url} exceeds the {self.max_bytes // 2**20} MB limit")
+        return bytes(body)
+
+    def submit(self, url):
+        """Start fetching url in the pool, sharing the future with concurrent callers."""
+        with self._lock:
+            future = self._in_flight.get(url)
+            if future is None:
+                future = self._pool.submit(self._download, url)
+                self._in_flight[url] = future
+                future.add_done_callback(lambda _: self._forget(url))
+        return future
+
+    def _forget(self, url):
+        with self._lock:
+            self._in_flight.pop(url, None)
+
+    def fetch(self, url):
+        """Return the bytes at url, from the cache when possible."""
+        data = self._cached(url)
+        return data if data is not None else self.submit(url).result()
+
+    def fetch_many(self, urls):
+        """Fetch several URLs concurrently, returning bytes (or the exception) in input order."""
+        futures = [self.submit(url) for url in urls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def prefetch(self, urls):
+        """Warm the cache for upcoming URLs without waiting for them."""
+        return [self.submit(url) for url in urls]
+
+    def load_image(self, url):
+        """Fetch url and decode it as an RGB PIL image."""
+        image = Image.open(io.BytesIO(self.fetch(url)))
+        return image.convert('RGB') if image.mode != 'RGB' else image
+
+
+_default_fetcher = None
+_default_lock = threading.Lock()
+
+
+def default_fetcher():
+    """Process-wide fetcher configured by IMAGE_CACHE_DIR / IMAGE_CACHE_MAX_MB / FETCH_CONCURRENCY / MAX_IMAGE_MB."""
+    global _default_fetcher
+    with _default_lock:
+        if _default_fetcher is None:
+            _default_fetcher = ImageFetcher(
+                cache_dir=os.environ.get("IMAGE_CACHE_DIR"),
+                max_cache_bytes=int(os.environ.get("IMAGE_CACHE_MAX_MB", DEFAULT_MAX_CACHE_MB)) * 1024 * 1024,
+                max_concurrency=int(os.environ.get("FETCH_CONCURRENCY", DEFAULT_CONCURRENCY)),
+                max_bytes=int(os.environ.get("MAX_IMAGE_MB", DEFAULT_MAX_IMAGE_MB)) * 1024 * 1024
+            )
+        return _default_fetcher
+
+
+def main():
+    """Prefetch a list of image URLs into the local cache."""
+    parser = argparse.ArgumentParser(description="Prefetch image URLs into the local cache")
+    parser.add_argument("urls", help="Text file with one URL per line")
+    parser.add_argument("--cache-dir", default=".image_cache", help="Cache directory (default: .image_cache)")
+    parser.add_argument("--max-cache-mb", type=int, default=DEFAULT_MAX_CACHE_MB,
+                       help=f"Cache size limit in MB (default: {DEFAULT_MAX_CACHE_MB})")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                       help=f"Concurrent downloads (default: {DEFAULT_CONCURRENCY})")
+    args = parser.parse_args()
+
+    try:
+        with open(args.urls) as f:
+            urls = [line.strip() for line in f if line.strip()]
+
+        fetcher = ImageFetcher(args.cache_dir, args.max_cache_mb * 1024 * 1024, args.concurrency)
+        start = time.perf_counter()
+        results = fetcher.fetch_many(urls)
+        elapsed = time.perf_counter() - start
+
+        failed = [(url, result) for url, result in zip(urls, results) if isinstance(result, Exception)]
+        for url, error in failed:
+            print(f"⚠️  {url}: {error}")
+        fetched = len(urls) - len(failed)
+        total_mb = sum(len(r) for r in results if not isinstance(r, Exception)) / 1024 / 1024
+        print(f"✅ {fetched}/{len(urls)} image(s), {total_mb:.1f} MB in {elapsed:.1f}s")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Weighted fair scheduling of model calls between interactive and bulk work
+
+Field audits and bulk jobs (nightly rescoring, revalidating a manager's
+region) share the same OWL-ViT model. Without a scheduler a large bulk job
+holds the model while live uploads time out behind it.
+
+Every model call acquires one of INFERENCE_SLOTS slots through the
+scheduler:
+
+- Priority classes: a free slot always goes to a waiting `interactive` call
+  before any `bulk` call. A request is bulk when it sends `priority=bulk`
+  (form field or query parameter, or the X-Priority header); everything
+  else is interactive.
+- Within a class, tenants (the `tenant` field or X-Tenant header, e.g. a
+  manager id) share slots by start-time fair queuing: each call is tagged
+  with a virtual finish time of start + images / weight, and the smallest
+  tag goes first, so a tenant with weight 2 gets twice the images of a
+  tenant with weight 1 while both are waiting. SCHEDULER_WEIGHTS sets the
+  weights as `tenant=weight,...` (default 1).
+- A slot is held for one model batch only, so a bulk request of many batches
+  is preempted between batches whenever interactive work is waiting.
+
+Queue wait (time from asking for a slot to getting it) is reported per class
+in /health. Enabled by INFERENCE_SLOTS.
+"""
+
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITY_CLASSES = (INTERACTIVE, BULK)  # Highest priority first
+DEFAULT_TENANT = "default"
+WAIT_SAMPLES = 1000
+
+_context = threading.local()
+
+
+class FairScheduler:
+    """Hands out model slots by priority class, then by weighted fair queuing across tenants."""
+
+    def __init__(self, slots=1, weights=None, classes=PRIORITY_CLASSES):
+        self.slots = slots
+        self.weights = weights or {}
+        self.classes = classes
+        self._condition = threading.Condition()
+        self._free = slots
+        self._queues = {name: [] for name in classes}
+        self._virtual_time = {name: 0.0 for name in classes}
+        self._last_finish = {}
+        self._sequence = itertools.count()
+        self._waits = {name: deque(maxlen=WAIT_SAMPLES) for name in classes}
+        self._dispatched = {name: 0 for name in classes}
+        self._images = {name: 0 for name in classes}
+
+    def _head(self):
+        for name in self.classes:
+            if self._queues[name]:
+                return self._queues[name][0]
+        return None
+
+    def acquire(self, priority=INTERACTIVE, tenant=DEFAULT_TENANT, cost=1):
+        """Block until this call may use the model; returns the queue wait in seconds."""
+        enqueued = time.monotonic()
+        with self._condition:
+            key = (priority, tenant)
+            start = max(self._virtual_time[priority], self._last_finish.get(key, 0.0))
+            finish = start + cost / self.weights.get(tenant, 1.0)
+            self._last_finish[key] = finish
+            entry = (finish, next(self._sequence), start)
+            heapq.heappush(self._queues[priority], entry)
+
+            while not (self._free > 0 and self._head() is entry):
+                self._condition.wait()
+            heapq.heappop(self._queues[priority])
+            self._free -= 1
+            self._virtual_time[priority] = start
+
+            waited = time.monotonic() - enqueued
+            self._waits[priority].append(waited)
+            self._dispatched[priority] += 1
+            self._images[priority] += cost
+            # Another slot may still be free for the next waiter
+            self._condition.notify_all()
+        return waited
+
+    def release(self):
+        with self._condition:
+            self._free += 1
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, cost=1):
+        """Hold a slot for one model batch of `cost` images, in the calling request's class and tenant."""
+        priority, tenant = getattr(_context, "request", None) or (INTERACTIVE, DEFAULT_TENANT)
+        self.acquire(priority, tenant, cost)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._condition:
+            classes = {}
+            for name in self.classes:
+                waits = np.array(self._waits[name]) * 1000
+                classes[name] = {
+                    "waiting": len(self._queues[name]),
+                    "dispatched": self._dispatched[name],
+                    "images": self._images[name],
+                    "wait_ms": {
+                        "p50": round(float(np.percentile(waits, 50)), 1),
+                        "p95": round(float(np.percentile(waits, 95)), 1),
+                        "max": round(float(waits.max()), 1)
+                    } if len(waits) else {}
+                }
+            return {"slots": self.slots, "busy": self.slots - self._free, "classes": classes}
+
+
+@contextmanager
+def inference_slot(scheduler, cost=1):
+    """scheduler.slot(cost), or nothing when no scheduler is configured."""
+    if scheduler is None:
+        yield
+        return
+    with scheduler.slot(cost):
+        yield
+
+
+def install_scheduler(app, scheduler):
+    """Tag each request of a Flask app with its priority class and tenant for the scheduler."""
+    from flask import jsonify, request
+
+    @app.before_request
+    def _set_priority():
+        priority = request.values.get("priority") or request.headers.get("X-Priority") or INTERACTIVE
+        if priority not in scheduler.classes:
+            return jsonify({"error": f"Unknown priority: {priority}"}), 400
+        tenant = request.values.get("tenant") or request.headers.get("X-Tenant") or DEFAULT_TENANT
+        _context.request = (priority, tenant)
+        return None
+
+    @app.teardown_request
+    def _clear_priority(_exc):
+        _context.request = None
+
+
+def parse_weights(spec):
+    """{'tenant': weight} from 'tenant=weight,...'."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        tenant, _, weight = item.partition("=")
+        weights[tenant.strip()] = float(weight)
+    return weights
+
+
+def scheduler_from_env():
+    """Scheduler configured by INFERENCE_SLOTS / SCHEDULER_WEIGHTS, or None if disabled."""
+    slots = os.environ.get("INFERENCE_SLOTS")
+    if not slots:
+        return None
+    return FairScheduler(int(slots), parse_weights(os.environ.get("SCHEDULER_WEIGHTS", "")))
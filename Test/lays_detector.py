@@ -6,28 +6,34 @@ This script detects Lay's chips/snacks in images using zero-shot object detectio
 """
 
 import argparse
+import hashlib
 import sys
 from pathlib import Path
 from typing import List, Tuple, Union
-import requests
 from PIL import Image, ImageDraw, ImageFont
 import torch
-from transformers import OwlViTProcessor, OwlViTForObjectDetection
 import numpy as np
 
+from compact_detector import StudentDetector
+from embedding_store import EmbeddingStore, image_side_tensors
+from image_fetcher import default_fetcher
+from model_bundle import load_owlvit
+from owlvit_postprocessing import DEFAULT_TOP_K, postprocess_detections
+from owlvit_preprocessing import OwlViTPreprocessor
+from owlvit_runtime import COMPILE_MODES, OwlViTRuntime
+from reference_bank import ReferenceBank
+from transformers.models.owlvit.modeling_owlvit import OwlViTObjectDetectionOutput
+
 
 class LaysDetector:
     """Lay's chips detector using OWL-ViT model."""
     
-    def __init__(self, model_name: str = "google/owlvit-base-patch32"):
-        """Initialize the detector with the specified model."""
-        print(f"Loading OWL-ViT model: {model_name}")
-        self.processor = OwlViTProcessor.from_pretrained(model_name)
-        self.model = OwlViTForObjectDetection.from_pretrained(model_name)
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(self.device)
-        print(f"Model loaded on device: {self.device}")
+    def __init__(self, model_name: str = "google/owlvit-base-patch32", compile_mode: str = "eager",
+                 reference_bank: str = None, embedding_store: str = None, student: str = None):
+        """Initialize the detector with the specified model, execution mode and optional stores.
         
+        `student` loads a distilled compact detector (see distill.py) in place of OWL-ViT.
+        """
         # Lay's detection prompts
         self.lays_prompts = [
             "Lay's chips bag",
@@ -38,15 +44,45 @@ class LaysDetector:
             "Lay's chip packet",
             "Lays potato chips bag"
         ]
+        
+        self.student = None
+        self.reference_bank = None
+        self.embedding_store = None
+        if student:
+            if reference_bank or embedding_store:
+                raise ValueError("Reference banks and embedding stores need the OWL-ViT backend")
+            self.device = torch.device("cpu")
+            self.student = StudentDetector.load(student, self.device)
+            self.processor = self.model = self.preprocessor = self.runtime = None
+            print(f"Distilled detector loaded: {student}")
+            return
+        
+        print(f"Loading OWL-ViT model: {model_name}")
+        self.processor, self.model = load_owlvit(model_name)
+        self.preprocessor = OwlViTPreprocessor(self.processor)
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model.to(self.device)
+        self.runtime = OwlViTRuntime(self.model, model_name, self.device, mode=compile_mode)
+        print(f"Model loaded on device: {self.device} ({compile_mode} execution)")
+        
+        # Image-conditioned queries from cropped pack images
+        if reference_bank:
+            self.reference_bank = ReferenceBank.load(reference_bank)
+            if self.reference_bank.model_name != model_name:
+                raise ValueError(f"Reference bank was built with {self.reference_bank.model_name}, not {model_name}")
+            print(f"Reference bank loaded: {len(self.reference_bank)} pack image(s)")
+        
+        # Per-patch image embeddings kept for re-querying archived photos
+        if embedding_store:
+            self.embedding_store = EmbeddingStore(embedding_store, model_name,
+                                                  self.model.config.text_config.hidden_size)
     
     def load_image(self, image_input: str) -> Image.Image:
         """Load image from file path or URL."""
         try:
             if image_input.startswith(('http://', 'https://')):
-                # Load from URL
-                response = requests.get(image_input, timeout=10)
-                response.raise_for_status()
-                image = Image.open(requests.get(image_input, stream=True).raw)
+                # Load from URL through the pooled, cached fetcher
+                image = default_fetcher().load_image(image_input)
             else:
                 # Load from local file
                 image_path = Path(image_input)
@@ -63,43 +99,46 @@ class LaysDetector:
         except Exception as e:
             raise Exception(f"Error loading image: {str(e)}")
     
-    def detect_lays(self, image: Image.Image, confidence_threshold: float = 0.1) -> List[dict]:
-        """Detect Lay's chips in the image."""
-        # Prepare inputs
-        inputs = self.processor(
-            text=self.lays_prompts, 
-            images=image, 
-            return_tensors="pt"
-        )
+    def detect_lays(self, image: Image.Image, confidence_threshold: float = 0.1,
+                    top_k: int = DEFAULT_TOP_K, image_id: str = None) -> List[dict]:
+        """Detect Lay's chips in the image, keeping at most top_k candidates per prompt."""
+        if self.student is not None:
+            return self.student.detect(image, confidence_threshold, top_k)
         
-        # Move inputs to device
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        # Prepare inputs
+        inputs = self.preprocessor(text=self.lays_prompts, images=image, device=self.device)
         
         # Run inference
-        with torch.no_grad():
-            outputs = self.model(**inputs)
+        outputs = self.runtime(**inputs)
+        
+        # Persist image-side embeddings so new prompts can be scored later without re-inference
+        if self.embedding_store is not None:
+            if image_id is None:
+                image_id = hashlib.sha1(image.tobytes()).hexdigest()
+            self.embedding_store.append(image_id, image.size, *image_side_tensors(self.model, outputs))
         
         # Process outputs
-        target_sizes = torch.Tensor([image.size[::-1]]).to(self.device)
-        results = self.processor.post_process_object_detection(
-            outputs=outputs, 
-            target_sizes=target_sizes, 
-            threshold=confidence_threshold
-        )
-        
-        detections = []
-        boxes, scores, labels = results[0]["boxes"], results[0]["scores"], results[0]["labels"]
-        
-        for box, score, label in zip(boxes, scores, labels):
-            detection = {
-                "box": box.cpu().numpy(),
-                "score": float(score.cpu()),
-                "label": self.lays_prompts[label.cpu().item()],
-                "label_id": int(label.cpu().item())
-            }
-            detections.append(detection)
-        
-        return detections
+        return postprocess_detections(outputs, image.size, self.lays_prompts, confidence_threshold, top_k)
+    
+    def detect_with_references(self, image: Image.Image, confidence_threshold: float = 0.1,
+                               top_k: int = DEFAULT_TOP_K) -> List[dict]:
+        """Detect Lay's packs by matching image patches against the reference bank."""
+        if self.reference_bank is None:
+            raise ValueError("No reference bank loaded")
+        
+        pixel_values = self.preprocessor.encode_images([image]).to(self.device)
+        
+        with torch.inference_mode():
+            feature_map, _ = self.model.image_embedder(pixel_values=pixel_values)
+            b, h, w, d = feature_map.shape
+            image_feats = feature_map.reshape(b, h * w, d)
+            
+            # One (patches x references) product scores every patch against the whole bank
+            logits, _ = self.model.class_predictor(image_feats, self.reference_bank.query_embeds(self.device))
+            pred_boxes = self.model.box_predictor(image_feats, feature_map)
+        
+        outputs = OwlViTObjectDetectionOutput(logits=logits, pred_boxes=pred_boxes)
+        return postprocess_detections(outputs, image.size, self.reference_bank.labels, confidence_threshold, top_k)
     
     def save_annotated_image(self, image: Image.Image, detections: List[dict], output_path: str):
         """Save image with bounding boxes drawn around detections."""
@@ -163,16 +202,28 @@ def main():
     parser.add_argument("image", help="Path to image file or URL")
     parser.add_argument("--confidence", "-c", type=float, default=0.1, 
                        help="Confidence threshold for detections (default: 0.1)")
+    parser.add_argument("--top-k", "-k", type=int, default=DEFAULT_TOP_K,
+                       help=f"Maximum candidates kept per prompt (default: {DEFAULT_TOP_K})")
     parser.add_argument("--save-annotated", "-s", type=str, 
                        help="Save annotated image to specified path")
     parser.add_argument("--model", "-m", default="google/owlvit-base-patch32",
                        help="Model name to use (default: google/owlvit-base-patch32)")
+    parser.add_argument("--compile", choices=COMPILE_MODES, default="eager",
+                       help="OWL-ViT execution mode, compiled graphs are cached on disk (default: eager)")
+    parser.add_argument("--embedding-store", "-e", type=str,
+                       help="Append the image's patch embeddings to this store for later re-querying")
+    parser.add_argument("--reference-bank", "-r", type=str,
+                       help="Detect with a reference bank of pack images (see reference_bank.py) instead of text prompts")
+    parser.add_argument("--student", type=str,
+                       help="Detect with a distilled compact detector (see distill.py) instead of OWL-ViT")
     
     args = parser.parse_args()
     
     try:
         # Initialize detector
-        detector = LaysDetector(model_name=args.model)
+        detector = LaysDetector(model_name=args.model, compile_mode=args.compile,
+                                reference_bank=args.reference_bank, embedding_store=args.embedding_store,
+                                student=args.student)
         
         # Load image
         print(f"Loading image: {args.image}")
@@ -181,7 +232,11 @@ def main():
         
         # Detect Lay's
         print("Running detection...")
-        detections = detector.detect_lays(image, confidence_threshold=args.confidence)
+        if detector.reference_bank is not None:
+            detections = detector.detect_with_references(image, confidence_threshold=args.confidence, top_k=args.top_k)
+        else:
+            detections = detector.detect_lays(image, confidence_threshold=args.confidence, top_k=args.top_k,
+                                              image_id=args.image)
         
         # Print results
         detector.print_results(detections)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Traffic capture and replay load generator
+
+Capture: with TRAFFIC_CAPTURE_DIR set, the detection apps record every
+request to the paths in CAPTURED_PATHS into a local corpus: the uploaded
+bytes (stored once per SHA-256 under objects/), the form fields and query
+string, the arrival time, and the response status and latency
+(manifest.jsonl).
+
+Replay: requests from a corpus are sent to a running service open-loop,
+i.e. on a fixed schedule that does not wait for earlier responses, either at
+a fixed rate or at the recorded inter-arrival times scaled by --speed.
+Latency is measured from each request's scheduled send time, so time spent
+waiting for a free client slot counts against the service instead of being
+hidden. The report gives throughput, latency percentiles, error and shed
+(429/503) rates.
+
+Sweep: replays at increasing rates and reports the saturation point, the
+highest rate the service sustains (achieved >= 95% of offered, p99 within
+--slo-ms, errors and sheds under 1%).
+
+Usage:
+    TRAFFIC_CAPTURE_DIR=corpus python multi_model_app.py
+    python load_replay.py replay corpus --url http://localhost:5002 --rate 4 --concurrency 8 --duration 60
+    python load_replay.py replay corpus --url http://localhost:5002 --speed 2
+    python load_replay.py sweep corpus --url http://localhost:5002 --rates 1 2 4 8 16 --slo-ms 3000
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+CAPTURED_PATHS = ("/upload", "/upload/batch", "/v1/detect")
+SHED_STATUSES = (429, 503)
+
+
+class TrafficRecorder:
+    """Writes captured requests into a corpus directory."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        (self.path / "objects").mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _store(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        target = self.path / "objects" / digest
+        if not target.exists():
+            temp = target.with_suffix(f".{threading.get_ident()}.tmp")
+            temp.write_bytes(data)
+            os.replace(temp, target)
+        return digest
+
+    def capture(self, flask_request):
+        """Read the request's uploads and body before the handler consumes them."""
+        files = []
+        for field, storage in flask_request.files.items(multi=True):
+            data = storage.read()
+            storage.seek(0)
+            files.append({"field": field, "filename": storage.filename,
+                          "content_type": storage.mimetype, "object": self._store(data)})
+        body = None
+        if not files and not flask_request.form:
+            data = flask_request.get_data()  # cached, so the handler still sees it
+            body = self._store(data) if data else None
+        return {
+            "time": time.time(),
+            "method": flask_request.method,
+            "path": flask_request.path,
+            "query": flask_request.query_string.decode(),
+            "form": list(flask_request.form.items(multi=True)),
+            "files": files,
+            "body": body,
+            "content_type": flask_request.content_type if body else None
+        }
+
+    def write(self, entry, status, elapsed_ms):
+        entry.update(status=status, elapsed_ms=round(elapsed_ms, 1))
+        with self._lock, open(self.path / "manifest.jsonl", "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def install_capture(app, paths=CAPTURED_PATHS):
+    """Record matching requests of a Flask app when TRAFFIC_CAPTURE_DIR is set."""
+    path = os.environ.get("TRAFFIC_CAPTURE_DIR")
+    if not path:
+        return None
+    from flask import g, request
+
+    recorder = TrafficRecorder(path)
+
+    @app.before_request
+    def _capture_request():
+        if request.path in paths:
+            g.traffic_entry = recorder.capture(request)
+            g.traffic_start = time.perf_counter()
+
+    @app.after_request
+    def _record_response(response):
+        entry = g.pop("traffic_entry", None)
+        if entry is not None:
+            recorder.write(entry, response.status_code, (time.perf_counter() - g.traffic_start) * 1000)
+        return response
+
+    return recorder
+
+
+class Corpus:
+    """Captured requests loaded for replay."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "manifest.jsonl") as f:
+            # The manifest is written in completion order; replay in arrival order
+            self.entries = sorted((json.loads(line) for line in f if line.strip()), key=lambda e: e["time"])
+        if not self.entries:
+            raise ValueError(f"Corpus has no requests: {path}")
+        self._objects = {}
+
+    def _object(self, digest):
+        data = self._objects.get(digest)
+        if data is None:
+            data = self._objects[digest] = (self.path / "objects" / digest).read_bytes()
+        return data
+
+    def preload(self):
+        """Read every object into memory so disk reads do not skew replay latency."""
+        for entry in self.entries:
+            for item in entry["files"]:
+                self._object(item["object"])
+            if entry.get("body"):
+                self._object(entry["body"])
+
+    def request_kwargs(self, entry):
+        kwargs = {"params": entry["query"] or None}
+        if entry["files"]:
+            kwargs["files"] = [(item["field"], (item["filename"], self._object(item["object"]), item["content_type"]))
+                               for item in entry["files"]]
+            kwargs["data"] = entry["form"]
+        elif entry.get("body"):
+            kwargs["data"] = self._object(entry["body"])
+            kwargs["headers"] = {"Content-Type": entry.get("content_type") or "application/octet-stream"}
+        else:
+            kwargs["data"] = entry["form"]
+        return kwargs
+
+    def schedule(self, rate=None, speed=1.0, duration=None, seed=0):
+        """(offset_seconds, entry) pairs: Poisson arrivals at `rate`, or recorded gaps divided by `speed`."""
+        rng = random.Random(seed)
+        if rate:
+            count = max(1, int(rate * duration)) if duration else len(self.entries)
+            offset = 0.0
+            for i in range(count):
+                yield offset, self.entries[i % len(self.entries)]
+                offset += rng.expovariate(rate)
+            return
+
+        start = self.entries[0]["time"]
+        span = self.entries[-1]["time"] - start
+        loop = 0
+        while True:
+            for entry in self.entries:
+                offset = (entry["time"] - start + loop * (span + 1.0)) / speed
+                if duration and offset > duration:
+                    return
+                yield offset, entry
+            if not duration:
+                return
+            loop += 1
+
+
+def replay(corpus, url, rate=None, speed=1.0, concurrency=8, duration=None, timeout=60, seed=0):
+    """Send the corpus to url open-loop and return the report."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    corpus.preload()
+
+    results = []
+    lock = threading.Lock()
+
+    def send(scheduled, entry):
+        sent = time.perf_counter()
+        try:
+            response = session.request(entry["method"], url.rstrip("/") + entry["path"], timeout=timeout,
+                                       **corpus.request_kwargs(entry))
+            status = response.status_code
+        except requests.RequestException:
+            status = None
+        done = time.perf_counter()
+        with lock:
+            results.append((status, done - scheduled, done - sent, done))
+
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    start = time.perf_counter()
+    offered = 0
+    for offset, entry in corpus.schedule(rate, speed, duration, seed):
+        delay = start + offset - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pool.submit(send, start + offset, entry)
+        offered += 1
+    send_span = time.perf_counter() - start
+    pool.shutdown(wait=True)
+    return summarize(results, offered, send_span, start)
+
+
+def summarize(results, offered, send_span, start):
+    """Throughput, latency percentiles and error/shed rates for one replay."""
+    statuses = np.array([-1 if r[0] is None else r[0] for r in results])
+    latency = np.array([r[1] for r in results]) * 1000
+    service = np.array([r[2] for r in results]) * 1000
+    finished = max((r[3] for r in results), default=start) - start
+    ok = (statuses >= 200) & (statuses < 300)
+    shed = np.isin(statuses, SHED_STATUSES)
+
+    def percentiles(values):
+        if not len(values):
+            return {}
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {"p50": round(float(p50), 1), "p90": round(float(p90), 1), "p99": round(float(p99), 1),
+                "max": round(float(values.max()), 1)}
+
+    return {
+        "requests": int(offered),
+        "offered_rps": round(offered / send_span, 2) if send_span > 0 else None,
+        "throughput_rps": round(float(ok.sum()) / finished, 2) if finished > 0 else None,
+        "ok": int(ok.sum()),
+        "error_rate": round(float((~ok & ~shed).mean()), 4) if len(results) else 0.0,
+        "shed_rate": round(float(shed.mean()), 4) if len(results) else 0.0,
+        "latency_ms": percentiles(latency[ok]),
+        "service_ms": percentiles(service[ok])
+    }
+
+
+def sustained(report, slo_ms):
+    """Whether a replay kept up with its offered rate within the latency SLO."""
+    return (report["throughput_rps"] is not None and report["offered_rps"]
+            and report["throughput_rps"] >= 0.95 * report["offered_rps"]
+            and report["error_rate"] + report["shed_rate"] < 0.01
+            and report["latency_ms"].get("p99", float("inf")) <= slo_ms)
+
+
+def main():
+    """Replay captured traffic against a running detection service."""
+    parser = argparse.ArgumentParser(description="Replay captured detection traffic as a load test")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("replay", "sweep"):
+        sub = subparsers.add_parser(name, help="Replay at one rate" if name == "replay" else "Find the saturation point")
+        sub.add_argument("corpus", help="Corpus directory (TRAFFIC_CAPTURE_DIR)")
+        sub.add_argument("--url", default="http://localhost:5002", help="Service base URL (default: http://localhost:5002)")
+        sub.add_argument("--concurrency", type=int, default=8, help="Concurrent client connections (default: 8)")
+        sub.add_argument("--duration", type=float, default=60 if name == "sweep" else None,
+                         help="Seconds per replay (default: one pass over the corpus; 60 for sweep)")
+        sub.add_argument("--timeout", type=float, default=60, help="Request timeout in seconds (default: 60)")
+        sub.add_argument("--output", "-o", help="Write the report as JSON")
+    subparsers.choices["replay"].add_argument("--rate", type=float, help="Fixed Poisson arrival rate in requests/sec")
+    subparsers.choices["replay"].add_argument("--speed", type=float, default=1.0,
+                                              help="Scale recorded inter-arrival times (2 = twice as fast)")
+    subparsers.choices["sweep"].add_argument("--rates", type=float, nargs="+", required=True,
+                                             help="Arrival rates to try, in requests/sec")
+    subparsers.choices["sweep"].add_argument("--slo-ms", type=float, default=5000,
+                                             help="p99 latency limit for a sustained rate (default: 5000)")
+    args = parser.parse_args()
+
+    try:
+        corpus = Corpus(args.corpus)
+        print(f"📂 {len(corpus.entries)} captured request(s)")
+
+        if args.command == "replay":
+            report = replay(corpus, args.url, args.rate, args.speed, args.concurrency, args.duration, args.timeout)
+            print(json.dumps(report, indent=2))
+        else:
+            runs = []
+            for rate in sorted(args.rates):
+                result = replay(corpus, args.url, rate, 1.0, args.concurrency, args.duration, args.timeout)
+                result["rate"] = rate
+                result["sustained"] = bool(sustained(result, args.slo_ms))
+                runs.append(result)
+                print(f"   {rate:>7.2f} req/s -> {result['throughput_rps']} req/s, "
+                      f"p99 {result['latency_ms'].get('p99')} ms, errors {result['error_rate']:.1%}, "
+                      f"shed {result['shed_rate']:.1%} {'✅' if result['sustained'] else '❌'}")
+            saturation = max((r["rate"] for r in runs if r["sustained"]), default=None)
+            report = {"runs": runs, "saturation_rps": saturation}
+            print(f"📈 Saturation point: {saturation} req/s" if saturation else "📈 No rate was sustained")
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"💾 Report saved to: {args.output}")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Per-request memory budget and size-aware image decoding
+
+A compressed upload says little about its decoded size: a 16 MB JPEG can
+hold a 12000 x 9000 photo, and every request then makes several full-size
+copies (RGB conversion, the annotated copy, NumPy arrays for OCR crops, the
+base64/PNG encodes). Two of those in parallel have OOM-killed pods.
+
+Two measures keep a process inside a fixed budget:
+
+- Size-aware decode: only the header is read first; JPEGs are then decoded
+  straight at a reduced scale with Image.draft() (the decoder skips DCT
+  coefficients, so the full-size bitmap is never materialized), and any
+  remaining excess is removed with Image.reduce(). Photos end up with their
+  longer side at most MAX_IMAGE_SIDE, which is still well above the 768 px
+  OWL-ViT input.
+- Accounting: before decoding, each request reserves an estimate of its peak
+  working memory (REQUEST_COPIES full RGB copies of the working image plus
+  the compressed bytes, and the full-size bitmap for formats that cannot be
+  drafted) from a process-wide MemoryBudget. When the budget is
+  exhausted the request waits for earlier ones to finish; after
+  MEMORY_WAIT_SECONDS it is shed with 503 and Retry-After instead of risking
+  the OOM killer. A single request larger than the whole budget still runs,
+  but alone.
+
+Enabled with MEMORY_BUDGET_MB; MAX_IMAGE_SIDE and MEMORY_WAIT_SECONDS tune it.
+"""
+
+import io
+import os
+import threading
+import time
+
+from PIL import Image
+
+DEFAULT_MAX_IMAGE_SIDE = 2048
+DEFAULT_WAIT_SECONDS = 30
+REQUEST_COPIES = 6
+REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK", "I", "F")  # Image.reduce() averages these correctly
+
+
+class BudgetExceeded(Exception):
+    """Raised when a reservation cannot be granted within the wait timeout."""
+
+
+def working_size(size, max_side=DEFAULT_MAX_IMAGE_SIDE):
+    """(width, height) an image of `size` is decoded to, never upscaled."""
+    width, height = size
+    scale = min(1.0, max_side / max(width, height)) if max_side else 1.0
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def estimate_bytes(size, compressed_bytes=0, max_side=DEFAULT_MAX_IMAGE_SIDE, mode="RGB", draftable=True):
+    """Peak working memory of one photo decoded to its working size.
+
+    Only JPEG can be drafted; other formats are decoded at full size first (at most 4 bytes per
+    pixel), plus an RGB copy when their mode has to be converted before reduce().
+    """
+    width, height = working_size(size, max_side)
+    total = width * height * 3 * REQUEST_COPIES + compressed_bytes
+    if not draftable and (width, height) != tuple(size):
+        pixels = size[0] * size[1]
+        total += pixels * 4 + (pixels * 3 if mode not in REDUCIBLE_MODES else 0)
+    return total
+
+
+def image_bytes(image, compressed_bytes=0, max_side=DEFAULT_MAX_IMAGE_SIDE):
+    """estimate_bytes() for an opened, not yet decoded PIL image."""
+    return estimate_bytes(image.size, compressed_bytes, max_side, image.mode, image.format == "JPEG")
+
+
+def decode_bounded(source, max_side=DEFAULT_MAX_IMAGE_SIDE):
+    """Decode bytes, a stream or an opened PIL image to RGB with its longer side at most max_side."""
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    image = source if isinstance(source, Image.Image) else Image.open(source)
+    target = working_size(image.size, max_side)
+
+    if target != image.size:
+        # JPEG: let the decoder produce a 1/2, 1/4 or 1/8 scale image directly
+        image.draft('RGB', target)
+        factor = min(image.size[0] // target[0], image.size[1] // target[1])
+        if factor >= 2 and image.mode not in REDUCIBLE_MODES:
+            image = image.convert('RGB')  # Palette, 1-bit and 16-bit images
+        if factor >= 2:
+            image = image.reduce(factor)
+        if max(image.size) > max_side:
+            image = image.resize(working_size(image.size, max_side), Image.BILINEAR)
+    else:
+        image.load()
+    return image.convert('RGB') if image.mode != 'RGB' else image
+
+
+class MemoryBudget:
+    """Process-wide byte budget shared by all in-flight requests."""
+
+    def __init__(self, budget_bytes, max_side=DEFAULT_MAX_IMAGE_SIDE, wait_seconds=DEFAULT_WAIT_SECONDS):
+        self.budget_bytes = budget_bytes
+        self.max_side = max_side
+        self.wait_seconds = wait_seconds
+        self._condition = threading.Condition()
+        self._in_use = 0
+        self._peak = 0
+        self._waiting = 0
+        self._deferred = 0
+        self._shed = 0
+
+    def reserve(self, nbytes, timeout=None):
+        """Block until nbytes fit in the budget and reserve them; raises BudgetExceeded on timeout."""
+        nbytes = min(nbytes, self.budget_bytes)  # an oversized request runs alone rather than never
+        timeout = self.wait_seconds if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            if self._in_use + nbytes > self.budget_bytes:
+                self._deferred += 1
+                self._waiting += 1
+                try:
+                    while self._in_use + nbytes > self.budget_bytes:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._shed += 1
+                            raise BudgetExceeded(f"Memory budget exhausted ({self._in_use // 2**20} MB in use)")
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += nbytes
+            self._peak = max(self._peak, self._in_use)
+        return nbytes
+
+    def release(self, nbytes):
+        with self._condition:
+            self._in_use -= nbytes
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "budget_mb": round(self.budget_bytes / 2**20, 1),
+                "in_use_mb": round(self._in_use / 2**20, 1),
+                "peak_mb": round(self._peak / 2**20, 1),
+                "waiting": self._waiting,
+                "deferred": self._deferred,
+                "shed": self._shed
+            }
+
+    def reserve_for_request(self, nbytes):
+        """Reserve for the current Flask request; released when the request ends (see install_budget)."""
+        from flask import g
+
+        reserved = self.reserve(nbytes)
+        g.memory_reserved = g.get("memory_reserved", 0) + reserved
+
+    def open_image(self, source, extra_bytes=None):
+        """Reserve for one upload from its header, then decode it at working resolution.
+
+        extra_bytes(working size), if given, is the memory of later stages (e.g. SAM refinement) and is
+        reserved together with the decode, so a request never waits on the budget while holding part of it.
+        Returns (image, original size).
+        """
+        data = source if isinstance(source, (bytes, bytearray)) else source.read()
+        image = Image.open(io.BytesIO(data))
+        extra = extra_bytes(working_size(image.size, self.max_side)) if extra_bytes else 0
+        self.reserve_for_request(image_bytes(image, len(data), self.max_side) + extra)
+        return decode_bounded(image, self.max_side), image.size
+
+    def reserve_batch(self, items, extra_bytes=None):
+        """Reserve for a batch of (name, bytes) uploads from their headers before any is decoded.
+
+        extra_bytes is as for open_image(); later stages run one photo at a time, so only the largest is added.
+        """
+        total = extra = 0
+        for _, data in items:
+            try:
+                image = Image.open(io.BytesIO(data))
+            except Exception:
+                continue  # Reported as a per-photo decode error later
+            total += image_bytes(image, len(data), self.max_side)
+            if extra_bytes:
+                extra = max(extra, extra_bytes(working_size(image.size, self.max_side)))
+        self.reserve_for_request(total + extra)
+
+
+def install_budget(app, budget):
+    """Release request reservations at teardown and answer BudgetExceeded with 503."""
+    from flask import g, jsonify
+
+    @app.teardown_request
+    def _release_memory(_exc):
+        reserved = g.pop("memory_reserved", 0)
+        if reserved:
+            budget.release(reserved)
+
+    @app.errorhandler(BudgetExceeded)
+    def _shed(error):
+        response = jsonify({"error": str(error)})
+        response.status_code = 503
+        response.headers["Retry-After"] = "5"
+        return response
+
+
+def memory_budget_from_env():
+    """Budget configured by MEMORY_BUDGET_MB / MAX_IMAGE_SIDE / MEMORY_WAIT_SECONDS, or None if disabled."""
+    budget_mb = os.environ.get("MEMORY_BUDGET_MB")
+    if not budget_mb:
+        return None
+    return MemoryBudget(int(budget_mb) * 2**20,
+                        int(os.environ.get("MAX_IMAGE_SIDE", DEFAULT_MAX_IMAGE_SIDE)),
+                        float(os.environ.get("MEMORY_WAIT_SECONDS", DEFAULT_WAIT_SECONDS)))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Offline model bundle for the Lay's detection pipelines
+
+Snapshots every model the apps use (OWL-ViT weights and processor config,
+Grounding DINO config and weights, PaddleOCR inference models) into one
+versioned local directory, with all PyTorch weights stored as safetensors.
+When MODEL_BUNDLE_DIR points at a bundle, the loaders below read everything
+from it in offline mode: safetensors are memory-mapped instead of unpickled,
+so cold loads are faster and worker processes share the weight pages.
+
+Usage:
+    python model_bundle.py create --output bundles --dino-weights groundingdino_swint_ogc.pth
+    python model_bundle.py verify bundles/20261019-120000
+    MODEL_BUNDLE_DIR=bundles/20261019-120000 python multi_model_app.py
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+OWLVIT_MODEL_NAME = "google/owlvit-base-patch32"
+DINO_CONFIG = "groundingdino/config/GroundingDINO_SwinT_OGC.py"
+DINO_WEIGHTS = "groundingdino_swint_ogc.pth"
+PADDLEOCR_HOME = os.path.join(os.path.expanduser("~"), ".paddleocr", "whl")
+MANIFEST_NAME = "manifest.json"
+
+
+def bundle_dir():
+    """Return the active bundle directory from MODEL_BUNDLE_DIR, or None."""
+    path = os.environ.get("MODEL_BUNDLE_DIR")
+    if not path:
+        return None
+    path = Path(path)
+    if not (path / MANIFEST_NAME).exists():
+        raise FileNotFoundError(f"MODEL_BUNDLE_DIR has no {MANIFEST_NAME}: {path}")
+    return path
+
+
+def model_version(model_name=OWLVIT_MODEL_NAME):
+    """Version recorded with results: the bundle version, or the hub model name."""
+    bundle = bundle_dir()
+    if bundle is None:
+        return model_name
+    with open(bundle / MANIFEST_NAME) as f:
+        return json.load(f)["version"]
+
+
+def _enable_offline_mode():
+    """Stop transformers / huggingface_hub from reaching the network."""
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["TRANSFORMERS_OFFLINE"] = "1"
+
+
+def _local_name(model_name):
+    return model_name.replace("/", "--")
+
+
+def load_owlvit(model_name=OWLVIT_MODEL_NAME):
+    """Load the OWL-ViT processor and model, from the bundle when one is active."""
+    from transformers import OwlViTProcessor, OwlViTForObjectDetection
+
+    bundle = bundle_dir()
+    if bundle is None:
+        return (OwlViTProcessor.from_pretrained(model_name),
+                OwlViTForObjectDetection.from_pretrained(model_name))
+
+    _enable_offline_mode()
+    path = bundle / "owlvit" / _local_name(model_name)
+    logger.info(f"Loading OWL-ViT from bundle: {path}")
+    processor = OwlViTProcessor.from_pretrained(path, local_files_only=True)
+    model = OwlViTForObjectDetection.from_pretrained(path, local_files_only=True, use_safetensors=True)
+    return processor, model
+
+
+def load_grounding_dino(config_path=DINO_CONFIG, weights_path=DINO_WEIGHTS):
+    """Load Grounding DINO, mapping safetensors weights from the bundle when one is active."""
+    from groundingdino.util.inference import load_model
+
+    bundle = bundle_dir()
+    if bundle is None:
+        return load_model(config_path, weights_path)
+
+    from groundingdino.models import build_model
+    from groundingdino.util.misc import clean_state_dict
+    from groundingdino.util.slconfig import SLConfig
+    from safetensors.torch import load_file
+
+    dino_dir = bundle / "groundingdino"
+    logger.info(f"Loading Grounding DINO from bundle: {dino_dir}")
+    args = SLConfig.fromfile(str(dino_dir / "config.py"))
+    args.device = "cpu"
+    model = build_model(args)
+
+    # assign=True keeps the memory-mapped tensors as parameters instead of copying them
+    state_dict = load_file(str(dino_dir / "model.safetensors"))
+    model.load_state_dict(clean_state_dict(state_dict), strict=False, assign=True)
+    return model.eval()
+
+
+def _find_paddle_model(root, kind):
+    """First directory under root/kind holding a Paddle inference model."""
+    for pattern in ("inference.pdmodel", "inference.json"):
+        for path in sorted((root / kind).rglob(pattern)):
+            return str(path.parent)
+    return None
+
+
+def paddleocr_kwargs(legacy=False):
+    """PaddleOCR constructor kwargs pointing at the bundled models, empty without a bundle.
+
+    `legacy` selects the PaddleOCR 2.x argument names (det/rec/cls_model_dir).
+    """
+    bundle = bundle_dir()
+    if bundle is None:
+        return {}
+
+    root = bundle / "paddleocr"
+    if legacy:
+        names = {"det": "det_model_dir", "rec": "rec_model_dir", "cls": "cls_model_dir"}
+    else:
+        names = {"det": "text_detection_model_dir", "rec": "text_recognition_model_dir",
+                 "cls": "textline_orientation_model_dir"}
+
+    kwargs = {}
+    for kind, name in names.items():
+        model_dir = _find_paddle_model(root, kind)
+        if model_dir:
+            kwargs[name] = model_dir
+    return kwargs
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _snapshot_owlvit(target, model_name):
+    from transformers import OwlViTProcessor, OwlViTForObjectDetection
+
+    print(f"📦 OWL-ViT: {model_name}")
+    path = target / "owlvit" / _local_name(model_name)
+    OwlViTProcessor.from_pretrained(model_name).save_pretrained(path)
+    OwlViTForObjectDetection.from_pretrained(model_name).save_pretrained(path, safe_serialization=True)
+    return {"source": model_name, "path": str(path.relative_to(target))}
+
+
+def _snapshot_grounding_dino(target, config_path, weights_path):
+    import torch
+    from safetensors.torch import save_file
+
+    print(f"📦 Grounding DINO: {weights_path}")
+    path = target / "groundingdino"
+    path.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(config_path, path / "config.py")
+
+    # The .pth is unpickled once here so that runtime loads never have to
+    checkpoint = torch.load(weights_path, map_location="cpu", weights_only=False)
+    state_dict = checkpoint.get("model", checkpoint)
+    state_dict = {k: v.contiguous().clone() for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+    save_file(state_dict, str(path / "model.safetensors"))
+    return {"source": str(weights_path), "path": str(path.relative_to(target))}
+
+
+def _snapshot_paddleocr(target, paddleocr_dir):
+    print(f"📦 PaddleOCR: {paddleocr_dir}")
+    path = target / "paddleocr"
+    shutil.copytree(paddleocr_dir, path, dirs_exist_ok=True)
+    return {"source": str(paddleocr_dir), "path": str(path.relative_to(target))}
+
+
+def create_bundle(output, version=None, model_name=OWLVIT_MODEL_NAME, dino_config=DINO_CONFIG,
+                  dino_weights=DINO_WEIGHTS, paddleocr_dir=PADDLEOCR_HOME):
+    """Snapshot all pipeline models into output/version and write its manifest."""
+    import torch
+    import transformers
+
+    version = version or time.strftime("%Y%m%d-%H%M%S")
+    target = Path(output) / version
+    if target.exists():
+        raise FileExistsError(f"Bundle version already exists: {target}")
+    target.mkdir(parents=True)
+
+    models = {"owlvit": _snapshot_owlvit(target, model_name)}
+
+    if dino_weights and Path(dino_weights).exists() and Path(dino_config).exists():
+        models["groundingdino"] = _snapshot_grounding_dino(target, dino_config, dino_weights)
+    else:
+        print("⚠️  Grounding DINO config/weights not found, skipping")
+
+    if paddleocr_dir and Path(paddleocr_dir).is_dir():
+        models["paddleocr"] = _snapshot_paddleocr(target, paddleocr_dir)
+    else:
+        print("⚠️  PaddleOCR models not found, skipping")
+
+    files = {}
+    for path in sorted(target.rglob("*")):
+        if path.is_file():
+            files[str(path.relative_to(target))] = _sha256(path)
+
+    manifest = {
+        "version": version,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "models": models,
+        "files": files
+    }
+    with open(target / MANIFEST_NAME, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return target
+
+
+def verify_bundle(path):
+    """Return the list of files whose checksum does not match the manifest."""
+    path = Path(path)
+    with open(path / MANIFEST_NAME) as f:
+        manifest = json.load(f)
+
+    mismatched = []
+    for name, digest in manifest["files"].items():
+        file_path = path / name
+        if not file_path.exists() or _sha256(file_path) != digest:
+            mismatched.append(name)
+    return mismatched
+
+
+def main():
+    """Create or verify an offline model bundle."""
+    parser = argparse.ArgumentParser(description="Snapshot pipeline models into an offline bundle")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create = subparsers.add_parser("create", help="Create a new bundle version")
+    create.add_argument("--output", "-o", default="bundles", help="Bundle root directory (default: bundles)")
+    create.add_argument("--version", "-v", help="Bundle version (default: timestamp)")
+    create.add_argument("--model", "-m", default=OWLVIT_MODEL_NAME,
+                        help=f"OWL-ViT model name (default: {OWLVIT_MODEL_NAME})")
+    create.add_argument("--dino-config", default=DINO_CONFIG, help="Grounding DINO config file")
+    create.add_argument("--dino-weights", default=DINO_WEIGHTS, help="Grounding DINO .pth checkpoint")
+    create.add_argument("--paddleocr-dir", default=PADDLEOCR_HOME,
+                        help="PaddleOCR model directory (default: ~/.paddleocr/whl)")
+
+    verify = subparsers.add_parser("verify", help="Check bundle files against the manifest")
+    verify.add_argument("path", help="Bundle version directory")
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == "create":
+            target = create_bundle(args.output, args.version, args.model, args.dino_config,
+                                   args.dino_weights, args.paddleocr_dir)
+            print(f"✅ Bundle created: {target}")
+            print(f"   Run with MODEL_BUNDLE_DIR={target}")
+        else:
+            mismatched = verify_bundle(args.path)
+            if mismatched:
+                print(f"❌ {len(mismatched)} file(s) missing or modified:")
+                for name in mismatched:
+                    print(f"   - {name}")
+                sys.exit(1)
+            print("✅ Bundle verified")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
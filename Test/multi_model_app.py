@@ -9,57 +9,144 @@ import io
 import base64
 import cv2
 import numpy as np
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Request, render_template, request, jsonify
 from werkzeug.utils import secure_filename
 from PIL import Image
 import torch
-from transformers import OwlViTProcessor, OwlViTForObjectDetection
 import logging
 
+from batch_upload import MAX_BATCH_BYTES, chunked, collect_uploads, decode_images
+from inference_scheduler import inference_slot, install_scheduler, scheduler_from_env
+from load_replay import install_capture
+from memory_budget import BudgetExceeded, install_budget, memory_budget_from_env
+from model_bundle import load_owlvit, model_version, paddleocr_kwargs
+from owlvit_postprocessing import DEFAULT_TOP_K, postprocess_batch
+from owlvit_preprocessing import OwlViTPreprocessor
+from owlvit_runtime import runtime_from_env
+from phash_index import detect_with_index, find_duplicate, index_from_env, remember
+from prescreen import prescreen_from_env
+from profiler_capture import install_profiler, profiled
+from raw_output_cache import capture_raw_outputs, raw_cache_from_env, record_raw_outputs
+from results_store import results_store_from_env
+from sam_refinement import mask_refiner_from_env
+from shop_layout import incremental_detect, layout_store_from_env
+from single_flight import RequestAbandoned, install_single_flight, raise_if_abandoned
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class UploadRequest(Request):
+    """Request with a larger body limit for batch uploads, which carry a whole visit."""
+    
+    @property
+    def max_content_length(self):
+        if self.path == '/upload/batch':
+            return MAX_BATCH_BYTES
+        return super().max_content_length
+
 app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['SECRET_KEY'] = 'your-secret-key-here'
+install_capture(app)  # Records traffic for load replay when TRAFFIC_CAPTURE_DIR is set
+
+# Per-request memory accounting and bounded decode (enabled by MEMORY_BUDGET_MB)
+memory_budget = memory_budget_from_env()
+if memory_budget is not None:
+    install_budget(app, memory_budget)
+profiler = install_profiler(app)  # Armed on demand via /admin/profile or SIGUSR2
+single_flight = install_single_flight(app)  # Identical concurrent requests share one pipeline run
+
+# Priority classes and per-tenant fair sharing of the model (enabled by INFERENCE_SLOTS)
+scheduler = scheduler_from_env()
+if scheduler is not None:
+    install_scheduler(app, scheduler)
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
 
 # Global model variables
 owlvit_processor = None
+owlvit_preprocessor = None
 owlvit_model = None
+owlvit_runtime = None
 paddleocr_model = None
 device = None
+duplicate_index = None
+prescreen = None
+layout_store = None
+results_store = None
+model_version_name = None
+mask_refiner = None
+raw_cache = None
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def refine_masks(image, detections):
+    """SAM share-of-shelf for one image in a scheduler slot, or None when SAM is off."""
+    if mask_refiner is None:
+        return None
+    with inference_slot(scheduler):
+        return mask_refiner.refine(image, detections)
+
+def sam_working_bytes():
+    """SAM refinement's memory per photo size, reserved with the upload; None when SAM is off."""
+    return mask_refiner.working_bytes if mask_refiner is not None else None
+
 def load_models():
     """Load OWL-ViT and PaddleOCR models."""
-    global owlvit_processor, owlvit_model, paddleocr_model, device
+    global owlvit_processor, owlvit_preprocessor, owlvit_model, owlvit_runtime, paddleocr_model, device, duplicate_index, prescreen, layout_store, results_store, model_version_name, mask_refiner, raw_cache
     
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     logger.info(f"Using device: {device}")
     
     # Load OWL-ViT
     logger.info("Loading OWL-ViT model...")
-    owlvit_processor = OwlViTProcessor.from_pretrained("google/owlvit-base-patch32")
-    owlvit_model = OwlViTForObjectDetection.from_pretrained("google/owlvit-base-patch32")
+    owlvit_processor, owlvit_model = load_owlvit("google/owlvit-base-patch32")
+    owlvit_preprocessor = OwlViTPreprocessor(owlvit_processor)
     owlvit_model.to(device)
+    owlvit_runtime = runtime_from_env(owlvit_model, "google/owlvit-base-patch32", device)
     logger.info("OWL-ViT loaded successfully")
     
     # Load PaddleOCR (optional)
     logger.info("Loading PaddleOCR model...")
     try:
         from paddleocr import PaddleOCR
-        paddleocr_model = PaddleOCR(use_textline_orientation=True, lang='en')
+        paddleocr_model = PaddleOCR(use_textline_orientation=True, lang='en', **paddleocr_kwargs())
         logger.info("PaddleOCR loaded successfully")
     except Exception as e:
         logger.warning(f"PaddleOCR not available: {e}")
         paddleocr_model = None
+    
+    # Near-duplicate photo index (enabled by PHASH_INDEX_DIR)
+    duplicate_index = index_from_env()
+    if duplicate_index is not None:
+        logger.info(f"Near-duplicate index loaded with {len(duplicate_index)} photos")
+    
+    # Colour/quality pre-screen (enabled by PRESCREEN=1)
+    prescreen = prescreen_from_env()
+    
+    # Per-shop layouts for incremental detection (enabled by SHOP_LAYOUT_DIR)
+    layout_store = layout_store_from_env()
+    
+    # Persistent per-image/per-box results (enabled by RESULTS_DB)
+    results_store = results_store_from_env()
+    model_version_name = model_version()
+    
+    # SAM2 mask refinement for share-of-shelf (enabled by SAM_MODEL)
+    try:
+        mask_refiner = mask_refiner_from_env(device)
+    except Exception as e:
+        logger.warning(f"SAM2 not available: {e}")
+        mask_refiner = None
+    if mask_refiner is not None:
+        logger.info("SAM2 mask refinement enabled")
+    
+    # Raw outputs kept for /rethreshold (disabled by RAW_CACHE_MB=0)
+    raw_cache = raw_cache_from_env()
 
 def calculate_iou(box1, box2):
     """Calculate Intersection over Union (IoU) of two bounding boxes."""
@@ -88,6 +175,7 @@ def is_box_contained(box1, box2):
     return (x1_min >= x2_min and y1_min >= y2_min and 
             x1_max <= x2_max and y1_max <= y2_max)
 
+@profiled("nms")
 def non_maximum_suppression(detections, iou_threshold=0.3):
     """Apply Non-Maximum Suppression to remove duplicate detections."""
     if len(detections) == 0:
@@ -112,9 +200,10 @@ def non_maximum_suppression(detections, iou_threshold=0.3):
     
     return keep
 
-def detect_with_owlvit_enhanced(image, confidence_threshold=0.1):
-    """Enhanced OWL-ViT detection with multiple prompts."""
-    global owlvit_processor, owlvit_model, device
+@profiled("owlvit")
+def detect_with_owlvit_batch(images, confidence_threshold=0.1, top_k=DEFAULT_TOP_K):
+    """Enhanced OWL-ViT detection for several images, one model call per preprocessor batch."""
+    global owlvit_processor, owlvit_preprocessor, owlvit_model, owlvit_runtime, device
     
     # More comprehensive prompts for Lay's detection
     lays_prompts = [
@@ -128,31 +217,29 @@ def detect_with_owlvit_enhanced(image, confidence_threshold=0.1):
         "Lay's chips bag with logo"
     ]
     
-    inputs = owlvit_processor(text=lays_prompts, images=image, return_tensors="pt")
-    inputs = {k: v.to(device) for k, v in inputs.items()}
-    
-    with torch.no_grad():
-        outputs = owlvit_model(**inputs)
-    
-    target_sizes = torch.Tensor([image.size[::-1]]).to(device)
-    results = owlvit_processor.post_process_object_detection(
-        outputs=outputs, target_sizes=target_sizes, threshold=confidence_threshold
-    )
-    
-    detections = []
-    boxes, scores, labels = results[0]["boxes"], results[0]["scores"], results[0]["labels"]
+    results = []
+    for batch in chunked(images, owlvit_preprocessor.max_batch_size):
+        inputs = owlvit_preprocessor(text=lays_prompts, images=batch, device=device)
+        
+        # Slot held for this batch only, so bulk requests yield to interactive ones between batches
+        with inference_slot(scheduler, len(batch)):
+            outputs = owlvit_runtime(**inputs)
+        record_raw_outputs(outputs, [image.size for image in batch], lays_prompts)
+        
+        results.extend(postprocess_batch(outputs, [image.size for image in batch], lays_prompts,
+                                         confidence_threshold, top_k))
     
-    for box, score, label in zip(boxes, scores, labels):
-        detection = {
-            "box": box.cpu().numpy().tolist(),
-            "score": float(score.cpu()),
-            "label": lays_prompts[label.cpu().item()],
-            "model": "OWL-ViT Enhanced"
-        }
-        detections.append(detection)
+    for detections in results:
+        for detection in detections:
+            detection["model"] = "OWL-ViT Enhanced"
     
-    return detections
+    return results
 
+def detect_with_owlvit_enhanced(image, confidence_threshold=0.1, top_k=DEFAULT_TOP_K):
+    """Enhanced OWL-ViT detection with multiple prompts."""
+    return detect_with_owlvit_batch([image], confidence_threshold, top_k)[0]
+
+@profiled("paddleocr")
 def verify_with_ocr(image, detection):
     """Verify detection using OCR to check for Lay's text."""
     global paddleocr_model
@@ -181,8 +268,9 @@ def verify_with_ocr(image, detection):
         cropped = image.crop((x1, y1, x2, y2))
         img_array = np.array(cropped)
         
-        # Run OCR
-        result = paddleocr_model.ocr(img_array, cls=True)
+        # Run OCR, in a scheduler slot like the detector so bulk OCR also yields to interactive work
+        with inference_slot(scheduler):
+            result = paddleocr_model.ocr(img_array, cls=True)
         
         if result and result[0]:
             all_text = ""
@@ -210,25 +298,19 @@ def verify_with_ocr(image, detection):
         detection['ocr_text'] = f"OCR error: {str(e)}"
         return True  # Trust detection if OCR fails
 
-def multi_model_detect_lays(image, confidence_threshold=0.1):
-    """Multi-model detection with OWL-ViT + OCR verification."""
-    logger.info("Starting multi-model detection...")
-    
-    # Enhanced OWL-ViT detection
-    logger.info("Running enhanced OWL-ViT detection...")
-    detections = detect_with_owlvit_enhanced(image, confidence_threshold)
-    logger.info(f"OWL-ViT found {len(detections)} detections")
-    
+def verify_detections(image, detections, iou_threshold=0.3, verify=verify_with_ocr):
+    """NMS and OCR verification of one image's OWL-ViT detections."""
     # Apply NMS to remove duplicates
     logger.info("Applying Non-Maximum Suppression...")
-    filtered_detections = non_maximum_suppression(detections, iou_threshold=0.3)
+    filtered_detections = non_maximum_suppression(detections, iou_threshold=iou_threshold)
     logger.info(f"After NMS: {len(filtered_detections)} detections")
     
     # OCR verification for remaining detections
     logger.info("Running OCR verification...")
     verified_detections = []
     for detection in filtered_detections:
-        if verify_with_ocr(image, detection):
+        raise_if_abandoned()
+        if verify(image, detection):
             verified_detections.append(detection)
             logger.info(f"OCR verified detection with text: {detection.get('ocr_text', 'N/A')[:50]}")
         else:
@@ -237,6 +319,26 @@ def multi_model_detect_lays(image, confidence_threshold=0.1):
     logger.info(f"Final verified detections: {len(verified_detections)}")
     return verified_detections
 
+def multi_model_detect_lays(image, confidence_threshold=0.1):
+    """Multi-model detection with OWL-ViT + OCR verification."""
+    logger.info("Starting multi-model detection...")
+    raise_if_abandoned()
+    
+    # Enhanced OWL-ViT detection
+    logger.info("Running enhanced OWL-ViT detection...")
+    detections = detect_with_owlvit_enhanced(image, confidence_threshold)
+    logger.info(f"OWL-ViT found {len(detections)} detections")
+    
+    return verify_detections(image, detections)
+
+def multi_model_detect_lays_batch(images, confidence_threshold=0.1):
+    """Multi-model detection for several images with batched OWL-ViT calls."""
+    logger.info(f"Starting multi-model detection for {len(images)} images...")
+    raise_if_abandoned()
+    batch_detections = detect_with_owlvit_batch(images, confidence_threshold)
+    return [verify_detections(image, detections) for image, detections in zip(images, batch_detections)]
+
+@profiled("annotate")
 def create_annotated_image(image, detections):
     """Create an annotated version of the image with bounding boxes."""
     from PIL import ImageDraw, ImageFont
@@ -278,6 +380,17 @@ def create_annotated_image(image, detections):
     
     return annotated_image
 
+def summarize_detections(detections):
+    """Confidence, OCR verification and label summary of a non-empty detection list."""
+    ocr_verified_count = sum(1 for d in detections if d.get('ocr_verified', False))
+    return {
+        'avg_confidence': round(sum(d['score'] for d in detections) / len(detections), 2),
+        'ocr_verified': ocr_verified_count,
+        'ocr_verification_rate': round(ocr_verified_count / len(detections) * 100, 1),
+        'unique_labels': list(set(d['label'] for d in detections))
+    }
+
+@profiled("encode_image")
 def image_to_base64(image):
     """Convert PIL Image to base64 string."""
     buffer = io.BytesIO()
@@ -307,42 +420,211 @@ def upload_file():
         confidence = float(request.form.get('confidence', 0.1))
         
         # Read and process image
-        image = Image.open(file.stream)
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
+        if memory_budget is not None:
+            image, _ = memory_budget.open_image(file.stream, sam_working_bytes())
+        else:
+            image = Image.open(file.stream)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+        
+        record = {
+            'image_id': file.filename,
+            'shop_id': request.form.get('shop_id'),
+            'visit_id': request.form.get('visit_id')
+        }
+        
+        detect = lambda img, conf: multi_model_detect_lays(img, confidence_threshold=conf)
+        incremental = None
+        if layout_store is not None and record['shop_id']:
+            # Re-use the shop's previous layout and only re-detect what changed
+            def detect(img, conf, full=detect):
+                nonlocal incremental
+                found, incremental = incremental_detect(layout_store, record['shop_id'], img, conf, full,
+                                                        multi_model_detect_lays_batch)
+                return found
         
-        # Detect Lay's using multi-model approach
-        detections = multi_model_detect_lays(image, confidence_threshold=confidence)
+        # Cheap colour/quality gate before any model runs
+        screen = prescreen.screen(image) if prescreen is not None else None
+        if screen is None or screen['passed']:
+            # Detect Lay's using multi-model approach, keeping the raw outputs for /rethreshold
+            with capture_raw_outputs() as captured:
+                detections, near_duplicate = detect_with_index(duplicate_index, image, confidence, detect, record)
+            result_id = raw_cache.put(captured, image) if raw_cache is not None else None
+        else:
+            logger.info(f"Pre-screen rejected image: {screen['reason']}")
+            detections, near_duplicate, result_id = [], None, None
+            if screen['shadow']:
+                # Run the full pipeline anyway to measure the gate's false-negative rate
+                prescreen.record_shadow(multi_model_detect_lays(image, confidence_threshold=confidence))
+        
+        # Mask areas of the surviving boxes (embedding cached per image)
+        shelf_share = refine_masks(image, detections)
         
         # Prepare response data
         result = {
             'detected': len(detections) > 0,
             'count': len(detections),
             'detections': detections,
-            'original_image': image_to_base64(image)
+            'original_image': image_to_base64(image),
+            'near_duplicate': near_duplicate,
+            'prescreen': screen,
+            'incremental': incremental,
+            'shelf_share': shelf_share,
+            'result_id': result_id
         }
         
         if detections:
             annotated_image = create_annotated_image(image, detections)
             result['annotated_image'] = image_to_base64(annotated_image)
-            
-            avg_confidence = sum(d['score'] for d in detections) / len(detections)
-            result['avg_confidence'] = round(avg_confidence, 2)
-            
-            ocr_verified_count = sum(1 for d in detections if d.get('ocr_verified', False))
-            result['ocr_verified'] = ocr_verified_count
-            result['ocr_verification_rate'] = round(ocr_verified_count / len(detections) * 100, 1)
-            
-            # Get unique labels
-            unique_labels = list(set(d['label'] for d in detections))
-            result['unique_labels'] = unique_labels
+            result.update(summarize_detections(detections))
+        
+        if results_store is not None:
+            results_store.record(detections, model_version=model_version_name, confidence=confidence,
+                                 prescreen=screen, near_duplicate=near_duplicate, shelf_share=shelf_share, **record)
         
         return jsonify(result)
         
+    except (BudgetExceeded, RequestAbandoned):
+        raise
     except Exception as e:
         logger.error(f"Error in upload_file: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """Handle several photos (multipart files and/or zip/tar archives) in one request."""
+    try:
+        files = request.files.getlist('files') + request.files.getlist('file')
+        if not files:
+            return jsonify({'error': 'No files uploaded'}), 400
+        
+        confidence = float(request.form.get('confidence', 0.1))
+        include_images = request.form.get('include_images', 'false').lower() == 'true'
+        
+        try:
+            items = collect_uploads(files)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if not items:
+            return jsonify({'error': 'No images found in upload'}), 400
+        
+        if memory_budget is not None:
+            memory_budget.reserve_batch(items, sam_working_bytes())
+        
+        # Decode in parallel, then run the per-image gates before batching the model calls
+        results = []
+        decoded = []
+        pending = []
+        max_side = memory_budget.max_side if memory_budget is not None else None
+        for name, image, error in decode_images(items, max_side):
+            result = {'filename': name}
+            results.append(result)
+            if error:
+                result['error'] = error
+                continue
+            decoded.append((result, image))
+            
+            screen = prescreen.screen(image) if prescreen is not None else None
+            result['prescreen'] = screen
+            if screen is not None and not screen['passed']:
+                result['detections'] = []
+                continue
+            
+            image_hash = None
+            if duplicate_index is not None:
+                image_hash, near_duplicate, detections = find_duplicate(duplicate_index, image, confidence)
+                result['near_duplicate'] = near_duplicate
+                if detections is not None:
+                    result['detections'] = detections
+                    continue
+                if near_duplicate is not None:
+                    image_hash = None  # Already indexed under the earlier photo
+            pending.append((result, image, image_hash))
+        
+        if pending:
+            batch_detections = multi_model_detect_lays_batch([image for _, image, _ in pending], confidence)
+            for (result, image, image_hash), detections in zip(pending, batch_detections):
+                result['detections'] = detections
+                if image_hash is not None:
+                    remember(duplicate_index, image_hash, image, confidence, detections, {
+                        'image_id': result['filename'],
+                        'shop_id': request.form.get('shop_id'),
+                        'visit_id': request.form.get('visit_id')
+                    })
+        
+        for result, image in decoded:
+            detections = result['detections']
+            if mask_refiner is not None:
+                result['shelf_share'] = refine_masks(image, detections)
+            if results_store is not None:
+                results_store.record(detections, image_id=result['filename'], shop_id=request.form.get('shop_id'),
+                                     visit_id=request.form.get('visit_id'), model_version=model_version_name,
+                                     confidence=confidence, prescreen=result.get('prescreen'),
+                                     near_duplicate=result.get('near_duplicate'),
+                                     shelf_share=result.get('shelf_share'))
+            result['detected'] = len(detections) > 0
+            result['count'] = len(detections)
+            if detections:
+                result.update(summarize_detections(detections))
+            if include_images:
+                result['original_image'] = image_to_base64(image)
+                if detections:
+                    result['annotated_image'] = image_to_base64(create_annotated_image(image, detections))
+        
+        return jsonify({
+            'count': len(results),
+            'detected': sum(1 for r in results if r.get('detected')),
+            'results': results
+        })
+        
+    except (BudgetExceeded, RequestAbandoned):
+        raise
+    except Exception as e:
+        logger.error(f"Error in upload_batch: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/rethreshold', methods=['POST'])
+def rethreshold():
+    """Re-apply threshold, NMS and OCR gating to the cached raw outputs of an earlier /upload."""
+    try:
+        entry = raw_cache.get(request.form.get('result_id', '')) if raw_cache is not None else None
+        if entry is None:
+            return jsonify({'error': 'Unknown or expired result_id, upload the image again'}), 404
+        
+        confidence = float(request.form.get('confidence', 0.1))
+        iou_threshold = float(request.form.get('iou', 0.3))
+        ocr_gate = request.form.get('ocr', 'true').lower() == 'true'
+        
+        detections = entry.detections(confidence)
+        for detection in detections:
+            detection["model"] = "OWL-ViT Enhanced"
+        if ocr_gate:
+            verify = lambda image, detection: entry.verify(detection, verify_with_ocr)
+        else:
+            verify = lambda image, detection: True
+        detections = verify_detections(entry.image, detections, iou_threshold, verify)
+        if memory_budget is not None and mask_refiner is not None and detections:
+            memory_budget.reserve_for_request(mask_refiner.working_bytes(entry.image.size))
+        
+        result = {
+            'detected': len(detections) > 0,
+            'count': len(detections),
+            'detections': detections,
+            'shelf_share': refine_masks(entry.image, detections),
+            'result_id': request.form['result_id']
+        }
+        if detections:
+            result['annotated_image'] = image_to_base64(create_annotated_image(entry.image, detections))
+            result.update(summarize_detections(detections))
+        
+        return jsonify(result)
+
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"Error in rethreshold: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/health')
 def health():
     """Health check endpoint."""
@@ -350,7 +632,13 @@ def health():
         'status': 'healthy',
         'owlvit_loaded': owlvit_model is not None,
         'paddleocr_loaded': paddleocr_model is not None,
-        'device': str(device)
+        'device': str(device),
+        'prescreen': prescreen.stats() if prescreen is not None else None,
+        'memory': memory_budget.stats() if memory_budget is not None else None,
+        'sam': mask_refiner.stats() if mask_refiner is not None else None,
+        'single_flight': single_flight.stats() if single_flight is not None else None,
+        'raw_cache': raw_cache.stats() if raw_cache is not None else None,
+        'scheduler': scheduler.stats() if scheduler is not None else None
     })
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Fixed-shape OWL-ViT preprocessing
+
+Replaces the per-call OwlViTProcessor(text=..., images=...) pipeline for our
+fixed model input: prompt tokenization is cached, and each image goes through
+a single OpenCV resize followed by a fused mean/std normalization into a
+preallocated float buffer. Several images are stacked into one batch.
+"""
+
+import argparse
+import sys
+import threading
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+
+class OwlViTPreprocessor:
+    """Drop-in replacement for calling OwlViTProcessor on text prompts and images."""
+
+    def __init__(self, processor, max_batch_size=8):
+        self.tokenizer = processor.tokenizer
+        image_processor = processor.image_processor
+
+        size = image_processor.size
+        self.height, self.width = size["height"], size["width"]
+
+        mean = np.asarray(image_processor.image_mean, dtype=np.float32)
+        std = np.asarray(image_processor.image_std, dtype=np.float32)
+        rescale_factor = getattr(image_processor, "rescale_factor", 1 / 255)
+
+        # (pixel * rescale - mean) / std folded into a single multiply-add per channel
+        self._scale = (rescale_factor / std).astype(np.float32)
+        self._offset = (-mean / std).astype(np.float32)
+
+        self.max_batch_size = max_batch_size
+        self._text_cache = {}
+        self._text_lock = threading.Lock()
+        # Buffers are per thread so concurrent requests never share pixel memory
+        self._local = threading.local()
+
+    def __call__(self, text, images, device=None):
+        """Return input_ids, attention_mask and pixel_values ready for the model."""
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+
+        inputs = dict(self.encode_text(text, device))
+        if len(images) > 1:
+            inputs = {k: v.repeat(len(images), 1) for k, v in inputs.items()}
+
+        pixel_values = self.encode_images(images)
+        inputs["pixel_values"] = pixel_values.to(device) if device is not None else pixel_values
+        return inputs
+
+    def encode_text(self, prompts, device=None):
+        """Tokenize prompts once per prompt list and device, then reuse the tensors."""
+        key = (tuple(prompts), str(device))
+        encoding = self._text_cache.get(key)
+        if encoding is None:
+            with self._text_lock:
+                tokens = self.tokenizer(list(prompts), padding="max_length", return_tensors="pt")
+                encoding = {k: tokens[k] for k in ("input_ids", "attention_mask")}
+                if device is not None:
+                    encoding = {k: v.to(device) for k, v in encoding.items()}
+                self._text_cache[key] = encoding
+        return encoding
+
+    def encode_images(self, images):
+        """Resize and normalize images into the thread's batch buffer.
+
+        The returned CPU tensor shares memory with the buffer and stays valid
+        until the same thread preprocesses its next batch.
+        """
+        batch = self._batch_buffer(len(images))
+        resized = self._local.resized
+
+        for i, image in enumerate(images):
+            pixels = self._to_rgb_array(image)
+            src_height, src_width = pixels.shape[:2]
+
+            # INTER_AREA approximates the antialiased bicubic resize when shrinking photos
+            if src_width > self.width or src_height > self.height:
+                interpolation = cv2.INTER_AREA
+            else:
+                interpolation = cv2.INTER_CUBIC
+            cv2.resize(pixels, (self.width, self.height), dst=resized, interpolation=interpolation)
+
+            for c in range(3):
+                np.multiply(resized[:, :, c], self._scale[c], out=batch[i, c], casting="unsafe")
+                batch[i, c] += self._offset[c]
+
+        return torch.from_numpy(batch[:len(images)])
+
+    def _batch_buffer(self, batch_size):
+        """Per-thread CHW float buffer, grown when a larger batch arrives."""
+        batch = getattr(self._local, "batch", None)
+        if batch is None or batch.shape[0] < batch_size:
+            capacity = max(batch_size, self.max_batch_size)
+            batch = np.empty((capacity, 3, self.height, self.width), dtype=np.float32)
+            self._local.batch = batch
+            self._local.resized = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        return batch
+
+    @staticmethod
+    def _to_rgb_array(image):
+        if isinstance(image, Image.Image):
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            return np.asarray(image)
+        return np.ascontiguousarray(image)
+
+
+def compare_with_processor(processor, images, prompts):
+    """Return (max, mean) absolute difference between our pixel_values and the processor's."""
+    preprocessor = OwlViTPreprocessor(processor)
+    ours = preprocessor(text=prompts, images=images)
+    reference = processor(text=prompts, images=images, return_tensors="pt")
+
+    if not torch.equal(ours["input_ids"], reference["input_ids"]):
+        raise ValueError("Tokenized prompts differ from the processor output")
+
+    diff = (ours["pixel_values"] - reference["pixel_values"]).abs()
+    return float(diff.max()), float(diff.mean())
+
+
+def main():
+    """Check preprocessing parity against OwlViTProcessor for one or more images."""
+    from transformers import OwlViTProcessor
+
+    parser = argparse.ArgumentParser(description="Compare fast preprocessing with OwlViTProcessor")
+    parser.add_argument("images", nargs="+", help="Image files to compare")
+    parser.add_argument("--model", "-m", default="google/owlvit-base-patch32",
+                       help="Model name to use (default: google/owlvit-base-patch32)")
+    parser.add_argument("--tolerance", "-t", type=float, default=0.05,
+                       help="Maximum mean absolute difference allowed (default: 0.05)")
+    args = parser.parse_args()
+
+    processor = OwlViTProcessor.from_pretrained(args.model)
+    images = [Image.open(path).convert("RGB") for path in args.images]
+    max_diff, mean_diff = compare_with_processor(processor, images, ["Lay's potato chips bag", "Lay's logo"])
+
+    print(f"📊 Max abs difference: {max_diff:.4f}")
+    print(f"📊 Mean abs difference: {mean_diff:.4f}")
+    if mean_diff > args.tolerance:
+        print("❌ Preprocessing differs from OwlViTProcessor beyond tolerance")
+        sys.exit(1)
+    print("✅ Preprocessing matches OwlViTProcessor within tolerance")
+
+
+if __name__ == "__main__":
+    main()
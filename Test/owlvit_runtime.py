@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Compiled execution of the OWL-ViT forward pass
+
+Wraps an OwlViTForObjectDetection model so the fixed 768x768 detection
+forward can run as a frozen TorchScript trace or through torch.compile.
+Compiled artifacts are cached on disk so only the first boot pays for
+compilation. If compilation fails, or the compiled graph does not produce
+the same detections as the eager model, the runtime falls back to eager.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+import torch
+import transformers
+from transformers.models.owlvit.modeling_owlvit import OwlViTObjectDetectionOutput
+
+logger = logging.getLogger(__name__)
+
+COMPILE_MODES = ("eager", "trace", "compile")
+WARMUP_RUNS = 3
+# Bump when _DetectionForward's outputs change so stale cached traces are not reused
+TRACE_VERSION = 2
+DEFAULT_CACHE_DIR = os.environ.get(
+    "OWLVIT_COMPILE_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".owlvit_cache")
+)
+
+
+class _DetectionForward(torch.nn.Module):
+    """Positional-argument wrapper returning the tensors post-processing and the embedding store need."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, pixel_values, attention_mask):
+        outputs = self.model(input_ids=input_ids, pixel_values=pixel_values, attention_mask=attention_mask)
+        return outputs.logits, outputs.pred_boxes, outputs.image_embeds, outputs.class_embeds
+
+
+def _to_output(tensors):
+    logits, pred_boxes, image_embeds, class_embeds = tensors
+    return OwlViTObjectDetectionOutput(logits=logits, pred_boxes=pred_boxes,
+                                       image_embeds=image_embeds, class_embeds=class_embeds)
+
+
+def detections_match(reference, candidate, threshold=0.1, atol=1e-3):
+    """Check that two forward outputs yield the same thresholded detections."""
+    ref_scores, ref_labels = torch.max(reference.logits.float().sigmoid(), dim=-1)
+    cand_scores, cand_labels = torch.max(candidate.logits.float().sigmoid(), dim=-1)
+
+    ref_keep = ref_scores > threshold
+    if not torch.equal(ref_keep, cand_scores > threshold):
+        return False
+    if not torch.equal(ref_labels[ref_keep], cand_labels[ref_keep]):
+        return False
+    if not torch.allclose(ref_scores[ref_keep], cand_scores[ref_keep], atol=atol):
+        return False
+    return torch.allclose(reference.pred_boxes.float()[ref_keep], candidate.pred_boxes.float()[ref_keep], atol=atol)
+
+
+class OwlViTRuntime:
+    """Callable replacement for `owlvit_model(**inputs)` with optional compilation."""
+
+    def __init__(self, model, model_name, device, mode="eager", cache_dir=DEFAULT_CACHE_DIR,
+                 onednn_fusion=False, parity_threshold=0.1, parity_atol=1e-3):
+        if mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode '{mode}', expected one of {COMPILE_MODES}")
+
+        self.model = model.eval()
+        self.model_name = model_name
+        self.device = device
+        self.mode = mode
+        self.cache_dir = Path(cache_dir)
+        self.onednn_fusion = onednn_fusion
+        self.parity_threshold = parity_threshold
+        self.parity_atol = parity_atol
+
+        # Compiled callables keyed by input shapes; None marks an eager fallback
+        self._compiled = {}
+
+        if self.mode != "eager" and self.device.type == "cpu":
+            self.model.to(memory_format=torch.channels_last)
+
+    def __call__(self, input_ids, pixel_values, attention_mask, **kwargs):
+        """Run detection, compiling the graph for these input shapes on first use."""
+        if self.mode == "eager":
+            with torch.inference_mode():
+                return self.model(input_ids=input_ids, pixel_values=pixel_values, attention_mask=attention_mask)
+
+        if self.device.type == "cpu":
+            pixel_values = pixel_values.contiguous(memory_format=torch.channels_last)
+
+        key = self._shape_key(input_ids, pixel_values)
+        if key not in self._compiled:
+            self._compiled[key] = self._build(key, input_ids, pixel_values, attention_mask)
+
+        forward = self._compiled[key]
+        with torch.inference_mode():
+            if forward is not None:
+                try:
+                    return _to_output(forward(input_ids, pixel_values, attention_mask))
+                except RuntimeError as e:
+                    logger.warning(f"Compiled OWL-ViT ({self.mode}) failed at runtime for {key}, using eager: {e}")
+                    self._compiled[key] = None
+            return self.model(input_ids=input_ids, pixel_values=pixel_values, attention_mask=attention_mask)
+
+    @property
+    def is_compiled(self):
+        """True if at least one input shape runs through a compiled graph."""
+        return any(forward is not None for forward in self._compiled.values())
+
+    def _shape_key(self, input_ids, pixel_values):
+        return (tuple(input_ids.shape), tuple(pixel_values.shape))
+
+    def _cache_path(self, key):
+        """Artifact path unique to the model, library versions, device and shapes."""
+        fingerprint = "|".join([
+            self.model_name, torch.__version__, transformers.__version__,
+            self.device.type, self.mode, repr(key), str(TRACE_VERSION)
+        ])
+        digest = hashlib.sha1(fingerprint.encode()).hexdigest()[:16]
+        return self.cache_dir / f"owlvit-{self.mode}-{digest}.pt"
+
+    def _build(self, key, input_ids, pixel_values, attention_mask):
+        """Compile for one input shape and verify parity, returning None on failure."""
+        start = time.perf_counter()
+        try:
+            if self.mode == "trace":
+                forward = self._load_or_trace(key, input_ids, pixel_values, attention_mask)
+            else:
+                forward = self._torch_compile()
+
+            with torch.inference_mode():
+                reference = self.model(input_ids=input_ids, pixel_values=pixel_values, attention_mask=attention_mask)
+                # The JIT re-optimizes over the first calls, so check parity on the settled graph
+                for _ in range(WARMUP_RUNS):
+                    candidate = _to_output(forward(input_ids, pixel_values, attention_mask))
+
+            if not detections_match(reference, candidate, self.parity_threshold, self.parity_atol):
+                logger.warning(f"Compiled OWL-ViT ({self.mode}) failed parity check for {key}, using eager")
+                return None
+
+        except Exception as e:
+            logger.warning(f"OWL-ViT compilation ({self.mode}) failed for {key}, using eager: {e}")
+            return None
+
+        logger.info(f"Compiled OWL-ViT ({self.mode}) ready for {key} in {time.perf_counter() - start:.1f}s")
+        return forward
+
+    def _load_or_trace(self, key, input_ids, pixel_values, attention_mask):
+        """Load a frozen trace from the on-disk cache, tracing and saving it on a miss."""
+        path = self._cache_path(key)
+
+        traced = None
+        if path.exists():
+            logger.info(f"Loading cached OWL-ViT trace: {path}")
+            try:
+                traced = torch.jit.load(str(path), map_location=self.device)
+            except Exception as e:
+                # Truncated or incompatible file; re-trace over it
+                logger.warning(f"Discarding unreadable OWL-ViT trace {path}: {e}")
+                path.unlink(missing_ok=True)
+
+        if traced is None:
+            logger.info("Tracing OWL-ViT forward pass...")
+            with torch.no_grad():
+                traced = torch.jit.trace(
+                    _DetectionForward(self.model).eval(),
+                    (input_ids, pixel_values, attention_mask),
+                    strict=False
+                )
+                traced = torch.jit.freeze(traced)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # Written aside and renamed, so a killed or concurrent worker never leaves a truncated trace
+            temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            try:
+                torch.jit.save(traced, str(temp))
+                os.replace(temp, path)
+            finally:
+                temp.unlink(missing_ok=True)
+            logger.info(f"Saved OWL-ViT trace to: {path}")
+
+        # Operator fusion is applied after loading, optimized graphs do not round-trip through torch.jit.save
+        if self.device.type == "cpu":
+            torch.jit.enable_onednn_fusion(self.onednn_fusion)
+            traced = torch.jit.optimize_for_inference(traced)
+
+        return traced
+
+    def _torch_compile(self):
+        """torch.compile the forward, persisting Inductor's FX graph cache under cache_dir."""
+        inductor_dir = self.cache_dir / "inductor"
+        inductor_dir.mkdir(parents=True, exist_ok=True)
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(inductor_dir))
+
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+        if self.device.type == "cpu":
+            inductor_config.cpp.weight_prepack = True
+
+        return torch.compile(_DetectionForward(self.model).eval(), dynamic=False)
+
+
+def runtime_from_env(model, model_name, device):
+    """Build a runtime configured by OWLVIT_COMPILE_MODE / OWLVIT_ONEDNN_FUSION."""
+    mode = os.environ.get("OWLVIT_COMPILE_MODE", "eager").lower()
+    onednn_fusion = os.environ.get("OWLVIT_ONEDNN_FUSION", "0") == "1"
+    return OwlViTRuntime(model, model_name, device, mode=mode, onednn_fusion=onednn_fusion)
+
+
+def main():
+    """Compile OWL-ViT for an image, report the parity check and compare latency."""
+    from PIL import Image
+    from transformers import OwlViTProcessor, OwlViTForObjectDetection
+
+    parser = argparse.ArgumentParser(description="Compile OWL-ViT and check parity against eager execution")
+    parser.add_argument("image", help="Path to an image used for warm-up and the parity check")
+    parser.add_argument("--mode", "-m", choices=COMPILE_MODES[1:], default="trace",
+                       help="Compilation mode (default: trace)")
+    parser.add_argument("--model", default="google/owlvit-base-patch32",
+                       help="Model name to use (default: google/owlvit-base-patch32)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                       help="Directory for compiled artifacts")
+    parser.add_argument("--onednn-fusion", action="store_true",
+                       help="Enable oneDNN graph fusion for traced CPU graphs")
+    parser.add_argument("--runs", type=int, default=5, help="Timed runs per mode (default: 5)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    processor = OwlViTProcessor.from_pretrained(args.model)
+    model = OwlViTForObjectDetection.from_pretrained(args.model)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+
+    image = Image.open(args.image).convert("RGB")
+    inputs = processor(text=["Lay's potato chips bag", "Lay's logo"], images=image, return_tensors="pt")
+    inputs = {k: v.to(device) for k, v in inputs.items()}
+
+    eager = OwlViTRuntime(model, args.model, device, mode="eager")
+    compiled = OwlViTRuntime(model, args.model, device, mode=args.mode,
+                             cache_dir=args.cache_dir, onednn_fusion=args.onednn_fusion)
+
+    # The first compiled call builds, caches and parity-checks the graph
+    compiled(**inputs)
+    if not compiled.is_compiled:
+        print("❌ Compilation failed or parity check did not pass, eager fallback in use")
+        sys.exit(1)
+    print(f"✅ Parity check passed ({args.mode})")
+
+    for name, runtime in (("eager", eager), (args.mode, compiled)):
+        runtime(**inputs)
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            runtime(**inputs)
+        print(f"⏱️  {name}: {(time.perf_counter() - start) / args.runs * 1000:.1f} ms/forward")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Perceptual-hash near-duplicate index for submitted shelf photos
+
+Each photo gets a 64-bit DCT perceptual hash, which survives recompression,
+resizing and light cropping. Hashes are indexed with multi-index hashing:
+the hash is split into four 16-bit chunks, and by the pigeonhole principle
+any hash within Hamming distance r of a query matches it in at least one
+chunk to within r // 4 bits. A lookup therefore probes a few dozen buckets
+and verifies only those candidates, which stays sub-millisecond at millions
+of photos.
+
+The index is persistent and append-only: hashes and record offsets are
+binary files loaded with NumPy at startup, and each record (shop, visit and
+the detection result to reuse) is a JSON line read back on demand.
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from itertools import combinations
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+CHUNKS = 4
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+DEFAULT_MAX_DISTANCE = 10
+REBUILD_EVERY = 4096
+
+HASHES_FILE = "hashes.u64"
+OFFSETS_FILE = "offsets.u64"
+RECORDS_FILE = "records.jsonl"
+
+
+def perceptual_hash(image):
+    """64-bit DCT perceptual hash of a PIL image or RGB array."""
+    pixels = np.asarray(image.convert("RGB") if isinstance(image, Image.Image) else image)
+    gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    # Low-frequency 8x8 block without the DC term, thresholded at its median
+    low = cv2.dct(small)[:8, :8].flatten()[1:]
+    bits = low > np.median(low)
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value << 1
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _popcount(values):
+    """Per-element bit count of a uint64 array."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8)).reshape(len(values), 64).sum(axis=1)
+
+
+def _chunk(value, i):
+    return (value >> (i * CHUNK_BITS)) & CHUNK_MASK
+
+
+def _flip_masks(radius):
+    """All chunk-sized bit masks with at most `radius` bits set."""
+    masks = [0]
+    for bits in range(1, radius + 1):
+        for positions in combinations(range(CHUNK_BITS), bits):
+            mask = 0
+            for position in positions:
+                mask |= 1 << position
+            masks.append(mask)
+    return masks
+
+
+def rescale_detections(detections, from_size, to_size):
+    """Scale detection boxes recorded on an image of from_size onto to_size (width, height)."""
+    sx = to_size[0] / from_size[0]
+    sy = to_size[1] / from_size[1]
+    rescaled = []
+    for detection in detections:
+        x1, y1, x2, y2 = detection["box"]
+        rescaled.append(dict(detection, box=[x1 * sx, y1 * sy, x2 * sx, y2 * sy]))
+    return rescaled
+
+
+class PerceptualHashIndex:
+    """Persistent multi-index-hashing table of photo hashes and their detection records.
+
+    Each of the four chunk tables is a sorted array of chunk values with the
+    matching record ids and a 65536-entry bucket start table, rebuilt in bulk.
+    Hashes added since the last rebuild are scanned directly until there are
+    enough of them to make a rebuild worthwhile.
+    """
+
+    def __init__(self, path, max_distance=DEFAULT_MAX_DISTANCE, rebuild_every=REBUILD_EVERY):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_distance = max_distance
+        self.rebuild_every = rebuild_every
+        self._lock = threading.Lock()
+        self._masks = {}
+
+        self._hashes = np.zeros(1024, dtype=np.uint64)
+        self._offsets = np.zeros(1024, dtype=np.uint64)
+        self._count = 0
+        # (order, starts, indexed), replaced as a whole so lookups never mix two rebuilds
+        self._state = (np.zeros(0, dtype=np.int64), np.zeros((CHUNKS, CHUNK_MASK + 2), dtype=np.int64), 0)
+        self._load()
+
+    def __len__(self):
+        return self._count
+
+    def _load(self):
+        hashes_path = self.path / HASHES_FILE
+        if not hashes_path.exists():
+            return
+        hashes = np.fromfile(hashes_path, dtype="<u8")
+        offsets = np.fromfile(self.path / OFFSETS_FILE, dtype="<u8")
+
+        # A crash between writes can leave one file a record ahead; trust the shorter one
+        count = min(len(hashes), len(offsets))
+        self._reserve(count)
+        self._hashes[:count] = hashes[:count]
+        self._offsets[:count] = offsets[:count]
+        self._count = count
+        self._rebuild()
+
+    def _reserve(self, size):
+        if size > len(self._hashes):
+            capacity = max(size, 2 * len(self._hashes))
+            self._hashes = np.resize(self._hashes, capacity)
+            self._offsets = np.resize(self._offsets, capacity)
+
+    def _rebuild(self):
+        """Re-sort the chunk tables over every hash added so far."""
+        hashes = self._hashes[:self._count]
+        orders, starts = [], []
+        for i in range(CHUNKS):
+            chunks = ((hashes >> np.uint64(i * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.int64)
+            order = np.argsort(chunks, kind="stable")
+            orders.append(order)
+            starts.append(np.searchsorted(chunks[order], np.arange(CHUNK_MASK + 2)) + i * self._count)
+
+        # All four tables live in one array so a lookup gathers every bucket in one pass
+        self._state = (np.concatenate(orders), np.stack(starts), self._count)
+
+    def add(self, image_hash, record):
+        """Append a photo hash with its record, returning the record id."""
+        line = (json.dumps(record) + "\n").encode()
+        with self._lock:
+            with open(self.path / RECORDS_FILE, "ab") as f:
+                offset = f.tell()
+                f.write(line)
+            with open(self.path / OFFSETS_FILE, "ab") as f:
+                f.write(struct.pack("<Q", offset))
+            with open(self.path / HASHES_FILE, "ab") as f:
+                f.write(struct.pack("<Q", image_hash))
+
+            record_id = self._count
+            self._reserve(record_id + 1)
+            self._hashes[record_id] = image_hash
+            self._offsets[record_id] = offset
+            self._count += 1
+
+            if self._count - self._state[2] >= self.rebuild_every:
+                self._rebuild()
+        return record_id
+
+    def lookup(self, image_hash, max_distance=None):
+        """Return (record_id, distance) of the nearest indexed photo within max_distance, or None."""
+        max_distance = self.max_distance if max_distance is None else max_distance
+        chunk_radius = max_distance // CHUNKS
+        if chunk_radius not in self._masks:
+            self._masks[chunk_radius] = np.array(_flip_masks(chunk_radius), dtype=np.int64)
+        masks = self._masks[chunk_radius]
+
+        # Count before hashes: _reserve() swaps in a larger copy before the count grows
+        order, starts, indexed = self._state
+        count = self._count
+        hashes = self._hashes
+        probes = np.array([_chunk(image_hash, i) for i in range(CHUNKS)])[:, None] ^ masks
+        rows = np.arange(CHUNKS)[:, None]
+        lo = starts[rows, probes].ravel()
+        lengths = starts[rows, probes + 1].ravel() - lo
+
+        # Expand each (lo, length) bucket range into positions without a Python loop
+        total = int(lengths.sum())
+        positions = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        candidates = np.concatenate([order[positions], np.arange(indexed, count)])
+        if len(candidates) == 0:
+            return None
+
+        distances = _popcount(hashes[candidates] ^ np.uint64(image_hash))
+        best = int(np.argmin(distances))
+        if distances[best] > max_distance:
+            return None
+        return int(candidates[best]), int(distances[best])
+
+    def record(self, record_id):
+        """Read one stored record back from the records file."""
+        with open(self.path / RECORDS_FILE, "rb") as f:
+            f.seek(int(self._offsets[record_id]))
+            return json.loads(f.readline())
+
+
+def find_duplicate(index, image, confidence):
+    """Look up an intake photo, returning (image_hash, near_duplicate, reusable detections or None)."""
+    image_hash = perceptual_hash(image)
+    match = index.lookup(image_hash)
+    if match is None:
+        return image_hash, None, None
+
+    record_id, distance = match
+    prior = index.record(record_id)
+    near_duplicate = {key: prior.get(key) for key in ("image_id", "shop_id", "visit_id")}
+    near_duplicate.update(record_id=record_id, distance=distance)
+
+    # Results are only reused when the earlier run used the same confidence threshold
+    near_duplicate["reused"] = prior.get("confidence") == confidence
+    if not near_duplicate["reused"]:
+        return image_hash, near_duplicate, None
+    return image_hash, near_duplicate, rescale_detections(prior["detections"], prior["image_size"], image.size)
+
+
+def remember(index, image_hash, image, confidence, detections, record=None):
+    """Add a newly processed photo and its detections to the index."""
+    index.add(image_hash, dict(record or {}, confidence=confidence,
+                               image_size=list(image.size), detections=detections))
+
+
+def detect_with_index(index, image, confidence, detect, record=None):
+    """Run detect(image, confidence) unless a near-duplicate was already processed.
+
+    Returns (detections, near_duplicate): near_duplicate describes the matched
+    earlier photo and its distance, or is None. New photos are added to the
+    index with their detections.
+    """
+    if index is None:
+        return detect(image, confidence), None
+
+    image_hash, near_duplicate, detections = find_duplicate(index, image, confidence)
+    if detections is not None:
+        return detections, near_duplicate
+
+    detections = detect(image, confidence)
+    if near_duplicate is None:
+        remember(index, image_hash, image, confidence, detections, record)
+    return detections, near_duplicate
+
+
+def index_from_env():
+    """Open the index configured by PHASH_INDEX_DIR / PHASH_MAX_DISTANCE, or None if disabled."""
+    path = os.environ.get("PHASH_INDEX_DIR")
+    if not path:
+        return None
+    return PerceptualHashIndex(path, int(os.environ.get("PHASH_MAX_DISTANCE", DEFAULT_MAX_DISTANCE)))
+
+
+def main():
+    """Look up images in a near-duplicate index, optionally adding them."""
+    parser = argparse.ArgumentParser(description="Query a perceptual-hash near-duplicate index")
+    parser.add_argument("index", help="Index directory")
+    parser.add_argument("images", nargs="+", help="Image files to look up")
+    parser.add_argument("--max-distance", "-d", type=int, default=DEFAULT_MAX_DISTANCE,
+                       help=f"Maximum Hamming distance for a near-duplicate (default: {DEFAULT_MAX_DISTANCE})")
+    parser.add_argument("--add", action="store_true", help="Add images that have no near-duplicate")
+    args = parser.parse_args()
+
+    try:
+        index = PerceptualHashIndex(args.index, args.max_distance)
+        print(f"📊 Index holds {len(index)} photo(s)")
+
+        for path in args.images:
+            image_hash = perceptual_hash(Image.open(path))
+            start = time.perf_counter()
+            match = index.lookup(image_hash)
+            elapsed = (time.perf_counter() - start) * 1000
+
+            if match:
+                record_id, distance = match
+                print(f"🔁 {path}: near-duplicate of {index.record(record_id).get('image_id')} "
+                      f"(distance {distance}, {elapsed:.3f} ms)")
+            else:
+                print(f"🆕 {path}: no near-duplicate ({elapsed:.3f} ms)")
+                if args.add:
+                    index.add(image_hash, {"image_id": path})
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
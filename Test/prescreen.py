@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Colour/quality pre-screen for shelf photos
+
+Runs before any model: the photo is shrunk to a small thumbnail, then one
+HSV conversion gives the fraction of pixels in the Lay's yellow and red
+palette, the variance of the Laplacian gives a sharpness score and the grey
+histogram gives the exposure. Photos with no Lay's colours, heavy blur or
+blown/crushed exposure are rejected in a few milliseconds instead of paying
+for OWL-ViT and OCR.
+
+Features and the decision are kept separate so a labelled folder can be
+screened once and the thresholds swept offline:
+
+    python prescreen.py labelled/ --sweep-palette 0.001 0.002 0.005 0.01
+
+where labelled/ has `positive/` (Lay's visible) and `negative/` sub-folders.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+THUMBNAIL_SIZE = 256
+
+# OpenCV hue runs 0-180
+YELLOW_RANGE = ((18, 110, 110), (35, 255, 255))
+RED_RANGES = (((0, 120, 90), (8, 255, 255)), ((170, 120, 90), (180, 255, 255)))
+
+DEFAULT_MIN_YELLOW = 0.002
+DEFAULT_MIN_RED = 0.0005
+DEFAULT_MIN_SHARPNESS = 25.0
+DEFAULT_MAX_CLIPPED = 0.6
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
+
+
+def screen_features(image):
+    """Palette, sharpness and exposure features of a PIL image or RGB array."""
+    if isinstance(image, Image.Image):
+        # Integer box reduction on the PIL side avoids copying the full-size frame
+        factor = max(image.size) // THUMBNAIL_SIZE
+        if factor > 1:
+            image = image.reduce(factor)
+        pixels = np.asarray(image.convert("RGB"))
+    else:
+        pixels = image
+        height, width = pixels.shape[:2]
+        scale = THUMBNAIL_SIZE / max(height, width)
+        if scale < 1:
+            pixels = cv2.resize(pixels, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                interpolation=cv2.INTER_AREA)
+
+    hsv = cv2.cvtColor(pixels, cv2.COLOR_RGB2HSV)
+    total = hsv.shape[0] * hsv.shape[1]
+    yellow = cv2.countNonZero(cv2.inRange(hsv, *YELLOW_RANGE))
+    red = sum(cv2.countNonZero(cv2.inRange(hsv, low, high)) for low, high in RED_RANGES)
+
+    gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+    sharpness = cv2.Laplacian(gray, cv2.CV_32F).var()
+    histogram = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+
+    return {
+        "yellow_fraction": yellow / total,
+        "red_fraction": red / total,
+        "sharpness": float(sharpness),
+        "dark_fraction": float(histogram[:16].sum() / total),
+        "bright_fraction": float(histogram[240:].sum() / total),
+        "mean_brightness": float(gray.mean())
+    }
+
+
+class Prescreen:
+    """Threshold gate over screen_features with running reject/false-negative counters.
+
+    With a non-zero `shadow_rate`, that fraction of rejected photos is still
+    sent through the full pipeline by the caller and reported back through
+    record_shadow(), which estimates the live false-negative rate.
+    """
+
+    def __init__(self, min_yellow=DEFAULT_MIN_YELLOW, min_red=DEFAULT_MIN_RED,
+                 min_sharpness=DEFAULT_MIN_SHARPNESS, max_clipped=DEFAULT_MAX_CLIPPED, shadow_rate=0.0):
+        self.min_yellow = min_yellow
+        self.min_red = min_red
+        self.min_sharpness = min_sharpness
+        self.max_clipped = max_clipped
+        self.shadow_rate = shadow_rate
+
+        self._lock = threading.Lock()
+        self.screened = 0
+        self.rejected = {}
+        self.shadowed = 0
+        self.shadow_misses = 0
+
+    def decide(self, features):
+        """Return the rejection reason for a feature dict, or None if the photo passes."""
+        if features["dark_fraction"] > self.max_clipped:
+            return "underexposed"
+        if features["bright_fraction"] > self.max_clipped:
+            return "overexposed"
+        if features["sharpness"] < self.min_sharpness:
+            return "blurry"
+        if features["yellow_fraction"] < self.min_yellow or features["red_fraction"] < self.min_red:
+            return "no_palette"
+        return None
+
+    def screen(self, image):
+        """Screen one photo, returning a verdict dict with the features and timing."""
+        start = time.perf_counter()
+        features = screen_features(image)
+        reason = self.decide(features)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self.screened += 1
+            if reason:
+                self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+        return {
+            "passed": reason is None,
+            "reason": reason,
+            "shadow": reason is not None and random.random() < self.shadow_rate,
+            "features": {name: round(value, 5) for name, value in features.items()},
+            "elapsed_ms": round(elapsed_ms, 2)
+        }
+
+    def record_shadow(self, detections):
+        """Record the full-pipeline result of a shadowed rejected photo."""
+        with self._lock:
+            self.shadowed += 1
+            if detections:
+                self.shadow_misses += 1
+
+    def stats(self):
+        """Reject rate by reason and the shadow-estimated false-negative rate."""
+        with self._lock:
+            rejected = sum(self.rejected.values())
+            return {
+                "screened": self.screened,
+                "rejected": rejected,
+                "reject_rate": round(rejected / self.screened, 4) if self.screened else 0.0,
+                "rejected_by_reason": dict(self.rejected),
+                "shadowed": self.shadowed,
+                "false_negative_rate": round(self.shadow_misses / self.shadowed, 4) if self.shadowed else None
+            }
+
+
+def prescreen_from_env():
+    """Build the gate configured by PRESCREEN_* environment variables, or None if disabled."""
+    if os.environ.get("PRESCREEN", "0") != "1":
+        return None
+    return Prescreen(
+        min_yellow=float(os.environ.get("PRESCREEN_MIN_YELLOW", DEFAULT_MIN_YELLOW)),
+        min_red=float(os.environ.get("PRESCREEN_MIN_RED", DEFAULT_MIN_RED)),
+        min_sharpness=float(os.environ.get("PRESCREEN_MIN_SHARPNESS", DEFAULT_MIN_SHARPNESS)),
+        max_clipped=float(os.environ.get("PRESCREEN_MAX_CLIPPED", DEFAULT_MAX_CLIPPED)),
+        shadow_rate=float(os.environ.get("PRESCREEN_SHADOW_RATE", 0.0))
+    )
+
+
+def evaluate(samples, gate):
+    """Reject rate and false-negative rate of a gate over (features, is_positive) samples."""
+    positives = sum(1 for _, positive in samples if positive)
+    rejected = false_negatives = 0
+    for features, positive in samples:
+        if gate.decide(features):
+            rejected += 1
+            false_negatives += positive
+    return {
+        "reject_rate": rejected / len(samples) if samples else 0.0,
+        "false_negative_rate": false_negatives / positives if positives else 0.0
+    }
+
+
+def _labelled_images(folder):
+    folder = Path(folder)
+    for label, positive in (("positive", True), ("negative", False)):
+        for path in sorted((folder / label).rglob("*")):
+            if path.suffix.lower() in IMAGE_EXTENSIONS:
+                yield path, positive
+
+
+def main():
+    """Measure the pre-screen's reject and false-negative rates on a labelled folder."""
+    parser = argparse.ArgumentParser(description="Evaluate the colour/quality pre-screen")
+    parser.add_argument("folder", help="Folder with positive/ and negative/ sub-folders")
+    parser.add_argument("--min-yellow", type=float, default=DEFAULT_MIN_YELLOW,
+                       help=f"Minimum yellow pixel fraction (default: {DEFAULT_MIN_YELLOW})")
+    parser.add_argument("--min-red", type=float, default=DEFAULT_MIN_RED,
+                       help=f"Minimum red pixel fraction (default: {DEFAULT_MIN_RED})")
+    parser.add_argument("--min-sharpness", type=float, default=DEFAULT_MIN_SHARPNESS,
+                       help=f"Minimum Laplacian variance (default: {DEFAULT_MIN_SHARPNESS})")
+    parser.add_argument("--max-clipped", type=float, default=DEFAULT_MAX_CLIPPED,
+                       help=f"Maximum fraction of crushed or blown pixels (default: {DEFAULT_MAX_CLIPPED})")
+    parser.add_argument("--sweep-palette", type=float, nargs="+",
+                       help="Also report rates for these minimum yellow fractions")
+    args = parser.parse_args()
+
+    try:
+        gate = Prescreen(args.min_yellow, args.min_red, args.min_sharpness, args.max_clipped)
+        samples = []
+        timings = []
+        for path, positive in _labelled_images(args.folder):
+            image = Image.open(path)
+            image.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            verdict = gate.screen(image)
+            samples.append((verdict["features"], positive))
+            timings.append(verdict["elapsed_ms"])
+            if positive and not verdict["passed"]:
+                print(f"⚠️  {path}: positive rejected ({verdict['reason']})")
+
+        if not samples:
+            raise ValueError(f"No images found under {args.folder}/positive or {args.folder}/negative")
+
+        stats = gate.stats()
+        rates = evaluate(samples, gate)
+        print(f"\n📊 {len(samples)} image(s), median screen time {np.median(timings):.2f} ms")
+        print(f"   Reject rate: {rates['reject_rate']:.1%}")
+        print(f"   False-negative rate: {rates['false_negative_rate']:.1%}")
+        for reason, count in sorted(stats["rejected_by_reason"].items()):
+            print(f"   - {reason}: {count}")
+
+        if args.sweep_palette:
+            print("\n🔧 Yellow threshold sweep:")
+            for min_yellow in args.sweep_palette:
+                gate.min_yellow = min_yellow
+                rates = evaluate(samples, gate)
+                print(f"   {min_yellow:<8g} reject {rates['reject_rate']:.1%}  "
+                      f"false-negative {rates['false_negative_rate']:.1%}")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+On-demand profiler capture for live inference workers
+
+An admin arms the capture for the next N detection requests, either with
+`POST /admin/profile?requests=N` (X-Admin-Token header, only registered when
+ADMIN_TOKEN is set) or by sending SIGUSR2 to the worker (arms
+PROFILE_SIGNAL_REQUESTS, default 5). Each captured request is run under:
+
+- torch.profiler, exported as a Chrome trace (chrome://tracing, Perfetto)
+  with operator-level time of the OWL-ViT / Grounding DINO forwards;
+- a sampling profiler on the request thread (every PROFILE_SAMPLE_MS),
+  exported as collapsed stacks for flamegraph.pl or speedscope, which shows
+  Python overhead in PaddleOCR calls, NMS and annotation.
+
+Pipeline stages decorated with @profiled("name") appear as named ranges in
+the trace. While nothing is armed, the request hook and every decorated
+stage cost one attribute check, and nothing is imported or started.
+
+Files are written to PROFILE_DIR (default: profiles/) as
+<timestamp>-<n>.trace.json and <timestamp>-<n>.stacks.txt.
+"""
+
+import functools
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+DEFAULT_PROFILE_DIR = "profiles"
+DEFAULT_SAMPLE_MS = 5
+DEFAULT_SIGNAL_REQUESTS = 5
+PROFILED_PATHS = ("/upload", "/upload/batch", "/v1/detect")
+
+_active = threading.local()
+
+
+def profiled(name):
+    """Mark a pipeline stage as a named range in captured traces."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not getattr(_active, "capturing", False):
+                return func(*args, **kwargs)
+            import torch
+            with torch.profiler.record_function(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer and counts collapsed stacks."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class ProfilerCapture:
+    """Arms, runs and writes profiles for the next N requests, one request at a time."""
+
+    def __init__(self, output_dir=DEFAULT_PROFILE_DIR, sample_ms=DEFAULT_SAMPLE_MS):
+        self.output_dir = Path(output_dir)
+        self.sample_interval = sample_ms / 1000
+        self.remaining = 0
+        self.signalled = 0  # Set without the lock by the SIGUSR2 handler, moved to remaining by start()
+        self.files = []
+        self._lock = threading.Lock()
+        self._busy = False
+        self._count = 0
+
+    def arm(self, requests=1):
+        with self._lock:
+            self.remaining = max(0, int(requests))
+        return self.remaining
+
+    def arm_from_signal(self, requests):
+        """arm() for signal handlers, which must not wait on the lock the interrupted thread may hold."""
+        self.signalled = requests
+
+    def start(self):
+        """Begin capturing the current request if armed and no capture is running; returns a handle or None."""
+        with self._lock:
+            requests, self.signalled = self.signalled, 0
+            if requests:
+                self.remaining = requests
+            if self.remaining <= 0 or self._busy:
+                return None
+            self.remaining -= 1
+            self._busy = True
+            self._count += 1
+            number = self._count
+
+        import torch
+        from torch.profiler import ProfilerActivity, profile
+
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        profiler = profile(activities=activities, record_shapes=True, with_stack=False)
+        sampler = StackSampler(threading.get_ident(), self.sample_interval)
+        profiler.__enter__()
+        sampler.start()
+        _active.capturing = True
+        return profiler, sampler, number, time.perf_counter()
+
+    def finish(self, handle, label):
+        profiler, sampler, number, started = handle
+        _active.capturing = False
+        sampler.stop()
+        profiler.__exit__(None, None, None)
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            stem = self.output_dir / f"{time.strftime('%Y%m%d-%H%M%S')}-{number}"
+            profiler.export_chrome_trace(f"{stem}.trace.json")
+            sampler.write(f"{stem}.stacks.txt")
+            with self._lock:
+                self.files.append({"request": label, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                                   "trace": f"{stem}.trace.json", "stacks": f"{stem}.stacks.txt"})
+        finally:
+            with self._lock:
+                self._busy = False
+
+    def status(self):
+        with self._lock:
+            return {"armed": self.signalled or self.remaining, "capturing": self._busy, "captures": list(self.files[-20:])}
+
+
+def install_profiler(app, paths=PROFILED_PATHS):
+    """Add the capture hooks, the admin endpoint (with ADMIN_TOKEN) and the SIGUSR2 trigger to a Flask app."""
+    from flask import g, jsonify, request
+
+    capture = ProfilerCapture(os.environ.get("PROFILE_DIR", DEFAULT_PROFILE_DIR),
+                              float(os.environ.get("PROFILE_SAMPLE_MS", DEFAULT_SAMPLE_MS)))
+
+    @app.before_request
+    def _start_profile():
+        if (capture.remaining or capture.signalled) and request.path in paths:
+            g.profile_handle = capture.start()
+
+    @app.teardown_request
+    def _finish_profile(_exc):
+        handle = g.pop("profile_handle", None)
+        if handle is not None:
+            capture.finish(handle, f"{request.method} {request.path}")
+
+    token = os.environ.get("ADMIN_TOKEN")
+    if token:
+        @app.route('/admin/profile', methods=['GET', 'POST'])
+        def admin_profile():
+            """Arm the profiler for the next N requests (POST) or list captures (GET)."""
+            if request.headers.get('X-Admin-Token') != token:
+                return jsonify({'error': 'Forbidden'}), 403
+            if request.method == 'POST':
+                requests = request.args.get('requests', type=int) if 'requests' in request.args else 1
+                if requests is None or requests < 0:
+                    return jsonify({'error': 'requests must be a non-negative integer'}), 400
+                capture.arm(requests)
+            return jsonify(capture.status())
+
+    # Workers without an admin route can still be armed from the shell: kill -USR2 <pid>
+    if hasattr(signal, "SIGUSR2") and threading.current_thread() is threading.main_thread():
+        requests = int(os.environ.get("PROFILE_SIGNAL_REQUESTS", DEFAULT_SIGNAL_REQUESTS))
+        signal.signal(signal.SIGUSR2, lambda *_: capture.arm_from_signal(requests))
+
+    return capture
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+Cache of raw OWL-ViT outputs for re-thresholding without re-inference
+
+The confidence slider of the web UI used to re-upload the photo and re-run
+the whole pipeline for every position. After a full-image detection the
+pre-threshold logits and boxes (a few KB for the 576 patches of a 768 px
+input) are kept here together with the decoded image, under a `result_id`
+returned with the response. POST /rethreshold then re-applies the score
+threshold, the NMS IoU and the OCR gate to those outputs; OCR results are
+cached per box, so only boxes that were not read before are cropped and
+OCR'd.
+
+Entries expire after RAW_CACHE_SECONDS (default 600) and the oldest are
+dropped beyond RAW_CACHE_MB (default 256, counted as decoded RGB bytes).
+RAW_CACHE_MB=0 disables the cache.
+
+The model code reports its outputs with record_raw_outputs() while a
+capture_raw_outputs() is active on the calling thread, so the detection
+functions keep their signatures.
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from owlvit_postprocessing import DEFAULT_TOP_K, postprocess_batch
+
+DEFAULT_TTL_SECONDS = 600
+DEFAULT_CACHE_MB = 256
+
+_capturing = threading.local()
+
+
+@contextmanager
+def capture_raw_outputs():
+    """Collect the raw outputs recorded on this thread; yields the list of (logits, pred_boxes, image_size, prompts)."""
+    captured = []
+    _capturing.outputs = captured
+    try:
+        yield captured
+    finally:
+        _capturing.outputs = None
+
+
+def record_raw_outputs(outputs, image_sizes, prompts):
+    """Report a batch of raw model outputs to the active capture, if any."""
+    captured = getattr(_capturing, "outputs", None)
+    if captured is None:
+        return
+    logits = outputs.logits.detach().float().cpu()
+    pred_boxes = outputs.pred_boxes.detach().float().cpu()
+    for i, size in enumerate(image_sizes):
+        captured.append((logits[i].clone(), pred_boxes[i].clone(), tuple(size), list(prompts)))
+
+
+class RawOutputs:
+    """One image's pre-threshold outputs, its decoded image and the OCR results read so far."""
+
+    def __init__(self, logits, pred_boxes, image, prompts):
+        self.logits = logits
+        self.pred_boxes = pred_boxes
+        self.image = image
+        self.prompts = prompts
+        self.ocr = {}
+        self.created = time.monotonic()
+        self.nbytes = image.size[0] * image.size[1] * 3 + logits.numel() * 4 + pred_boxes.numel() * 4
+
+    def detections(self, threshold, top_k=DEFAULT_TOP_K):
+        """Candidate detections above threshold, as the live pipeline's post-processing returns them."""
+        outputs = SimpleNamespace(logits=self.logits[None], pred_boxes=self.pred_boxes[None])
+        return postprocess_batch(outputs, [self.image.size], self.prompts, threshold, top_k)[0]
+
+    def verify(self, detection, verify):
+        """OCR gate through the per-box cache; `verify(image, detection)` runs on a miss."""
+        key = tuple(round(v, 1) for v in detection["box"])
+        cached = self.ocr.get(key)
+        if cached is None:
+            verified = verify(self.image, detection)
+            cached = self.ocr[key] = (verified, detection.get("ocr_verified"), detection.get("ocr_text"))
+        detection["ocr_verified"], detection["ocr_text"] = cached[1], cached[2]
+        return cached[0]
+
+
+class RawOutputCache:
+    """Raw outputs by result id, expired by age and evicted oldest-first beyond a byte budget."""
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_CACHE_MB * 2**20):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._entries:
+            result_id, entry = next(iter(self._entries.items()))
+            if now - entry.created <= self.ttl_seconds and self._bytes <= self.max_bytes:
+                break
+            self._bytes -= entry.nbytes
+            del self._entries[result_id]
+
+    def put(self, captured, image):
+        """Keep the capture of a full-image detection; returns its result id, or None if there is none."""
+        full = [c for c in captured if c[2] == tuple(image.size)]
+        if len(captured) != 1 or not full:
+            return None  # Crops (incremental detection) or no model run (duplicate, pre-screen)
+        logits, pred_boxes, _, prompts = full[0]
+        entry = RawOutputs(logits, pred_boxes, image, prompts)
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[result_id] = entry
+            self._bytes += entry.nbytes
+            self._expire(time.monotonic())
+        return result_id if result_id in self._entries else None
+
+    def get(self, result_id):
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._entries.get(result_id)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "mb": round(self._bytes / 2**20, 1)}
+
+
+def raw_cache_from_env():
+    """Cache configured by RAW_CACHE_MB / RAW_CACHE_SECONDS, or None if RAW_CACHE_MB=0."""
+    cache_mb = float(os.environ.get("RAW_CACHE_MB", DEFAULT_CACHE_MB))
+    if cache_mb <= 0:
+        return None
+    return RawOutputCache(float(os.environ.get("RAW_CACHE_SECONDS", DEFAULT_TTL_SECONDS)), int(cache_mb * 2**20))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Reference bank of Lay's pack embeddings for image-conditioned detection
+
+A folder of cropped pack images is registered once: each crop goes through
+the OWL-ViT vision tower and the class embedding of the patch that best
+covers the whole crop becomes its query embedding (the same selection as
+OWL-ViT's image-guided detection). The bank is persisted as .npz, so at
+detection time every shelf patch is scored against the whole bank in a
+single matrix product without extra forward passes for the queries.
+
+Folder layout: one sub-folder per SKU (crops/lays_classic/*.jpg), or flat
+image files named after their SKU.
+
+Usage:
+    python reference_bank.py crops/ --output lays_bank.npz
+    python lays_detector.py shelf.jpg --reference-bank lays_bank.npz
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
+
+
+def _collect_references(folder):
+    """Return (path, label) pairs for every image in the reference folder."""
+    folder = Path(folder)
+    references = []
+    for path in sorted(folder.rglob("*")):
+        if path.suffix.lower() not in IMAGE_EXTENSIONS:
+            continue
+        label = path.parent.name if path.parent != folder else path.stem
+        references.append((path, label))
+    return references
+
+
+class ReferenceBank:
+    """Persisted OWL-ViT query embeddings for a set of labelled pack crops."""
+
+    def __init__(self, embeddings, labels, model_name):
+        if len(embeddings) != len(labels):
+            raise ValueError("Reference bank needs one label per embedding")
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.labels = list(labels)
+        self.model_name = model_name
+        self._device_embeddings = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def build(cls, folder, preprocessor, model, device, model_name, batch_size=8):
+        """Embed every crop in the folder with the OWL-ViT vision tower."""
+        references = _collect_references(folder)
+        if not references:
+            raise ValueError(f"No reference images found in: {folder}")
+
+        embeddings = []
+        for start in range(0, len(references), batch_size):
+            batch = references[start:start + batch_size]
+            crops = [Image.open(path).convert("RGB") for path, _ in batch]
+            pixel_values = preprocessor.encode_images(crops).to(device)
+
+            with torch.inference_mode():
+                feature_map, _ = model.image_embedder(pixel_values=pixel_values)
+                b, h, w, d = feature_map.shape
+                image_feats = feature_map.reshape(b, h * w, d)
+                query_embeds, _, _ = model.embed_image_query(image_feats, feature_map)
+
+            if query_embeds is None or len(query_embeds) != len(batch):
+                raise ValueError(f"Could not select a query patch for a crop in: {[str(p) for p, _ in batch]}")
+            embeddings.append(query_embeds.reshape(len(batch), -1).float().cpu().numpy())
+
+        return cls(np.concatenate(embeddings), [label for _, label in references], model_name)
+
+    @classmethod
+    def load(cls, path):
+        """Load a bank written by save()."""
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["embeddings"], data["labels"].tolist(), str(data["model_name"]))
+
+    def save(self, path):
+        """Write the bank to an .npz file."""
+        np.savez(path, embeddings=self.embeddings, labels=np.array(self.labels),
+                 model_name=np.array(self.model_name))
+
+    def query_embeds(self, device):
+        """Bank embeddings as a (1, num_references, dim) tensor, cached per device."""
+        key = str(device)
+        if key not in self._device_embeddings:
+            self._device_embeddings[key] = torch.from_numpy(self.embeddings).to(device)[None]
+        return self._device_embeddings[key]
+
+
+def main():
+    """Register a folder of cropped pack images as a reference bank."""
+    from model_bundle import load_owlvit
+    from owlvit_preprocessing import OwlViTPreprocessor
+
+    parser = argparse.ArgumentParser(description="Build a Lay's reference bank from cropped pack images")
+    parser.add_argument("folder", help="Folder of cropped pack images (one sub-folder per SKU)")
+    parser.add_argument("--output", "-o", default="lays_bank.npz", help="Output file (default: lays_bank.npz)")
+    parser.add_argument("--model", "-m", default="google/owlvit-base-patch32",
+                       help="Model name to use (default: google/owlvit-base-patch32)")
+    args = parser.parse_args()
+
+    try:
+        processor, model = load_owlvit(args.model)
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model.to(device).eval()
+
+        bank = ReferenceBank.build(args.folder, OwlViTPreprocessor(processor), model, device, args.model)
+        bank.save(args.output)
+
+        print(f"✅ Reference bank saved to: {args.output}")
+        print(f"📊 {len(bank)} reference(s) across {len(set(bank.labels))} SKU(s)")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
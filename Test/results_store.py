@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+Persistent results store for detections and audit history
+
+Every processed photo is written to a local SQLite database as one `images`
+row (shop, visit, time, model version, verdict) plus one `boxes` row per
+detection. The shop, day and model version are copied onto each box row so
+that range queries over millions of boxes ("Lay's boxes per shop per week
+for bundle X") are answered from the (shop_id, day), (sku, day) and
+(model_version, day) indexes without joining back to images.
+
+Writes are queued and a background thread inserts them in batches (one
+transaction per BATCH_SIZE photos or FLUSH_INTERVAL seconds), so request
+handlers never wait on disk. The database runs in WAL mode, so dashboard
+queries read while the apps write.
+
+Usage:
+    RESULTS_DB=results.db python multi_model_app.py
+    python results_store.py results.db compliance --since 2026-10-01 --by week
+    python results_store.py results.db boxes --shop S123 --since 2026-10-01
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 256
+FLUSH_INTERVAL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    image_id TEXT,
+    shop_id TEXT,
+    visit_id TEXT,
+    day TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    model_version TEXT,
+    confidence REAL,
+    detected INTEGER NOT NULL,
+    box_count INTEGER NOT NULL,
+    ocr_verified_count INTEGER NOT NULL,
+    prescreen_reason TEXT,
+    near_duplicate_of TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS boxes (
+    id INTEGER PRIMARY KEY,
+    image_row INTEGER NOT NULL REFERENCES images(id),
+    shop_id TEXT,
+    day TEXT NOT NULL,
+    model_version TEXT,
+    sku TEXT,
+    score REAL NOT NULL,
+    x1 REAL, y1 REAL, x2 REAL, y2 REAL,
+    ocr_verified INTEGER,
+    ocr_text TEXT
+);
+CREATE INDEX IF NOT EXISTS images_shop_day ON images (shop_id, day);
+CREATE INDEX IF NOT EXISTS images_day ON images (day);
+CREATE INDEX IF NOT EXISTS images_model_day ON images (model_version, day);
+CREATE INDEX IF NOT EXISTS boxes_image ON boxes (image_row);
+CREATE INDEX IF NOT EXISTS boxes_shop_day ON boxes (shop_id, day);
+CREATE INDEX IF NOT EXISTS boxes_sku_day ON boxes (sku, day);
+CREATE INDEX IF NOT EXISTS boxes_model_day ON boxes (model_version, day);
+"""
+
+# SQLite strftime formats for the compliance periods
+PERIODS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def _sku(detection):
+    return detection.get("sku") or detection.get("label")
+
+
+class ResultsStore:
+    """SQLite store of per-image and per-box detection results with a batching writer."""
+
+    def __init__(self, path, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._connection = _connect(self.path)
+        self._connection.executescript(SCHEMA)
+        self._read_lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="results-writer", daemon=True)
+        self._writer.start()
+
+    def record(self, detections, image_id=None, shop_id=None, visit_id=None, model_version=None,
+               confidence=None, prescreen=None, near_duplicate=None, created_at=None, **extra):
+        """Queue one photo's result for writing; returns immediately."""
+        created_at = created_at if created_at is not None else time.time()
+        self._queue.put({
+            "image_id": image_id,
+            "shop_id": shop_id,
+            "visit_id": visit_id,
+            "created_at": created_at,
+            "day": datetime.fromtimestamp(created_at, timezone.utc).strftime("%Y-%m-%d"),
+            "model_version": model_version,
+            "confidence": confidence,
+            "prescreen_reason": prescreen.get("reason") if prescreen else None,
+            "near_duplicate_of": near_duplicate.get("image_id") if near_duplicate else None,
+            "extra": json.dumps(extra) if extra else None,
+            "detections": detections
+        })
+
+    def flush(self):
+        """Block until everything queued so far has been written."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        self._connection.close()
+
+    def _write_loop(self):
+        while True:
+            batch, waiters = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while item is not None:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self._insert(batch)
+                except sqlite3.Error as e:
+                    logger.error(f"Results store write failed ({len(batch)} photos): {e}")
+            for waiter in waiters:
+                waiter.set()
+            if item is None:
+                return
+
+    def _insert(self, batch):
+        with self._read_lock, self._connection:
+            cursor = self._connection.cursor()
+            box_rows = []
+            for row in batch:
+                detections = row["detections"]
+                cursor.execute(
+                    "INSERT INTO images (image_id, shop_id, visit_id, day, created_at, model_version, confidence,"
+                    " detected, box_count, ocr_verified_count, prescreen_reason, near_duplicate_of, extra)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (row["image_id"], row["shop_id"], row["visit_id"], row["day"], row["created_at"],
+                     row["model_version"], row["confidence"], int(bool(detections)), len(detections),
+                     sum(1 for d in detections if d.get("ocr_verified")), row["prescreen_reason"],
+                     row["near_duplicate_of"], row["extra"])
+                )
+                image_row = cursor.lastrowid
+                for d in detections:
+                    x1, y1, x2, y2 = d["box"]
+                    box_rows.append((image_row, row["shop_id"], row["day"], row["model_version"], _sku(d),
+                                     d["score"], x1, y1, x2, y2,
+                                     int(d["ocr_verified"]) if "ocr_verified" in d else None, d.get("ocr_text")))
+            cursor.executemany(
+                "INSERT INTO boxes (image_row, shop_id, day, model_version, sku, score, x1, y1, x2, y2,"
+                " ocr_verified, ocr_text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                box_rows
+            )
+
+    def _query(self, sql, params):
+        with self._read_lock:
+            return [dict(row) for row in self._connection.execute(sql, params)]
+
+    def compliance(self, since=None, until=None, shop_id=None, model_version=None, by="week"):
+        """Per shop and period: photos, photos with Lay's, detection rate and box count."""
+        where, params = _filters(since, until, shop_id=shop_id, model_version=model_version)
+        return self._query(
+            f"SELECT shop_id, strftime('{PERIODS[by]}', day) AS period, COUNT(*) AS photos,"
+            " SUM(detected) AS photos_detected, ROUND(AVG(detected), 3) AS detection_rate,"
+            " SUM(box_count) AS boxes"
+            f" FROM images{where} GROUP BY shop_id, period ORDER BY shop_id, period",
+            params
+        )
+
+    def boxes(self, since=None, until=None, shop_id=None, sku=None, model_version=None, limit=1000):
+        """Box rows in a date range, newest first, optionally filtered by shop, SKU and model version."""
+        where, params = _filters(since, until, shop_id=shop_id, sku=sku, model_version=model_version)
+        return self._query(f"SELECT * FROM boxes{where} ORDER BY day DESC, id DESC LIMIT ?", params + [limit])
+
+    def images(self, since=None, until=None, shop_id=None, model_version=None, limit=1000):
+        """Image rows in a date range, newest first."""
+        where, params = _filters(since, until, shop_id=shop_id, model_version=model_version)
+        return self._query(f"SELECT * FROM images{where} ORDER BY created_at DESC LIMIT ?", params + [limit])
+
+
+def _filters(since, until, **equal):
+    """WHERE clause over the indexed columns; `since`/`until` are inclusive YYYY-MM-DD days."""
+    clauses, params = [], []
+    for column, value in equal.items():
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if since:
+        clauses.append("day >= ?")
+        params.append(since)
+    if until:
+        clauses.append("day <= ?")
+        params.append(until)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def results_store_from_env():
+    """Open the store configured by RESULTS_DB, or None if results are not persisted."""
+    path = os.environ.get("RESULTS_DB")
+    return ResultsStore(path) if path else None
+
+
+def main():
+    """Query a results database."""
+    parser = argparse.ArgumentParser(description="Query the detection results store")
+    parser.add_argument("database", help="SQLite results database")
+    parser.add_argument("query", choices=["compliance", "boxes", "images"], help="What to list")
+    parser.add_argument("--since", help="First day, YYYY-MM-DD")
+    parser.add_argument("--until", help="Last day, YYYY-MM-DD")
+    parser.add_argument("--shop", help="Shop ID")
+    parser.add_argument("--sku", help="SKU / detection label (boxes only)")
+    parser.add_argument("--model-version", help="Model version")
+    parser.add_argument("--by", choices=sorted(PERIODS), default="week", help="Compliance period (default: week)")
+    parser.add_argument("--limit", type=int, default=100, help="Maximum rows for boxes/images (default: 100)")
+    args = parser.parse_args()
+
+    try:
+        if not os.path.exists(args.database):
+            raise FileNotFoundError(f"Database not found: {args.database}")
+        store = ResultsStore(args.database)
+        start = time.perf_counter()
+        if args.query == "compliance":
+            rows = store.compliance(args.since, args.until, args.shop, args.model_version, args.by)
+        elif args.query == "boxes":
+            rows = store.boxes(args.since, args.until, args.shop, args.sku, args.model_version, args.limit)
+        else:
+            rows = store.images(args.since, args.until, args.shop, args.model_version, args.limit)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        for row in rows:
+            print(json.dumps(row))
+        print(f"✅ {len(rows)} row(s) in {elapsed:.1f} ms", file=sys.stderr)
+        store.close()
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+SAM2 mask refinement for share-of-shelf
+
+Detection boxes include shelf edge, price strip and neighbouring packs, so
+box area overstates how much of the shelf Lay's occupies. This optional
+stage runs after NMS/OCR and prompts SAM2 with the surviving boxes:
+
+- the image encoder (the expensive part) runs once per image; its embedding
+  is kept in a small LRU cache keyed by the image hash, so re-detecting the
+  same photo at another confidence threshold only re-runs the mask decoder;
+- all boxes of an image are decoded in batched prompt calls of
+  MASK_BATCH_SIZE boxes, at MASK_SIDE px on the longer side rather than at
+  photo resolution (the decoder predicts 256 px masks, so a larger upsample
+  adds no detail), and each chunk is reduced to areas and a bool union
+  before the next one;
+- each detection gets `mask_area` (pixels) and `mask_fill` (mask / box area),
+  and the image gets a share-of-shelf summary from the union of the masks,
+  with areas scaled back to photo pixels;
+- with a MemoryBudget, the app adds working_bytes() (one chunk of masks, the
+  union buffers and the encoder's copy of the image) to each request's
+  reservation before detection, so refinement never waits on the budget.
+
+Enabled with SAM_MODEL (e.g. facebook/sam2-hiera-small); SAM_CACHE_SIZE sets
+the number of cached embeddings (about 16 MB each for hiera models).
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from profiler_capture import profiled
+
+DEFAULT_CACHE_SIZE = 8
+MASK_BATCH_SIZE = 16
+MASK_SIDE = 1024
+
+
+def mask_size(size):
+    """(width, height) masks are decoded at for an image of `size`."""
+    width, height = size
+    scale = min(1.0, MASK_SIDE / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def image_hash(image):
+    """Content hash of a decoded PIL image."""
+    digest = hashlib.sha1(image.tobytes())
+    digest.update(f"{image.mode}{image.size}".encode())
+    return digest.hexdigest()
+
+
+class MaskRefiner:
+    """Box-prompted SAM2 masks with a per-image embedding cache."""
+
+    def __init__(self, predictor, cache_size=DEFAULT_CACHE_SIZE, batch_size=MASK_BATCH_SIZE):
+        self.predictor = predictor
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # The predictor holds one image's state at a time
+        self.hits = 0
+        self.misses = 0
+
+    def _set_image(self, image, key):
+        """Load the image's embedding into the predictor, from the cache when possible."""
+        state = self._cache.get(key)
+        if state is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            # SAM2ImagePredictor keeps the embedding in these attributes after set_image()
+            self.predictor._features, self.predictor._orig_hw = state
+            self.predictor._is_image_set = True
+            self.predictor._is_batch = False
+            return True
+
+        self.misses += 1
+        self.predictor.set_image(np.asarray(image))
+        if self.cache_size:
+            self._cache[key] = (self.predictor._features, self.predictor._orig_hw)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return False
+
+    def working_bytes(self, size):
+        """Upper bound on the memory of one refine() call for an image of `size`, beyond the cached embedding."""
+        mask_width, mask_height = mask_size(size)
+        masks = self.batch_size * mask_width * mask_height * 5  # float32 masks and their bool copy
+        encoder_input = size[0] * size[1] * 3 + 3 * 1024 * 1024 * 4
+        return masks + 2 * mask_width * mask_height + encoder_input
+
+    @profiled("sam")
+    def refine(self, image, detections, key=None):
+        """Add mask_area / mask_fill to each detection and return the image's share-of-shelf summary."""
+        if not detections:
+            return None
+        import torch
+
+        width, height = image.size
+        mask_width, mask_height = mask_size(image.size)
+        pixel_area = (width * height) / (mask_width * mask_height)
+        boxes = np.array([d["box"] for d in detections], dtype=np.float32)
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+        mask_boxes = boxes * np.array([mask_width / width, mask_height / height] * 2, dtype=np.float32)
+        union = np.zeros((mask_height, mask_width), dtype=bool)
+        areas = []
+
+        with self._lock, torch.inference_mode():
+            cached = self._set_image(image, key or image_hash(image))
+            # SAM2 scales box prompts from _orig_hw and upsamples its masks to it, so this decodes at mask size
+            orig_hw = self.predictor._orig_hw
+            self.predictor._orig_hw = [(mask_height, mask_width)]
+            try:
+                for start in range(0, len(mask_boxes), self.batch_size):
+                    chunk = mask_boxes[start:start + self.batch_size]
+                    masks, _, _ = self.predictor.predict(box=chunk, multimask_output=False)
+                    masks = masks.reshape(len(chunk), -1, mask_height, mask_width)[:, 0] > 0
+                    areas.extend(masks.sum(axis=(1, 2)).tolist())
+                    union |= masks.any(axis=0)
+            finally:
+                self.predictor._orig_hw = orig_hw
+
+        box_union = np.zeros((mask_height, mask_width), dtype=bool)
+        for detection, (x1, y1, x2, y2), (mx1, my1, mx2, my2), area in zip(detections, boxes, mask_boxes, areas):
+            box_area = max((x2 - x1) * (y2 - y1), 1.0)
+            detection["mask_area"] = int(area * pixel_area)
+            detection["mask_fill"] = round(float(area * pixel_area / box_area), 3)
+            box_union[int(my1):int(np.ceil(my2)), int(mx1):int(np.ceil(mx2))] = True
+
+        mask_area = int(union.sum() * pixel_area)
+        return {
+            "mask_area": mask_area,
+            "box_area": int(box_union.sum() * pixel_area),
+            "mask_share": round(float(union.mean()), 4),
+            "box_share": round(float(box_union.mean()), 4),
+            "embedding_cached": cached
+        }
+
+    def stats(self):
+        return {"cached_embeddings": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+def mask_refiner_from_env(device=None):
+    """SAM2 refiner configured by SAM_MODEL / SAM_CACHE_SIZE, or None if disabled."""
+    model_id = os.environ.get("SAM_MODEL")
+    if not model_id:
+        return None
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    kwargs = {"device": str(device)} if device is not None else {}
+    predictor = SAM2ImagePredictor.from_pretrained(model_id, **kwargs)
+    return MaskRefiner(predictor, int(os.environ.get("SAM_CACHE_SIZE", DEFAULT_CACHE_SIZE)))
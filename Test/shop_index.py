@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Spatial index of shops for nearest-shop and wrong-shop checks
+
+Shops are bucketed into a grid of roughly CELL_SIZE_M square cells: rows of
+equal latitude height, each row with its own longitude step so that a cell
+is at least CELL_SIZE_M wide everywhere in the row. A radius query only
+visits the ceil(radius / CELL_SIZE_M) rings of cells around the point and
+computes exact haversine distances for the shops in them.
+
+Like the perceptual-hash index, shops live in flat arrays sorted by cell key
+(binary-searched per cell), and newly added shops wait in a small unsorted
+tail that is brute-forced until REBUILD_EVERY of them have accumulated (or
+a batch query would compare too many pairs against it).
+Batch queries over whole visit logs are fully vectorized: every (visit,
+cell) probe is resolved with one searchsorted and one gather. Radii wider
+than MAX_RINGS cells are answered from a coarser copy of the grid (cells 4x,
+16x, ... larger, built on first use), and queries are processed in chunks of
+at most MAX_PROBES probes, so memory stays bounded for any radius and any
+number of visits.
+
+The grid does not wrap at the antimeridian, which no shop market comes near.
+
+Usage:
+    python shop_index.py shops.json --radius 30 --output wrong_shop.jsonl
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+from gps_validation import DEFAULT_RADIUS_M, LOCATIONS, VisitTable, _oid, _number, haversine, load_shops
+
+CELL_SIZE_M = 50
+REBUILD_EVERY = 1024
+BRUTE_FORCE_PAIRS = 1_000_000
+MAX_RINGS = 4
+MAX_PROBES = 1_000_000
+DEFAULT_MAX_NEAREST_M = 5000
+METERS_PER_DEGREE = 6371000 * math.pi / 180
+
+
+class ShopIndex:
+    """Grid index answering radius and nearest-shop queries over shop coordinates."""
+
+    def __init__(self, cell_size=CELL_SIZE_M, rebuild_every=REBUILD_EVERY):
+        self.cell_size = cell_size
+        self.rebuild_every = rebuild_every
+        self._lat_step = cell_size / METERS_PER_DEGREE
+        self.shop_ids = []
+        self._lats = np.zeros(0)
+        self._lons = np.zeros(0)
+        self._sorted = 0  # shops [0, _sorted) are in the sorted arrays, the rest are pending
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._order = np.zeros(0, dtype=np.int64)
+        self._coarse = {}  # cell size -> (shop count when built, ShopIndex over the same rows)
+
+    def __len__(self):
+        return len(self.shop_ids)
+
+    def _row(self, lats):
+        return np.floor((np.asarray(lats) + 90) / self._lat_step).astype(np.int64)
+
+    def _lon_step(self, rows):
+        # Measured at the row's pole-side edge, so every cell in the row is at least cell_size wide
+        edge = np.maximum(np.abs(rows * self._lat_step - 90), np.abs((rows + 1) * self._lat_step - 90))
+        return self._lat_step / np.maximum(np.cos(np.radians(np.minimum(edge, 89.9))), 1e-6)
+
+    def _col(self, lons, rows):
+        return np.floor((np.asarray(lons) + 180) / self._lon_step(rows)).astype(np.int64)
+
+    def _cell_keys(self, lats, lons):
+        rows = self._row(lats)
+        return (rows << 32) | self._col(lons, rows)
+
+    def add(self, shop_id, lat, lon):
+        self.add_many([shop_id], [lat], [lon])
+
+    def add_many(self, shop_ids, lats, lons):
+        """Insert shops; they are searchable immediately."""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        keep = ~(np.isnan(lats) | np.isnan(lons))
+        self.shop_ids.extend(shop_id for shop_id, ok in zip(shop_ids, keep) if ok)
+        self._lats = np.concatenate([self._lats, lats[keep]])
+        self._lons = np.concatenate([self._lons, lons[keep]])
+        if len(self) - self._sorted >= self.rebuild_every:
+            self._rebuild()
+
+    def _rebuild(self):
+        keys = self._cell_keys(self._lats, self._lons)
+        self._order = np.argsort(keys, kind="stable")
+        self._keys = keys[self._order]
+        self._sorted = len(self)
+
+    def _coarse_index(self, radius):
+        """Same shops on a grid whose cells are large enough for radius to span at most MAX_RINGS of them."""
+        cell_size = self.cell_size
+        while math.ceil(radius / cell_size) > MAX_RINGS:
+            cell_size *= 4
+        built = self._coarse.get(cell_size)
+        if built is None or built[0] != len(self):
+            index = ShopIndex(cell_size)
+            index.add_many(range(len(self)), self._lats, self._lons)
+            index._rebuild()
+            built = self._coarse[cell_size] = (len(self), index)
+        return built[1]
+
+    def within_batch(self, lats, lons, radius):
+        """All (query, shop) pairs within radius meters.
+
+        Returns (query_indexes, shop_rows, distances) sorted by query and then
+        distance; shop_rows index into `shop_ids`.
+        """
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        rings = max(1, math.ceil(radius / self.cell_size))
+        if rings > MAX_RINGS:
+            return self._coarse_index(radius).within_batch(lats, lons, radius)
+
+        pending = len(self) - self._sorted
+        if pending and len(lats) * pending > BRUTE_FORCE_PAIRS:
+            self._rebuild()
+            pending = 0
+
+        step = max(1, MAX_PROBES // (2 * rings + 1) ** 2)
+        if len(lats) <= step:
+            return self._within_chunk(lats, lons, radius, rings, pending)
+        starts = range(0, len(lats), step)
+        parts = [self._within_chunk(lats[i:i + step], lons[i:i + step], radius, rings, pending) for i in starts]
+        return (np.concatenate([queries + i for (queries, _, _), i in zip(parts, starts)]),
+                np.concatenate([rows for _, rows, _ in parts]),
+                np.concatenate([distances for _, _, distances in parts]))
+
+    def _within_chunk(self, lats, lons, radius, rings, pending):
+        offsets = np.arange(-rings, rings + 1)
+
+        # One probe per (query, row offset, column offset)
+        rows = self._row(lats)[:, None] + offsets[None, :]
+        cols = self._col(lons[:, None], rows)
+        keys = (rows[:, :, None] << 32) | (cols[:, :, None] + offsets[None, None, :])
+        starts = np.searchsorted(self._keys, keys.ravel(), side="left")
+        counts = np.searchsorted(self._keys, keys.ravel(), side="right") - starts
+        probe_query = np.repeat(np.arange(len(lats)), keys.shape[1] * keys.shape[2])
+
+        # Gather every candidate without a Python loop over probes
+        total = counts.sum()
+        query_indexes = np.repeat(probe_query, counts)
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        shop_rows = self._order[positions]
+
+        # Shops added since the last rebuild are compared against every query
+        if pending:
+            query_indexes = np.concatenate([query_indexes, np.repeat(np.arange(len(lats)), pending)])
+            shop_rows = np.concatenate([shop_rows, np.tile(np.arange(self._sorted, len(self)), len(lats))])
+
+        with np.errstate(invalid="ignore"):
+            distances = haversine(lats[query_indexes], lons[query_indexes], self._lats[shop_rows], self._lons[shop_rows])
+        hit = distances <= radius
+        query_indexes, shop_rows, distances = query_indexes[hit], shop_rows[hit], distances[hit]
+        order = np.lexsort((distances, query_indexes))
+        return query_indexes[order], shop_rows[order], distances[order]
+
+    def nearest_batch(self, lats, lons, max_distance=DEFAULT_MAX_NEAREST_M):
+        """Nearest shop row and distance per query (-1 / NaN when none is within max_distance)."""
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        nearest = np.full(len(lats), -1, dtype=np.int64)
+        distances = np.full(len(lats), np.nan)
+        pending = np.flatnonzero(~(np.isnan(lats) | np.isnan(lons)))
+
+        # Grow the search radius only for the queries that have not found a shop yet
+        radius = self.cell_size
+        while len(pending) and len(self):
+            radius = min(radius, max_distance)
+            query_indexes, shop_rows, found = self.within_batch(lats[pending], lons[pending], radius)
+            first = np.flatnonzero(np.r_[True, query_indexes[1:] != query_indexes[:-1]]) if len(query_indexes) else []
+            hits = pending[query_indexes[first]]
+            nearest[hits] = shop_rows[first]
+            distances[hits] = found[first]
+            pending = np.setdiff1d(pending, hits, assume_unique=True)
+            if radius >= max_distance:
+                break
+            radius *= 4
+        return nearest, distances
+
+    def within(self, lat, lon, radius):
+        """Shops within radius meters of a point as (shop_id, distance), nearest first."""
+        _, shop_rows, distances = self.within_batch([lat], [lon], radius)
+        return [(self.shop_ids[row], float(d)) for row, d in zip(shop_rows, distances)]
+
+    def nearest(self, lat, lon, max_distance=DEFAULT_MAX_NEAREST_M):
+        """Nearest shop as (shop_id, distance), or None."""
+        rows, distances = self.nearest_batch([lat], [lon], max_distance)
+        return (self.shop_ids[rows[0]], float(distances[0])) if rows[0] >= 0 else None
+
+    @classmethod
+    def from_shops(cls, shops, cell_size=CELL_SIZE_M):
+        """Index exported shop documents by their gps_n / gps_e."""
+        index = cls(cell_size)
+        index.add_many([_oid(shop.get("_id")) for shop in shops],
+                       [_number(shop.get("gps_n")) for shop in shops],
+                       [_number(shop.get("gps_e")) for shop in shops])
+        index._rebuild()
+        return index
+
+
+def find_wrong_shops(table, index, radius=DEFAULT_RADIUS_M, location="photoClick"):
+    """Visits whose location is within radius of a different shop than the assigned one.
+
+    Returns (visit_rows, nearest_shop_rows, nearest_distances, assigned_distances).
+    """
+    lats, lons = table.locations[location]
+    nearest, distances = index.nearest_batch(lats, lons, max_distance=radius)
+    nearest_ids = np.array([index.shop_ids[row] if row >= 0 else None for row in nearest], dtype=object)
+    with np.errstate(invalid="ignore"):
+        assigned = haversine(table.shop_lat, table.shop_lon, lats, lons)
+    wrong = (nearest >= 0) & (nearest_ids != np.array(table.shop_ids, dtype=object)) & ~(assigned <= radius)
+    rows = np.flatnonzero(wrong)
+    return rows, nearest[rows], distances[rows], assigned[rows]
+
+
+def main():
+    """Flag visits taken at a different registered shop than the assigned one."""
+    parser = argparse.ArgumentParser(description="Nearest-shop / wrong-shop check over a shop export")
+    parser.add_argument("shops", help="Shop export (JSON array or JSON lines)")
+    parser.add_argument("--radius", type=float, default=DEFAULT_RADIUS_M,
+                       help=f"Radius in meters (default: {DEFAULT_RADIUS_M})")
+    parser.add_argument("--location", choices=LOCATIONS, default="photoClick",
+                       help="Visit location to check (default: photoClick)")
+    parser.add_argument("--cell-size", type=float, default=CELL_SIZE_M,
+                       help=f"Grid cell size in meters (default: {CELL_SIZE_M})")
+    parser.add_argument("--output", "-o", help="Write flagged visits as JSON lines")
+    args = parser.parse_args()
+
+    try:
+        shops = load_shops(args.shops)
+        start = time.perf_counter()
+        index = ShopIndex.from_shops(shops, args.cell_size)
+        table = VisitTable.from_shops(shops, args.radius)
+        loaded = time.perf_counter()
+
+        rows, nearest, distances, assigned = find_wrong_shops(table, index, args.radius, args.location)
+        elapsed = time.perf_counter() - loaded
+        print(f"📍 {len(index)} shop(s), {len(table)} visit(s) indexed in {loaded - start:.2f}s, "
+              f"checked in {elapsed * 1000:.1f} ms")
+        print(f"⚠️  {len(rows)} visit(s) taken at a different shop")
+
+        if args.output:
+            with open(args.output, "w") as f:
+                for row, shop_row, distance, assigned_distance in zip(rows, nearest, distances, assigned):
+                    f.write(json.dumps({
+                        "shopId": table.shop_ids[row],
+                        "visitIndex": int(table.visit_index[row]),
+                        "nearestShopId": index.shop_ids[shop_row],
+                        "nearestDistance": float(distance),
+                        "assignedDistance": None if np.isnan(assigned_distance) else float(assigned_distance)
+                    }) + "\n")
+            print(f"💾 Results saved to: {args.output}")
+
+    except Exception as e:
+        print(f"❌ Error: {str(e)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+"""
+Incremental per-shop detection against the previous visit's shelf layout
+
+Each shop's last accepted photo is remembered as ORB features, a grey
+thumbnail and its detections. On the next visit the new photo is aligned to
+the previous one with a RANSAC homography, then:
+
+1. every earlier detection is projected into the new photo and re-verified
+   with a crop-level check (normalized cross-correlation against the warped
+   earlier crop, which costs microseconds);
+2. a thumbnail difference after warping marks the shelf regions that
+   changed, plus anything the previous photo did not cover;
+3. full detection runs only on crops around the changed regions and the
+   boxes that failed re-verification, all crops in one batched call when a
+   batch detector is given.
+
+When alignment fails, more than MAX_CHANGED_FRACTION of the photo changed,
+or the crops would number more than MAX_REGIONS or cover more than
+MAX_REGION_FRACTION of the photo (each crop is a full model forward plus
+OCR, so many crops cost more than one full-image pass), the visit falls
+back to full-image detection. Either way the new
+photo and its detections become the shop's layout for the next visit.
+"""
+
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+FEATURE_SIZE = 1024
+THUMBNAIL_SIZE = 512
+MIN_MATCHES = 40
+MIN_INLIER_RATIO = 0.4
+MATCH_RATIO = 0.75
+DIFF_THRESHOLD = 40
+MIN_CROP_CORRELATION = 0.6
+MAX_BOX_CHANGE = 0.25
+MAX_CHANGED_FRACTION = 0.5
+REGION_MARGIN = 0.1
+MIN_REGION_SIZE = 64
+REGION_TILE = 64
+MAX_REGIONS = 8
+MAX_REGION_FRACTION = 0.5
+
+_orb = cv2.ORB_create(nfeatures=2000)
+_matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+
+
+def _gray(image, size):
+    """Grey copy of a PIL image with its longer side at most `size`, and the scale used."""
+    pixels = np.asarray(image.convert("RGB"))
+    scale = min(1.0, size / max(pixels.shape[:2]))
+    gray = cv2.cvtColor(pixels, cv2.COLOR_RGB2GRAY)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return gray, scale
+
+
+def _scale_matrix(scale):
+    return np.diag([scale, scale, 1.0])
+
+
+def _project_box(box, homography):
+    """Bounding box of a projected (x1, y1, x2, y2) box."""
+    x1, y1, x2, y2 = box
+    corners = np.array([[[x1, y1]], [[x2, y1]], [[x2, y2]], [[x1, y2]]], dtype=np.float32)
+    projected = cv2.perspectiveTransform(corners, homography).reshape(-1, 2)
+    return [float(projected[:, 0].min()), float(projected[:, 1].min()),
+            float(projected[:, 0].max()), float(projected[:, 1].max())]
+
+
+def _clip_box(box, width, height):
+    x1, y1, x2, y2 = box
+    return [max(0.0, x1), max(0.0, y1), min(float(width), x2), min(float(height), y2)]
+
+
+def _expand(box, margin, width, height):
+    x1, y1, x2, y2 = box
+    dx, dy = (x2 - x1) * margin, (y2 - y1) * margin
+    return _clip_box([x1 - dx, y1 - dy, x2 + dx, y2 + dy], width, height)
+
+
+def _correlation(a, b):
+    a = a.astype(np.float32) - a.mean()
+    b = b.astype(np.float32) - b.mean()
+    denominator = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denominator) if denominator > 0 else 0.0
+
+
+class ShopLayout:
+    """Previous visit's features, thumbnail and detections for one shop."""
+
+    def __init__(self, size, keypoints, descriptors, thumbnail, thumbnail_scale, feature_scale, detections):
+        self.size = size
+        self.keypoints = keypoints
+        self.descriptors = descriptors
+        self.thumbnail = thumbnail
+        self.thumbnail_scale = thumbnail_scale
+        self.feature_scale = feature_scale
+        self.detections = detections
+
+    @classmethod
+    def from_image(cls, image, detections):
+        features, feature_scale = _gray(image, FEATURE_SIZE)
+        keypoints, descriptors = _orb.detectAndCompute(features, None)
+        points = np.array([kp.pt for kp in keypoints], dtype=np.float32).reshape(-1, 2)
+        thumbnail, thumbnail_scale = _gray(image, THUMBNAIL_SIZE)
+        return cls(list(image.size), points, descriptors, thumbnail, thumbnail_scale, feature_scale, detections)
+
+
+class ShopLayoutStore:
+    """Per-shop layouts persisted as one .npz (arrays) and one .json (detections) per shop."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def lock(self, shop_id):
+        """Per-shop lock so two uploads for the same shop do not interleave."""
+        with self._locks_lock:
+            return self._locks.setdefault(shop_id, threading.Lock())
+
+    def _base(self, shop_id):
+        return self.path / re.sub(r"[^A-Za-z0-9_.-]", "_", str(shop_id))
+
+    def load(self, shop_id):
+        base = self._base(shop_id)
+        if not base.with_suffix(".json").exists():
+            return None
+        with open(base.with_suffix(".json")) as f:
+            meta = json.load(f)
+        with np.load(base.with_suffix(".npz")) as arrays:
+            descriptors = arrays["descriptors"] if arrays["descriptors"].size else None
+            return ShopLayout(meta["size"], arrays["keypoints"], descriptors, arrays["thumbnail"],
+                              meta["thumbnail_scale"], meta["feature_scale"], meta["detections"])
+
+    def save(self, shop_id, layout):
+        base = self._base(shop_id)
+        descriptors = layout.descriptors if layout.descriptors is not None else np.zeros((0, 32), np.uint8)
+        np.savez(base.with_suffix(".npz"), keypoints=layout.keypoints, descriptors=descriptors,
+                 thumbnail=layout.thumbnail)
+        with open(base.with_suffix(".json"), "w") as f:
+            json.dump({"size": layout.size, "thumbnail_scale": layout.thumbnail_scale,
+                       "feature_scale": layout.feature_scale, "detections": layout.detections}, f)
+
+
+def align(previous, current):
+    """Homography mapping previous-photo pixels to current-photo pixels, or None."""
+    if previous.descriptors is None or current.descriptors is None:
+        return None
+    if len(previous.descriptors) < MIN_MATCHES or len(current.descriptors) < MIN_MATCHES:
+        return None
+
+    pairs = _matcher.knnMatch(previous.descriptors, current.descriptors, k=2)
+    good = [p[0] for p in pairs if len(p) == 2 and p[0].distance < MATCH_RATIO * p[1].distance]
+    if len(good) < MIN_MATCHES:
+        return None
+
+    source = previous.keypoints[[m.queryIdx for m in good]].reshape(-1, 1, 2)
+    target = current.keypoints[[m.trainIdx for m in good]].reshape(-1, 1, 2)
+    homography, inliers = cv2.findHomography(source, target, cv2.RANSAC, 5.0)
+    if homography is None or inliers.sum() < max(MIN_MATCHES, MIN_INLIER_RATIO * len(good)):
+        return None
+
+    # Keypoints live in feature-image coordinates; lift the homography to full-size pixels
+    return (np.linalg.inv(_scale_matrix(current.feature_scale)) @ homography
+            @ _scale_matrix(previous.feature_scale))
+
+
+def changed_mask(previous, current, homography):
+    """Thumbnail-resolution mask of pixels that changed or were not covered by the previous photo."""
+    to_thumbnail = (_scale_matrix(current.thumbnail_scale) @ homography
+                    @ np.linalg.inv(_scale_matrix(previous.thumbnail_scale)))
+    height, width = current.thumbnail.shape
+    warped = cv2.warpPerspective(previous.thumbnail, to_thumbnail, (width, height))
+    covered = cv2.warpPerspective(np.full_like(previous.thumbnail, 255), to_thumbnail, (width, height))
+
+    # Blur both sides so sensor noise and slight misalignment do not count as change
+    difference = cv2.absdiff(cv2.GaussianBlur(warped, (5, 5), 0), cv2.GaussianBlur(current.thumbnail, (5, 5), 0))
+    mask = ((difference > DIFF_THRESHOLD) | (covered < 255)).astype(np.uint8) * 255
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+    mask = cv2.dilate(mask, np.ones((7, 7), np.uint8))
+    return mask, warped
+
+
+def incremental_detect(store, shop_id, image, confidence, detect, detect_batch=None):
+    """Detect with `detect(image, confidence)`, reusing the shop's previous layout where possible.
+
+    Changed crops go through `detect_batch(images, confidence)` in one call
+    when it is given. Returns (detections, info) where info reports the mode
+    used and how much of the photo was re-detected.
+    """
+    with store.lock(shop_id):
+        current = ShopLayout.from_image(image, [])
+        previous = store.load(shop_id)
+        homography = align(previous, current) if previous is not None else None
+
+        if homography is None:
+            detections = detect(image, confidence)
+            info = {"mode": "full", "reason": "no previous visit" if previous is None else "alignment failed"}
+        else:
+            detections, info = _detect_changes(previous, current, homography, image, confidence, detect,
+                                               detect_batch)
+
+        current.detections = detections
+        store.save(shop_id, current)
+        return detections, info
+
+
+def _detect_changes(previous, current, homography, image, confidence, detect, detect_batch=None):
+    width, height = image.size
+    mask, warped = changed_mask(previous, current, homography)
+    changed_fraction = float((mask > 0).mean())
+    if changed_fraction > MAX_CHANGED_FRACTION:
+        return detect(image, confidence), {"mode": "full", "reason": "layout changed",
+                                           "changed_fraction": round(changed_fraction, 3)}
+
+    thumbnail_scale = current.thumbnail_scale
+    carried, regions = [], []
+    for detection in previous.detections:
+        box = _clip_box(_project_box(detection["box"], homography), width, height)
+        if box[2] - box[0] < 2 or box[3] - box[1] < 2:
+            continue
+
+        # Crop-level re-verification on the thumbnails
+        tx1, ty1, tx2, ty2 = [int(round(v * thumbnail_scale)) for v in box]
+        box_mask = mask[ty1:ty2, tx1:tx2]
+        if box_mask.size == 0:
+            continue
+        box_change = float((box_mask > 0).mean())
+        correlation = _correlation(warped[ty1:ty2, tx1:tx2], current.thumbnail[ty1:ty2, tx1:tx2])
+
+        if box_change <= MAX_BOX_CHANGE and correlation >= MIN_CROP_CORRELATION:
+            carried.append(dict(detection, box=box, incremental="carried"))
+        else:
+            regions.append(box)
+
+    # Changed areas of the shelf become extra regions to re-detect
+    regions += [[v / thumbnail_scale for v in region] for region in _mask_regions(mask)]
+
+    # A crop smaller than a typical product cannot contain one; grow it around its centre
+    sizes = np.array([[d["box"][2] - d["box"][0], d["box"][3] - d["box"][1]] for d in previous.detections]
+                     or [[MIN_REGION_SIZE, MIN_REGION_SIZE]])
+    min_width, min_height = np.maximum(np.median(sizes, axis=0) * 1.5, MIN_REGION_SIZE)
+    regions = [_grow(_expand(r, REGION_MARGIN, width, height), min_width, min_height, width, height)
+               for r in regions]
+
+    crops = [[int(round(v)) for v in region] for region in _merge_regions(regions)]
+    crops = [(x1, y1, x2, y2) for x1, y1, x2, y2 in crops if x2 - x1 >= 16 and y2 - y1 >= 16]
+    region_area = sum(_area(crop) for crop in crops)
+    if len(crops) > MAX_REGIONS or region_area > MAX_REGION_FRACTION * width * height:
+        return detect(image, confidence), {"mode": "full", "reason": "too many changed regions",
+                                           "changed_fraction": round(changed_fraction, 3),
+                                           "regions": len(crops)}
+
+    images = [image.crop(crop) for crop in crops]
+    if detect_batch is not None:
+        found = detect_batch(images, confidence) if images else []
+    else:
+        found = [detect(crop_image, confidence) for crop_image in images]
+
+    redetected = []
+    for (x1, y1, _, _), detections in zip(crops, found):
+        for detection in detections:
+            bx1, by1, bx2, by2 = detection["box"]
+            redetected.append(dict(detection, box=[bx1 + x1, by1 + y1, bx2 + x1, by2 + y1],
+                                   incremental="redetected"))
+
+    # Overlapping crops can find the same product twice; keep the best-scoring box of each
+    unique = []
+    for detection in sorted(redetected, key=lambda d: d["score"], reverse=True):
+        if not any(_iou(detection["box"], kept["box"]) > 0.5 for kept in unique):
+            unique.append(detection)
+    redetected = unique
+
+    # A carried box overlapped by a fresh detection of the same region is dropped in favour of the new one,
+    # and a fresh box that is mostly inside a confirmed one is a product cut off at a crop edge
+    carried = [c for c in carried if not any(_iou(c["box"], r["box"]) > 0.5 for r in redetected)]
+    redetected = [r for r in redetected if not any(_overlap(r["box"], c["box"]) > 0.7 for c in carried)]
+    return carried + redetected, {
+        "mode": "incremental",
+        "changed_fraction": round(changed_fraction, 3),
+        "carried": len(carried),
+        "redetected": len(redetected),
+        "redetected_area": round(float(region_area) / (width * height), 3)
+    }
+
+
+def _iou(a, b):
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def _overlap(a, b):
+    """Fraction of box a that lies inside box b."""
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    return ix * iy / _area(a) if _area(a) > 0 else 0.0
+
+
+def _area(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def _grow(box, min_width, min_height, width, height):
+    x1, y1, x2, y2 = box
+    grow_x, grow_y = max(0.0, min_width - (x2 - x1)) / 2, max(0.0, min_height - (y2 - y1)) / 2
+    return _clip_box([x1 - grow_x, y1 - grow_y, x2 + grow_x, y2 + grow_y], width, height)
+
+
+def _mask_regions(mask):
+    """Boxes (thumbnail pixels) around the changed components of a mask.
+
+    Sparse components, such as the L-shaped strip a shifted camera leaves
+    uncovered, are split into REGION_TILE tiles instead of one bounding box
+    spanning the whole photo.
+    """
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(mask)
+    regions = []
+    for label in range(1, count):
+        x, y, w, h, area = stats[label]
+        if area < 0.002 * mask.size:
+            continue
+        if area >= 0.5 * w * h:
+            regions.append([x, y, x + w, y + h])
+            continue
+        component = labels[y:y + h, x:x + w] == label
+        for ty in range(0, h, REGION_TILE):
+            for tx in range(0, w, REGION_TILE):
+                tile = component[ty:ty + REGION_TILE, tx:tx + REGION_TILE]
+                if tile.any():
+                    ys, xs = np.nonzero(tile)
+                    regions.append([x + tx + xs.min(), y + ty + ys.min(), x + tx + xs.max() + 1, y + ty + ys.max() + 1])
+    return regions
+
+
+def _merge_regions(regions):
+    """Union overlapping boxes when the union adds little area, until nothing more merges."""
+    merged = list(regions)
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    union = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    if _area(union) > 1.2 * (_area(a) + _area(b)):
+                        continue
+                    merged[i] = union
+                    merged.pop(j)
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def layout_store_from_env():
+    """Open the store configured by SHOP_LAYOUT_DIR, or None if incremental detection is disabled."""
+    path = os.environ.get("SHOP_LAYOUT_DIR")
+    return ShopLayoutStore(path) if path else None
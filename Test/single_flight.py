@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Single-flight coalescing of identical in-flight detection requests
+
+A double-tapped submit or a backend retry after a timeout sends the same
+photo again while the first request is still running. Without coalescing
+each copy runs the whole pipeline, doubling load exactly when the service
+is already slow.
+
+Requests to COALESCED_PATHS are keyed by a SHA-256 over the path, query
+string, form fields and uploaded bytes (or the raw body). The first request
+with a key becomes the leader and runs the handler as usual; requests with
+the same key that arrive while it runs wait for it and answer with a copy of
+its response (status, body and headers), errors included. An exception that
+escapes the leader's handler is re-raised in every waiter. Once the leader
+finishes the key is forgotten, so this is not a result cache.
+
+Cancellation: a waiter whose client disconnects detaches and stops waiting.
+The leader calls raise_if_abandoned() between pipeline stages; when its own
+client is gone and no waiter is left, it raises RequestAbandoned and the
+remaining stages are skipped (answered with 499). A stage that is already
+running, e.g. a model forward, is not interrupted.
+
+Disconnects are detected by peeking at the client socket, which the
+werkzeug server and gunicorn expose in the WSGI environ; behind other
+servers clients are assumed connected.
+
+Disable with SINGLE_FLIGHT=0.
+"""
+
+import hashlib
+import os
+import socket
+import threading
+
+COALESCED_PATHS = ("/upload", "/upload/batch", "/v1/detect")
+POLL_SECONDS = 0.5
+ABANDONED_STATUS = 499  # nginx's "client closed request"
+
+_current = threading.local()
+
+
+class RequestAbandoned(Exception):
+    """Raised in the leader when every client waiting for its result has disconnected."""
+
+
+def client_disconnected(environ):
+    """Whether the client of a WSGI request has closed its connection."""
+    sock = environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+    if sock is None or not hasattr(socket, "MSG_DONTWAIT"):
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+
+
+class Flight:
+    """One in-flight computation and the requests waiting for it."""
+
+    def __init__(self, key, environ):
+        self.key = key
+        self.environ = environ  # The leader's, for its disconnect check
+        self.waiters = 0
+        self.leader_attached = True
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight:
+    """Registry of in-flight requests by key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def join(self, key, environ):
+        """(flight, is_leader) for a request with this key."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = Flight(key, environ)
+            self.leaders += 1
+            return flight, True
+
+    def wait(self, flight, environ):
+        """Block until the leader publishes; returns False if this client disconnected first."""
+        while not flight.done.wait(POLL_SECONDS):
+            if client_disconnected(environ):
+                with self._lock:
+                    flight.waiters -= 1
+                return False
+        return True
+
+    def publish(self, flight, response=None, error=None):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight.response, flight.error = response, error
+        flight.done.set()
+
+    def abandon_if_unwatched(self, flight):
+        """Drop the flight if its leader's client and all waiters are gone; returns whether it was dropped."""
+        if flight.leader_attached and client_disconnected(flight.environ):
+            flight.leader_attached = False
+        with self._lock:
+            if flight.leader_attached or flight.waiters > 0:
+                return False
+            # Later arrivals start a fresh computation instead of joining a cancelled one
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            self.abandoned += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "leaders": self.leaders,
+                    "coalesced": self.coalesced, "abandoned": self.abandoned}
+
+
+def raise_if_abandoned():
+    """Stop the current request's pipeline when nobody is waiting for its result any more."""
+    state = getattr(_current, "state", None)
+    if state is not None and state[0].abandon_if_unwatched(state[1]):
+        _current.state = None
+        raise RequestAbandoned("All clients disconnected")
+
+
+def request_key(flask_request):
+    """SHA-256 over the request's path, query, form fields and uploaded content."""
+    digest = hashlib.sha256()
+    digest.update(f"{flask_request.method} {flask_request.path}?{flask_request.query_string.decode()}".encode())
+    for name, value in sorted(flask_request.form.items(multi=True)):
+        digest.update(f"\0{name}={value}".encode())
+    files = list(flask_request.files.items(multi=True))
+    for field, storage in files:
+        digest.update(f"\0{field}:{storage.filename}\0".encode())
+        for chunk in iter(lambda: storage.stream.read(1 << 20), b""):
+            digest.update(chunk)
+        storage.seek(0)
+    if not files and not flask_request.form:
+        digest.update(flask_request.get_data())  # cached, so the handler still sees it
+    return digest.hexdigest()
+
+
+def install_single_flight(app, paths=COALESCED_PATHS):
+    """Coalesce identical concurrent requests to a Flask app unless SINGLE_FLIGHT=0."""
+    if os.environ.get("SINGLE_FLIGHT", "1") == "0":
+        return None
+    from flask import g, jsonify, request
+
+    registry = SingleFlight()
+
+    @app.before_request
+    def _join_flight():
+        if request.method != "POST" or request.path not in paths:
+            return None
+        flight, leader = registry.join(request_key(request), request.environ)
+        if leader:
+            g.flight = flight
+            _current.state = (registry, flight)
+            return None
+
+        if not registry.wait(flight, request.environ):
+            return app.response_class(status=ABANDONED_STATUS)
+        if flight.error is not None:
+            raise flight.error
+        status, body, headers = flight.response
+        return app.response_class(body, status=status, headers=headers)
+
+    @app.after_request
+    def _publish_response(response):
+        flight = g.pop("flight", None)
+        if flight is not None:
+            _current.state = None
+            registry.publish(flight, response=(response.status_code, response.get_data(), list(response.headers)))
+        return response
+
+    @app.teardown_request
+    def _publish_error(exc):
+        # Only reached with the flight still set when the handler raised past after_request
+        flight = g.pop("flight", None)
+        if flight is not None:
+            _current.state = None
+            registry.publish(flight, error=exc or RuntimeError("Request failed"))
+
+    @app.errorhandler(RequestAbandoned)
+    def _abandoned(_error):
+        return jsonify({"error": "Client disconnected"}), ABANDONED_STATUS
+
+    return registry
@@ -8,12 +8,20 @@ document.addEventListener('DOMContentLoaded', function() {
     const confidenceValue = document.getElementById('confidenceValue');
     const resultsSection = document.getElementById('resultsSection');
     const loading = document.getElementById('loading');
+    let lastResult = null;
 
     // Confidence slider update
     confidenceSlider.addEventListener('input', function() {
         confidenceValue.textContent = this.value;
     });
 
+    // Re-apply the threshold to the cached model outputs instead of re-uploading
+    confidenceSlider.addEventListener('change', function() {
+        if (lastResult && lastResult.result_id) {
+            rethreshold();
+        }
+    });
+
     // File input change
     fileInput.addEventListener('change', function() {
         if (this.files.length > 0) {
@@ -55,6 +63,8 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     function handleFileSelect(file) {
+        lastResult = null;
+
         // Validate file type
         if (!file.type.startsWith('image/')) {
             alert('Please select an image file.');
@@ -110,11 +120,38 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    function rethreshold() {
+        const formData = new FormData();
+        formData.append('result_id', lastResult.result_id);
+        formData.append('confidence', confidenceSlider.value);
+
+        fetch('/rethreshold', {
+            method: 'POST',
+            body: formData
+        })
+        .then(response => {
+            if (response.status === 404) {
+                return null;  // Cached outputs expired, run the full detection again
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data === null) {
+                detectLays();
+                return;
+            }
+            data.original_image = lastResult.original_image;
+            displayResults(data);
+        })
+        .catch(error => console.error('Error re-thresholding:', error));
+    }
+
     function displayResults(data) {
         if (data.error) {
             alert('Error: ' + data.error);
             return;
         }
+        lastResult = data;
 
         // Show results section
         resultsSection.style.display = 'block';
@@ -176,23 +213,10 @@ document.addEventListener('DOMContentLoaded', function() {
             // Keep original image
         } else if (tabName === 'annotated') {
             tabs[1].classList.add('active');
-            // Fetch annotated image from the last result
-            fetch('/upload', {
-                method: 'POST',
-                body: (() => {
-                    const formData = new FormData();
-                    formData.append('file', fileInput.files[0]);
-                    formData.append('confidence', confidenceSlider.value);
-                    return formData;
-                })()
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.annotated_image) {
-                    resultImage.src = data.annotated_image;
-                }
-            })
-            .catch(error => console.error('Error loading annotated image:', error));
+            // Annotated image of the last result
+            if (lastResult && lastResult.annotated_image) {
+                resultImage.src = lastResult.annotated_image;
+            }
         }
     };
 
@@ -17,6 +17,37 @@ const laysKeywords = [
   'lay chip', 'lay chips', 'lais chip', 'lais chips', 'lais lays'
 ];
 
+// Local Python detection service (Test/detection_service.py); when set it replaces Cloud Vision
+const localDetectionUrl = process.env.LOCAL_DETECTION_URL;
+
+/**
+ * Analyze image with the local detection service, which answers in the same shape as below.
+ * Node's fetch keeps a pooled keep-alive connection to the service between calls.
+ * @param {string} imageUrl - URL of the image to analyze
+ * @returns {Object} Detection results
+ */
+const analyzeWithLocalService = async (imageUrl) => {
+  console.log('🔍 Starting local AI analysis for image:', imageUrl);
+
+  const response = await fetch(
+    `${localDetectionUrl}/v1/detect?url=${encodeURIComponent(imageUrl)}`,
+    { method: 'POST', signal: AbortSignal.timeout(60000) }
+  );
+  const result = await response.json();
+  if (!response.ok) {
+    throw new Error(result.error || `Local detection failed with status ${response.status}`);
+  }
+
+  console.log('✅ Local AI Analysis completed:', {
+    laysDetected: result.laysDetected,
+    laysCount: result.laysCount,
+    confidence: result.confidence,
+    detectionMethod: result.detectionMethod
+  });
+
+  return { ...result, processedAt: new Date(result.processedAt) };
+};
+
 /**
  * Analyze image using Google Cloud Vision API to detect Lay's products
  * @param {string} imageUrl - URL of the image to analyze
@@ -24,6 +55,10 @@ const laysKeywords = [
  */
 export const analyzeImageForLays = async (imageUrl) => {
   try {
+    if (localDetectionUrl) {
+      return await analyzeWithLocalService(imageUrl);
+    }
+
     console.log('🔍 Starting AI analysis for image:', imageUrl);
 
     // Prepare the request